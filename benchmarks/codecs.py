@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Cost of encoding and decoding messages by the codecs.
+
+Each shape of message sent millions of times a day (execution reports
+`NEW`, `CANCELED`, `FILL`, level updates, trades, errors) is encoded
+by the generic path (`simplejson.dumps()` of the dict, as before
+`market.codecs`), by `codecs.JSON` (precompiled templates) and, for
+replies to participants, by `codecs.BINARY`. Decoding `createOrder`
+and `cancelOrder` is compared the same way.
+
+Run from the project directory, e.g. `PYTHONPATH=. benchmarks/codecs.py`.
+"""
+
+import argparse
+from decimal import Decimal
+import time
+
+import simplejson as json
+
+from market import codecs, wire
+
+
+arg_parser = argparse.ArgumentParser(description=__doc__)
+arg_parser.add_argument('--repeat', type=int, default=100000,
+                        help='Messages per measurement, default 100000.')
+arg_parser.add_argument('--output', help='Write the results (JSON) here.')
+
+#: Messages to encode (mapping shape -> message).
+ENCODED = {
+    'new': {
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 1461700123,
+        'report': 'NEW',
+        'seqId': 123456,
+    },
+    'canceled': {
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 1461700123,
+        'report': 'CANCELED',
+        'seqId': 123456,
+    },
+    'fill': {
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 1461700123,
+        'report': 'FILL',
+        'price': Decimal('149.05'),
+        'quantity': 25,
+        'seqId': 123456,
+    },
+    'orderbook': {
+        'type': 'orderbook',
+        'symbol': 'WOOD',
+        'side': 'bid',
+        'price': 149,
+        'quantity': 1200,
+        'seqId': 123456,
+    },
+    'trade': {
+        'type': 'trade',
+        'symbol': 'WOOD',
+        'time': 1461700123.456789,
+        'price': 149,
+        'quantity': 25,
+        'seqId': 123456,
+    },
+    'error': {
+        'error': 'Order does not exist.',
+        'seqId': 123456,
+    },
+}
+
+#: Messages of participants to decode (mapping name -> (JSON line,
+#: binary message)).
+DECODED = {
+    'createOrder': (
+        b'{"message": "createOrder", "orderId": 1461700123, "side": "BUY", '
+        b'"price": 149, "quantity": 25, "seqId": 123}',
+        wire.create_order(1461700123, 'BUY', 14900, 25, seq_id=123)),
+    'cancelOrder': (
+        b'{"message": "cancelOrder", "orderId": 1461700123, "seqId": 123}',
+        wire.cancel_order(1461700123, seq_id=123)),
+}
+
+
+def generic(msg):
+    return json.dumps(msg).encode('utf-8') + b'\n'
+
+
+def measure(function, argument, repeat):
+    """Nanoseconds per a call (the best of three runs)."""
+
+    best = None
+    for run in range(3):
+        start = time.perf_counter_ns()
+        for i in range(repeat):
+            function(argument)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / repeat)
+
+
+def run(args):
+    encode = {}
+    for shape, msg in ENCODED.items():
+        encode[shape] = {
+            'generic_ns': measure(generic, msg, args.repeat),
+            'json_ns': measure(codecs.JSON.encode, msg, args.repeat),
+            'json_bytes': len(codecs.JSON.encode(msg)),
+        }
+        if 'type' not in msg:
+            encode[shape]['binary_ns'] = measure(codecs.BINARY.encode, msg,
+                                                 args.repeat)
+            encode[shape]['binary_bytes'] = len(codecs.BINARY.encode(msg))
+
+    decode = {}
+    for name, (line, data) in DECODED.items():
+        decode[name] = {
+            'json_ns': measure(codecs.JSON.decode, line, args.repeat),
+            'binary_ns': measure(codecs.BINARY.decode, data, args.repeat),
+            'json_bytes': len(line) + 1,
+            'binary_bytes': len(data),
+        }
+    return {'encode': encode, 'decode': decode}
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    results = json.dumps(run(args), indent=4)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Latency and throughput of the matching engine on preloaded books.
+
+Books of resting orders (made by `market.factories.Order`) are preloaded
+for each size and each scenario, then the scenario's operations are
+timed one by one:
+
+- `create`: a new order not crossing the book (saved and put into it),
+- `cancel`: canceling a resting order,
+- `fill`: an order partly filling the best resting order,
+- `sweep`: an order sweeping several price levels,
+- `market`: a MARKET order filling about one resting order.
+
+Run from the project directory, e.g. `PYTHONPATH=. benchmarks/engine.py`.
+"""
+
+import argparse
+import json
+import random
+import time
+
+from market.book import RestingOrder
+from market import engine, factories, persistence
+
+
+arg_parser = argparse.ArgumentParser(description=__doc__)
+arg_parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated numbers of resting orders, '
+                             'default 1000,10000,100000.')
+arg_parser.add_argument('--operations', type=int, default=1000,
+                        help='Timed operations per scenario, default 1000 '
+                             '(at most a tenth of the book size).')
+arg_parser.add_argument('--levels', type=int, default=100,
+                        help='Price levels per side, default 100.')
+arg_parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random orders, default 0.')
+arg_parser.add_argument('--output', help='Write the results (JSON) here.')
+
+#: Ordered quantities of the resting orders.
+QUANTITY = (1, 100)
+
+
+def resting(side, levels):
+    """Saves a new resting order, bids under asks."""
+
+    buy = side == 'buy'
+    return factories.Order(
+        side=side,
+        price=random.randint(1, levels) + (0 if buy else levels),
+        quantity=random.randint(*QUANTITY))
+
+
+def preload(count, levels):
+    """Fills the book with resting orders.
+
+    :returns: The resting orders.
+    """
+
+    engine.books.clear()
+    orders = [resting('buy' if i % 2 == 0 else 'sell', levels)
+              for i in range(count)]
+    persistence.writer.flush()
+    return orders
+
+
+def asks():
+    """Number of the resting sell orders."""
+
+    return sum(len(level.orders) for level in engine.book.asks)
+
+
+def incoming(side, price, quantity):
+    order = RestingOrder(None, 'WOOD', 0, None, side, price, quantity)
+    persistence.save_order(order)
+    return engine.match(order)
+
+
+def create(orders, levels):
+    buy = random.random() < 0.5
+    incoming('buy' if buy else 'sell',
+             random.randint(1, levels) + (0 if buy else levels),
+             random.randint(*QUANTITY))
+
+
+def cancel(orders, levels):
+    order = orders.pop(random.randrange(len(orders)))
+    if order.active:
+        engine.cancel(order)
+
+
+def fill(orders, levels):
+    best = engine.book.best_ask()
+    incoming('buy', best.price, max(best.quantity // 2, 1))
+
+
+def sweep(orders, levels):
+    # through three price levels
+    quantity = sum(level.quantity
+                   for level, i in zip(engine.book.asks, range(3)))
+    incoming('buy', 2 * levels, quantity)
+
+
+def market(orders, levels):
+    incoming('market_buy', None, random.randint(*QUANTITY))
+
+
+SCENARIOS = [create, cancel, fill, sweep, market]
+
+
+def percentile(timings, share):
+    """The value under which the `share` of (sorted) timings is."""
+
+    return timings[min(int(len(timings) * share), len(timings) - 1)]
+
+
+def measure(scenario, count, operations, levels):
+    """Times the operations of a scenario on a new book.
+
+    :returns: Statistics in microseconds, throughput per second.
+    """
+
+    orders = preload(count, levels)
+    depth = asks()
+    timings = []
+    for operation in range(operations):
+        start = time.perf_counter_ns()
+        scenario(orders, levels)
+        timings.append(time.perf_counter_ns() - start)
+        # the book keeps its depth (not timed)
+        for i in range(depth - asks()):
+            resting('sell', levels)
+    persistence.writer.flush()
+
+    timings.sort()
+    us = lambda ns: round(ns / 1000, 1)
+    return {
+        'operations': operations,
+        'throughput': round(operations * 10 ** 9 / sum(timings)),
+        'mean_us': us(sum(timings) / operations),
+        'p50_us': us(percentile(timings, 0.5)),
+        'p99_us': us(percentile(timings, 0.99)),
+        'max_us': us(timings[-1]),
+    }
+
+
+def run(args):
+    random.seed(args.seed)
+    results = {'levels': args.levels, 'sizes': {}}
+    for count in map(int, args.sizes.split(',')):
+        operations = min(args.operations, count // 10)
+        results['sizes'][count] = {
+            scenario.__name__: measure(scenario, count, operations,
+                                       args.levels)
+            for scenario in SCENARIOS
+        }
+    return results
+
+
+if __name__ == '__main__':
+    from market.models import create_db
+    create_db()
+
+    args = arg_parser.parse_args()
+    results = json.dumps(run(args), indent=4)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""Load generator: many participants and watchers against a running
+server (`server.py`), reporting throughput and latency percentiles.
+
+Each participant sends orders at random (exponential) intervals:
+limit orders with normally distributed prices, a share of MARKET orders
+and cancels of its own open orders. Measured latencies:
+
+- `new`: from sending `createOrder` to its `NEW` report,
+- `fill`: from sending an order to the `FILL` reports of its immediately
+  matched part (those directly following its `NEW` report, received
+  at once with it),
+- `datastream`: from the time of a trade (the server's clock, so run it
+  on the same host) to receiving its `trade` message by a watcher.
+
+Run from the project directory, e.g.
+`PYTHONPATH=. benchmarks/load.py --participants 200 --watchers 200`.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+
+arg_parser = argparse.ArgumentParser(description=__doc__)
+arg_parser.add_argument('--host', default='localhost',
+                        help='Server host, default localhost.')
+arg_parser.add_argument('--port', type=int, default=7001,
+                        help='Participants port, default 7001.')
+arg_parser.add_argument('--port-datastream', type=int, default=7002,
+                        help='Datastream port, default 7002.')
+arg_parser.add_argument('--participants', type=int, default=100,
+                        help='Participant connections, default 100.')
+arg_parser.add_argument('--watchers', type=int, default=100,
+                        help='Watcher connections, default 100.')
+arg_parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of sending orders, default 10.')
+arg_parser.add_argument('--rate', type=float, default=10,
+                        help='Messages per second of each participant, '
+                             'default 10.')
+arg_parser.add_argument('--symbols', default='WOOD',
+                        help='Comma separated symbols, default WOOD.')
+arg_parser.add_argument('--price', type=float, default=100,
+                        help='Mean price (whole numbers are sent), '
+                             'default 100.')
+arg_parser.add_argument('--price-stddev', type=float, default=2,
+                        help='Standard deviation of prices, default 2.')
+arg_parser.add_argument('--quantity', type=int, default=100,
+                        help='Max. ordered quantity, default 100.')
+arg_parser.add_argument('--cancel-ratio', type=float, default=0.2,
+                        help='Share of cancels (of own open orders), '
+                             'default 0.2.')
+arg_parser.add_argument('--market-share', type=float, default=0.05,
+                        help='Share of MARKET orders, default 0.05.')
+arg_parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random order flow, default 0.')
+arg_parser.add_argument('--output', help='Write the results (JSON) here.')
+
+
+class Stats:
+    """Counters and latencies (in seconds) of the whole run."""
+
+    def __init__(self):
+        self.counts = dict.fromkeys(
+            ['sent', 'new', 'canceled', 'fill', 'error', 'datastream',
+             'lost'], 0)
+        self.latencies = {'new': [], 'fill': [], 'datastream': []}
+
+    def latency(self, kind, seconds):
+        self.latencies[kind].append(seconds)
+
+
+def percentiles(latencies):
+    """Latency percentiles in milliseconds."""
+
+    if not latencies:
+        return {'count': 0}
+    latencies = sorted(latencies)
+    at = lambda share: latencies[min(int(len(latencies) * share),
+                                     len(latencies) - 1)]
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'count': len(latencies),
+        'p50_ms': ms(at(0.5)),
+        'p99_ms': ms(at(0.99)),
+        'p99.9_ms': ms(at(0.999)),
+        'max_ms': ms(latencies[-1]),
+    }
+
+
+class Participant:
+    """A participant connection sending random order flow."""
+
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.symbols = args.symbols.split(',')
+        self.codes = itertools.count(1)
+
+        self.sent = {}
+        """Sent orders (mapping (symbol, orderId) -> (time, quantity))."""
+
+        self.open = {}
+        """Open orders (mapping (symbol, orderId) -> remaining quantity)."""
+
+        # the order whose NEW report was the last message received
+        # (in the same read)
+        self.last_new = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.args.host, self.args.port)
+
+    def _send(self, message):
+        self.writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.stats.counts['sent'] += 1
+
+    def _order(self):
+        args = self.args
+        symbol = random.choice(self.symbols)
+        code = next(self.codes)
+        side = random.choice(['BUY', 'SELL'])
+        message = {
+            'message': 'createOrder',
+            'symbol': symbol,
+            'orderId': code,
+            'quantity': random.randint(1, args.quantity),
+        }
+        if random.random() < args.market_share:
+            message['side'] = 'MARKET_' + side
+        else:
+            message['side'] = side
+            message['price'] = max(
+                1, round(random.gauss(args.price, args.price_stddev)))
+        self.sent[symbol, code] = time.monotonic(), message['quantity']
+        self._send(message)
+
+    def _cancel(self):
+        symbol, code = random.choice(list(self.open))
+        self._send({
+            'message': 'cancelOrder',
+            'symbol': symbol,
+            'orderId': code,
+        })
+
+    async def send(self, until):
+        """Sends the order flow until the (monotonic) time
+        (or until the connection is lost)."""
+
+        while time.monotonic() < until:
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            if self.open and random.random() < self.args.cancel_ratio:
+                self._cancel()
+            else:
+                self._order()
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.stats.counts['lost'] += 1
+                return
+
+    async def receive(self):
+        """Handles the reports until the connection is closed."""
+
+        rest = b''
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic()
+            *lines, rest = (rest + data).split(b'\n')
+            # the replies to one message are written at once
+            self.last_new = None
+            for line in lines:
+                self._report(json.loads(line.decode('utf-8')), now)
+
+    def _report(self, message, now):
+        counts = self.stats.counts
+        if 'error' in message:
+            counts['error'] += 1
+            self.last_new = None
+            return
+
+        key = message.get('symbol'), message['orderId']
+        report = message['report']
+        if report == 'NEW':
+            counts['new'] += 1
+            sent, self.open[key] = self.sent[key]
+            self.stats.latency('new', now - sent)
+            self.last_new = key
+            return
+
+        if report == 'FILL':
+            counts['fill'] += 1
+            if key in self.open:
+                self.open[key] -= message['quantity']
+                if not self.open[key] > 0:
+                    del self.open[key]
+            if key == self.last_new:
+                self.stats.latency('fill', now - self.sent[key][0])
+                # all its immediate fills follow in a row
+                return
+        elif report == 'CANCELED':
+            counts['canceled'] += 1
+            self.open.pop(key, None)
+        self.last_new = None
+
+    def close(self):
+        self.writer.close()
+
+
+async def watch(args, stats, connected):
+    """A watcher connection, counts the messages and trade delays."""
+
+    reader, writer = await asyncio.open_connection(args.host,
+                                                   args.port_datastream)
+    connected.set_result(writer)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        received = time.time()
+        message = json.loads(line.decode('utf-8'))
+        stats.counts['datastream'] += 1
+        if message['type'] == 'trade':
+            stats.latency('datastream', received - message['time'])
+
+
+async def run(args):
+    random.seed(args.seed)
+    loop = asyncio.get_event_loop()
+    stats = Stats()
+
+    watchers = [loop.create_future() for i in range(args.watchers)]
+    watching = [asyncio.ensure_future(watch(args, stats, connected))
+                for connected in watchers]
+    await asyncio.gather(*watchers)
+
+    participants = [Participant(args, stats)
+                    for i in range(args.participants)]
+    await asyncio.gather(*[p.connect() for p in participants])
+    receiving = [asyncio.ensure_future(p.receive()) for p in participants]
+
+    started = time.monotonic()
+    await asyncio.gather(*[p.send(started + args.duration)
+                           for p in participants])
+    elapsed = time.monotonic() - started
+    # the last replies
+    await asyncio.sleep(1)
+
+    for participant in participants:
+        participant.close()
+    for writer in watchers:
+        writer.result().close()
+    for task in receiving + watching:
+        task.cancel()
+
+    counts = stats.counts
+    return {
+        'participants': args.participants,
+        'watchers': args.watchers,
+        'duration': round(elapsed, 3),
+        'counts': counts,
+        'throughput': {
+            kind: round(counts[kind] / elapsed)
+            for kind in ['sent', 'new', 'fill', 'datastream']
+        },
+        'latency': {kind: percentiles(latencies)
+                    for kind, latencies in stats.latencies.items()},
+    }
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    loop = asyncio.get_event_loop()
+    results = json.dumps(loop.run_until_complete(run(args)), indent=4)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Memory taken by resting orders: bytes per order of a deep book
+(compact `book.RestingOrder`s) compared with ORM `models.Order`s.
+
+Run from the project directory, e.g. `PYTHONPATH=. benchmarks/memory.py`.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import gc
+import json
+import random
+import tracemalloc
+
+from market.book import Registry, RestingOrder
+from market import models
+
+
+arg_parser = argparse.ArgumentParser(description=__doc__)
+arg_parser.add_argument('--orders', type=int, default=1000000,
+                        help='Resting orders in the book, default 1M.')
+arg_parser.add_argument('--orm-orders', type=int, default=10000,
+                        help='ORM orders measured for comparison, '
+                             'default 10k.')
+arg_parser.add_argument('--levels', type=int, default=1000,
+                        help='Price levels per side, default 1000.')
+arg_parser.add_argument('--output', help='Write the results (JSON) here.')
+
+
+def measure(build, count):
+    """Bytes allocated by `build(count)` (and kept), per item."""
+
+    gc.collect()
+    tracemalloc.start()
+    kept = build(count)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / count
+
+
+def orders(cls, count, levels):
+    now = datetime.now()
+    for i in range(count):
+        buy = i % 2 == 0
+        yield cls(id=i + 1,
+                  symbol='WOOD',
+                  code=i,
+                  participant_id=random.randint(1, 1000),
+                  side='buy' if buy else 'sell',
+                  price=random.randint(1, levels) + (0 if buy else levels),
+                  quantity=random.randint(1, 1000),
+                  registered_at=now + timedelta(microseconds=i))
+
+
+def book(count, levels):
+    books = Registry()
+    for order in orders(RestingOrder, count, levels):
+        books[order.symbol].add(order)
+    return books
+
+
+def run(args):
+    return {
+        'orders': args.orders,
+        'levels': args.levels,
+        'book_bytes_per_order':
+            measure(lambda n: book(n, args.levels), args.orders),
+        'resting_order_bytes':
+            measure(lambda n: list(orders(RestingOrder, n, args.levels)),
+                    args.orders),
+        'orm_order_bytes':
+            measure(lambda n: list(orders(models.Order, n, args.levels)),
+                    args.orm_orders),
+    }
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    results = json.dumps(run(args), indent=4)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
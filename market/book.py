@@ -0,0 +1,357 @@
+import bisect
+
+
+class RestingOrder:
+    """Compact order kept in the books, the ORM (`models.Order`) is only
+    written to. A slotted instance costs a fraction of an ORM one
+    (no `__dict__`, no instance state, no relationships).
+    It has the same attributes the engine uses on `models.Order`.
+    """
+
+    __slots__ = ['id', 'symbol', 'code', 'participant_id', 'side', 'price',
+                 'quantity', 'registered_at', 'active', 'filled']
+
+    def __init__(self, id, symbol, code, participant_id, side, price,
+                 quantity, registered_at=None, active=True, filled=0):
+        self.id = id
+        self.symbol = symbol
+        self.code = code
+        self.participant_id = participant_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        """The remaining (open) quantity."""
+        self.registered_at = registered_at
+        self.active = active
+        self.filled = filled
+        """The quantity filled so far."""
+
+    def __repr__(self):
+        return '<RestingOrder %s/%s/%d pcs>' % (self.side, self.price,
+                                               self.quantity)
+
+
+class PriceLevel:
+    """Orders resting at one price, kept in time priority (FIFO)."""
+
+    __slots__ = ['price', 'orders', 'quantity']
+
+    def __init__(self, price):
+        self.price = price
+        """Price shared by all the orders of this level."""
+
+        self.orders = {}
+        """Orders of this level (keys), the oldest one first."""
+
+        self.quantity = 0
+        """Total quantity of the orders of this level."""
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    def first(self):
+        """The oldest order of this level, or `None` if it's empty."""
+
+        for order in self.orders:
+            return order
+        return None
+
+    def add(self, order):
+        """Adds an order to the end of the queue."""
+
+        self.orders[order] = None
+        self.quantity += order.quantity
+
+    def remove(self, order):
+        del self.orders[order]
+        self.quantity -= order.quantity
+
+    def reduce(self, order, quantity):
+        """Reduces the quantity of an order in place (keeping its place)."""
+
+        order.quantity -= quantity
+        self.quantity -= quantity
+
+
+class BookSide:
+    """One side of the order book (bids or asks) organized in price levels.
+
+    The best level is always at one end of a sorted list of prices,
+    so it's found in O(1).
+    """
+
+    def __init__(self, name, descending):
+        self.name = name
+        """Name of the side in datastream messages (`bid` or `ask`)."""
+
+        self.descending = descending
+        """Is a higher price better? (`True` for bids.)"""
+
+        self.levels = {}
+        """Mapping price -> PriceLevel."""
+
+        self.prices = []
+        """Prices of all the non-empty levels, sorted ascending."""
+
+        self.changed = {}
+        """Prices of the levels changed since `OrderBook.pop_changes()`
+        (keys, in the order of the first change)."""
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __iter__(self):
+        """Iterates over the levels, the best one first."""
+
+        prices = reversed(self.prices) if self.descending else self.prices
+        for price in list(prices):
+            yield self.levels[price]
+
+    def best(self):
+        """The best PriceLevel, or `None` if the side is empty."""
+
+        if not self.prices:
+            return None
+        return self.levels[self.prices[-1 if self.descending else 0]]
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = PriceLevel(order.price)
+            bisect.insort(self.prices, order.price)
+        level.add(order)
+        self.changed[order.price] = None
+
+    def reduce(self, order, quantity):
+        self.levels[order.price].reduce(order, quantity)
+        self.changed[order.price] = None
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        level.remove(order)
+        if not level:
+            del self.levels[order.price]
+            del self.prices[bisect.bisect_left(self.prices, order.price)]
+        self.changed[order.price] = None
+
+    def quantity(self, price):
+        """Total quantity at a price (0 if there is no such level)."""
+
+        level = self.levels.get(price)
+        return level.quantity if level else 0
+
+    def clear(self):
+        self.levels.clear()
+        self.changed.clear()
+        del self.prices[:]
+
+
+class OrderBook:
+    """In-memory order book, the source of truth for matching.
+
+    Limit orders are kept in price levels of their side, MARKET orders
+    wait in their own FIFO queues.
+    Orders are only expected to have `side`, `price`, `quantity`,
+    `participant_id` and `code` attributes.
+
+    Total quantities of price levels are maintained as orders come and go,
+    changed levels are collected for the datastream.
+
+    Orders are indexed by their owner (`participant_id`) and `code`.
+    """
+
+    def __init__(self, symbol=None, changed=None, holders=None):
+        self.symbol = symbol
+        """Symbol of the traded instrument."""
+
+        self.changed = changed
+        """Shared mapping where the book marks itself (as a key)
+        when its price levels change (optional)."""
+
+        self.holders = holders
+        """Shared mapping participant_id -> {book -> None} where the book
+        marks itself while it holds orders of a participant (optional)."""
+
+        self.bids = BookSide('bid', descending=True)
+        self.asks = BookSide('ask', descending=False)
+        self.market_buys = PriceLevel(None)
+        self.market_sells = PriceLevel(None)
+
+        self.index = {}
+        """Mapping participant_id -> {code -> order}."""
+
+    def _queue(self, order):
+        return {
+            'buy': self.bids,
+            'sell': self.asks,
+            'market_buy': self.market_buys,
+            'market_sell': self.market_sells,
+        }[order.side]
+
+    def add(self, order):
+        """Adds an order to the book (after the orders of the same price).
+
+        :param order: Order to be added.
+        """
+
+        self._queue(order).add(order)
+        orders = self.index.get(order.participant_id)
+        if orders is None:
+            orders = self.index[order.participant_id] = {}
+            if self.holders is not None:
+                self.holders.setdefault(order.participant_id, {})[self] = None
+        orders[order.code] = order
+        if self.changed is not None:
+            self.changed[self] = None
+
+    def remove(self, order):
+        """Removes an order from the book.
+
+        :raises KeyError: If the order is not in the book.
+        """
+
+        self._queue(order).remove(order)
+        orders = self.index[order.participant_id]
+        del orders[order.code]
+        if not orders:
+            del self.index[order.participant_id]
+            if self.holders is not None:
+                self._release(order.participant_id)
+        if self.changed is not None:
+            self.changed[self] = None
+
+    def _release(self, participant_id):
+        books = self.holders[participant_id]
+        del books[self]
+        if not books:
+            del self.holders[participant_id]
+
+    def reduce(self, order, quantity):
+        """Reduces the quantity of an order of the book in place, keeping
+        its time priority. It's removed when nothing is left.
+
+        :param order: Order of the book (with a mutable `quantity`).
+        :param int quantity: Quantity to be taken off.
+        """
+
+        if quantity < order.quantity:
+            self._queue(order).reduce(order, quantity)
+            if self.changed is not None:
+                self.changed[self] = None
+        else:
+            self.remove(order)
+            order.quantity -= quantity
+
+    def find(self, participant_id, code):
+        """Finds an order by its owner and code.
+
+        :returns: The order, or `None` if there is no such order.
+        """
+
+        orders = self.index.get(participant_id)
+        return orders.get(code) if orders else None
+
+    def orders_of(self, participant_id):
+        """Returns a list of all the orders of a participant."""
+
+        return list(self.index.get(participant_id, {}).values())
+
+    def best_bid(self):
+        """The oldest of the highest priced buy orders (or `None`)."""
+
+        level = self.bids.best()
+        return level.first() if level else None
+
+    def best_ask(self):
+        """The oldest of the lowest priced sell orders (or `None`)."""
+
+        level = self.asks.best()
+        return level.first() if level else None
+
+    def pop_changes(self):
+        """Returns the price levels changed since the last call
+        (and forgets them).
+
+        :returns: List of (side name, price, total quantity).
+        """
+
+        changes = []
+        for side in [self.bids, self.asks]:
+            changes.extend((side.name, price, side.quantity(price))
+                           for price in side.changed)
+            side.changed.clear()
+        return changes
+
+    def clear(self):
+        """Removes all the orders."""
+
+        self.bids.clear()
+        self.asks.clear()
+        for queue in [self.market_buys, self.market_sells]:
+            queue.orders.clear()
+            queue.quantity = 0
+        if self.holders is not None:
+            for participant_id in self.index:
+                self._release(participant_id)
+        self.index.clear()
+
+
+class Registry(dict):
+    """Independent order books of all the symbols (mapping symbol ->
+    OrderBook), created on demand.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.changed = {}
+        """Books with changed price levels (keys)."""
+
+        self.holders = {}
+        """Mapping participant_id -> {book -> None} of the books
+        holding orders of the participant."""
+
+    def __missing__(self, symbol):
+        book = self[symbol] = OrderBook(symbol, self.changed, self.holders)
+        return book
+
+    def find(self, symbol, participant_id, code):
+        """Finds an order by its symbol, owner and code
+        (without creating a book).
+
+        :returns: The order, or `None` if there is no such order.
+        """
+
+        book = self.get(symbol)
+        return book.find(participant_id, code) if book else None
+
+    def orders_of(self, participant_id):
+        """Returns a list of all the orders of a participant
+        (only the books holding some are visited)."""
+
+        return [order for book in self.holders.get(participant_id, {})
+                for order in book.orders_of(participant_id)]
+
+    def pop_changes(self):
+        """Returns the price levels changed since the last call
+        (and forgets them), only the changed books are visited.
+
+        :returns: List of (symbol, side name, price, total quantity).
+        """
+
+        changes = []
+        for book in self.changed:
+            changes.extend((book.symbol,) + change
+                           for change in book.pop_changes())
+        self.changed.clear()
+        return changes
+
+    def clear(self):
+        """Removes all the orders from all the books."""
+
+        for book in self.values():
+            book.clear()
+        self.changed.clear()
+        self.holders.clear()
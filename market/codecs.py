@@ -0,0 +1,167 @@
+"""Codecs of the messages of the participants and the watchers.
+
+A codec splits received data into messages (`split()`), decodes them
+(`decode()`) and encodes the messages for the peer (`encode()`);
+clients read the messages of the server by `read()`. Protocols take
+theirs from `CODECS`: participants negotiate one (see
+`server.ParticipantProtocol`), watchers get `JSON`.
+
+The same few shapes of messages (execution reports, level updates,
+trades, errors) are encoded most of the time, `JsonCodec` encodes them
+by precompiled templates instead of walking a generic dict (any other
+message falls back to `simplejson`, the bytes are the same).
+"""
+
+from decimal import Decimal
+
+import simplejson as json
+
+from . import wire
+
+
+# symbols are few, their JSON is cached
+_strings = {}
+
+
+def _string(value):
+    encoded = _strings.get(value)
+    if encoded is None:
+        encoded = _strings[value] = json.dumps(value)
+    return encoded
+
+
+_numbers = {int: int.__repr__, float: float.__repr__, Decimal: Decimal.__str__}
+
+
+def _number(value):
+    encode = _numbers.get(type(value))
+    return encode(value) if encode else json.dumps(value)
+
+
+def _new_report(msg):
+    return ('{"message": "executionReport", "symbol": %s, "orderId": %s, '
+            '"report": "%s", "seqId": %d}\n'
+            % (_string(msg['symbol']), _number(msg['orderId']),
+               msg['report'], msg['seqId'])).encode('utf-8')
+
+
+def _fill_report(msg):
+    return ('{"message": "executionReport", "symbol": %s, "orderId": %s, '
+            '"report": "FILL", "price": %s, "quantity": %s, "seqId": %d}\n'
+            % (_string(msg['symbol']), _number(msg['orderId']),
+               _number(msg['price']), _number(msg['quantity']),
+               msg['seqId'])).encode('utf-8')
+
+
+def _orderbook(msg):
+    return ('{"type": "orderbook", "symbol": %s, "side": "%s", '
+            '"price": %s, "quantity": %s, "seqId": %d}\n'
+            % (_string(msg['symbol']), msg['side'], _number(msg['price']),
+               _number(msg['quantity']), msg['seqId'])).encode('utf-8')
+
+
+def _trade(msg):
+    return ('{"type": "trade", "symbol": %s, "time": %s, "price": %s, '
+            '"quantity": %s, "seqId": %d}\n'
+            % (_string(msg['symbol']), _number(msg['time']),
+               _number(msg['price']), _number(msg['quantity']),
+               msg['seqId'])).encode('utf-8')
+
+
+def _error(msg):
+    return ('{"error": %s, "seqId": %d}\n'
+            % (json.dumps(msg['error']), msg['seqId'])).encode('utf-8')
+
+
+class JsonCodec:
+    """JSON lines (UTF-8)."""
+
+    name = 'json'
+
+    #: Encoders of the known shapes (mapping (keys of the message,
+    #: its `report` or `type`) -> function).
+    encoders = {
+        (('message', 'symbol', 'orderId', 'report', 'seqId'), 'NEW'):
+            _new_report,
+        (('message', 'symbol', 'orderId', 'report', 'seqId'), 'CANCELED'):
+            _new_report,
+        (('message', 'symbol', 'orderId', 'report', 'price', 'quantity',
+          'seqId'), 'FILL'): _fill_report,
+        (('type', 'symbol', 'side', 'price', 'quantity', 'seqId'),
+         'orderbook'): _orderbook,
+        (('type', 'symbol', 'time', 'price', 'quantity', 'seqId'),
+         'trade'): _trade,
+        (('error', 'seqId'), None): _error,
+    }
+
+    def split(self, data):
+        """Splits received data into lines.
+
+        :param bytes data: Received data.
+        :returns: (list of complete lines, the incomplete rest).
+        """
+
+        lines = data.split(b'\n')
+        return lines, lines.pop()
+
+    def decode(self, line):
+        """Decodes a line.
+
+        :rtype: dict (or whatever JSON the line is)
+        :raises ValueError: If it's not JSON.
+        """
+
+        return json.loads(line.decode('utf-8'))
+
+    def encode(self, msg):
+        """Encodes a message as a line.
+
+        :param dict msg: The message.
+        :rtype: bytes
+        """
+
+        shape = tuple(msg), msg.get('report', msg.get('type'))
+        try:
+            encoder = self.encoders.get(shape)
+        except TypeError:
+            # an unhashable report or type
+            encoder = None
+        if encoder is None:
+            return json.dumps(msg).encode('utf-8') + b'\n'
+        return encoder(msg)
+
+    def read(self, data):
+        """Splits and decodes data received from the server
+        (for clients).
+
+        :returns: (list of messages, the incomplete rest).
+        """
+
+        lines, rest = self.split(data)
+        return [self.decode(line) for line in lines if line.strip()], rest
+
+
+class BinaryCodec:
+    """The binary protocol of participants (see `wire`)."""
+
+    name = 'binary'
+
+    def split(self, data):
+        return wire.split(data)
+
+    def decode(self, data):
+        return wire.decode(data)
+
+    def encode(self, msg):
+        return wire.encode(msg)
+
+    def read(self, data):
+        return wire.read(data)
+
+
+JSON = JsonCodec()
+
+BINARY = BinaryCodec()
+
+#: Codecs by their names.
+CODECS = {codec.name: codec for codec in [JSON, BINARY]}
@@ -1,14 +1,26 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import StaticPool
 
 from . import settings
 
 
-db_engine = create_engine(settings.DB_URL)
+#: Is the DB private to the process (in-memory SQLite)?
+in_memory = settings.DB_URL in ['sqlite://', 'sqlite:///:memory:']
+
+if in_memory:
+    # one in-memory DB shared by all the threads
+    db_engine = create_engine(settings.DB_URL,
+                              connect_args={'check_same_thread': False},
+                              poolclass=StaticPool)
+else:
+    db_engine = create_engine(settings.DB_URL)
+
 db_session = scoped_session(
     sessionmaker(autocommit=False,
                  autoflush=False,
+                 expire_on_commit=False,
                  bind=db_engine),
 )
 
@@ -1,89 +1,234 @@
 from datetime import datetime
+import logging
 
-from .database import db_session
-from .models import Order
+from .book import Registry, RestingOrder
+from .journal import ACCEPTED, CANCELED, journal, order_values
+from .models import Execution, Order, Participant
+from . import persistence
+from . import settings
+from . import snapshot
 
 
-def _market_buy():
-    """Try to find a MARKET buy trade.
+logger = logging.getLogger(__name__)
 
-    :returns: (buy, sell, price) or `False`
+
+#: Order books of all the symbols, the source of truth for matching.
+books = Registry()
+
+#: The book of `settings.DEFAULT_SYMBOL`.
+book = books[settings.DEFAULT_SYMBOL]
+
+
+def add(order):
+    """Puts an active order into the book of its symbol.
+
+    :param book.RestingOrder order: A new order.
     """
 
-    buy = Order.query.filter_by(side='market_buy', active=True) \
-            .order_by(Order.registered_at) \
-            .first()
-    if buy is None:
-        return False
+    books[order.symbol].add(order)
+
 
-    sell = Order.query.filter_by(side='sell', active=True) \
-            .order_by(Order.price, Order.registered_at) \
-            .first()
-    if sell is None:
-        return False
+def cancel(order):
+    """Deactivates an order and takes it out of the book.
 
-    return buy, sell, sell.price
+    :param book.RestingOrder order: An active order.
+    """
 
+    order.active = False
+    books[order.symbol].remove(order)
+    persistence.deactivate_order(order)
 
-def _market_sell():
-    """Try to find a MARKET sell trade.
 
-    :returns: (buy, sell, price) or `False`
+def cancel_all(participant_id):
+    """Cancels all the orders of a participant (in all the books).
+
+    :param int participant_id: Primary key of the participant.
     """
 
-    sell = Order.query.filter_by(side='market_sell', active=True) \
-            .order_by(Order.registered_at) \
-            .first()
-    if sell is None:
-        return False
+    for order in books.orders_of(participant_id):
+        cancel(order)
 
-    # TODO what price is the best?
-    buy = Order.query.filter_by(side='buy', active=True) \
-            .order_by(Order.price.desc(), Order.registered_at) \
-            .first()
-    if buy is None:
-        return False
 
-    return buy, sell, buy.price
+def load():
+    """Fills the books with the active orders saved in the DB.
 
+    The journal (and the snapshot) of a previous run don't match
+    the DB state, they are moved aside and a new journal is started.
+    """
 
-def _standard_trade():
-    """Try to find a strandard trade.
+    journal.discard()
+    snapshot.discard(settings.SNAPSHOT_PATH)
+    books.clear()
+    columns = [Order.id, Order.symbol, Order.code, Order.participant_id,
+               Order.side, Order.price, Order.remaining_quantity,
+               Order.registered_at, Order.active, Order.filled_quantity]
+    for row in Order.query.with_entities(*columns) \
+                          .filter_by(active=True) \
+                          .order_by(Order.registered_at, Order.id):
+        books[row.symbol].add(RestingOrder(*row))
+    books.pop_changes()
+
+
+def recover():
+    """Fills the books from the last snapshot (if any) and by replaying
+    the journal following it.
+
+    Orders' owners are not known (they are disconnected anyway),
+    only their `participant_id`.
+
+    The DB is not touched: statements lost with the write-behind queue
+    (e.g. in a crash) are not re-applied, so the DB may lag behind
+    the recovered books (the journal is the authoritative record).
+    """
 
-    :returns: (buy, sell, price) or `False`
+    if not journal.path:
+        logger.warning('No journal to recover from')
+
+    books.clear()
+    orders = {}
+    seq = 0
+    last_order, last_participant, last_execution = 0, 0, 0
+
+    loaded = snapshot.load(settings.SNAPSHOT_PATH)
+    if loaded:
+        seq, restored, (last_order, last_participant, last_execution) = \
+            loaded
+        orders = {order.id: order for order in restored}
+        logger.info('Loaded %d orders from the snapshot at seq %d'
+                    % (len(orders), seq))
+
+    for seq, event, values in journal.read(after=seq):
+        if event == ACCEPTED:
+            order = RestingOrder(**order_values(values))
+            orders[order.id] = order
+            last_order = max(last_order, order.id)
+            last_participant = max(last_participant,
+                                   order.participant_id or 0)
+        elif event == CANCELED:
+            orders.pop(values[0]).active = False
+        else:
+            id, buy_id, sell_id, price, quantity, time = values
+            last_execution = max(last_execution, id)
+            for order_id in [buy_id, sell_id]:
+                order = orders[order_id]
+                order.quantity -= quantity
+                order.filled += quantity
+                if not order.quantity:
+                    orders.pop(order_id).active = False
+
+    for order in sorted(orders.values(),
+                        key=lambda order: (order.registered_at, order.id)):
+        books[order.symbol].add(order)
+    books.pop_changes()
+
+    persistence.seed_ids(Order, last_order)
+    persistence.seed_ids(Participant, last_participant)
+    persistence.seed_ids(Execution, last_execution)
+    logger.info('Recovered %d orders up to seq %d'
+                % (len(orders), journal.seq))
+
+
+def start(recovering=False):
+    """Fills the books (see `load()` and `recover()`) and opens
+    the journal, new primary keys follow the ones used so far.
+
+    :param bool recovering: Rebuild the books from the snapshot and
+        the journal (instead of the DB)?
+    :returns: The last primary key of participants (of the DB or
+        the journal), for a process assigning them.
+    :rtype: int
     """
 
-    buy = Order.query.filter_by(side='buy', active=True) \
-            .order_by(Order.price.desc(), Order.registered_at) \
-            .first()
-    if buy is None:
-        return False
+    if recovering:
+        recover()
+    else:
+        load()
+        persistence.seed_ids(Order)
+        persistence.seed_ids(Participant)
+        persistence.seed_ids(Execution)
+    journal.open()
+    return persistence.last_id(Participant)
 
-    sell = Order.query.filter_by(side='sell', active=True) \
-            .filter(Order.price <= buy.price) \
-            .order_by(Order.price, Order.registered_at) \
-            .first()
-    if sell is None:
-        return False
 
-    return buy, sell, buy.price
+def checkpoint():
+    """Starts a checkpoint of the books, see `snapshot.checkpoint()`.
 
+    :returns: A function finishing the checkpoint (or `None`).
+    """
 
-def trade():
-    """Try to make a trade.
+    return snapshot.checkpoint(books, journal, settings.SNAPSHOT_PATH,
+                               (persistence.last_id(Order),
+                                persistence.last_id(Participant),
+                                persistence.last_id(Execution)))
 
-    Order of possible trades:
-        1. MARKET buy
-        2. MARKET sell
-        3. standard trades
 
-    Partly traded Orders are forked, a forked copy contains the remaining
-    quantity.
+def _fill(book, order, quantity):
+    """Fills a resting order (partly) in place, it keeps its time priority.
 
-    :returns: Information about a trade if one was made (`False` otherwise):
+    :param book.OrderBook book: The book of the order.
+    :param book.RestingOrder order: The resting order.
+    :param int quantity: The traded quantity.
+    """
+
+    book.reduce(order, quantity)
+    order.filled += quantity
+    order.active = order.quantity > 0
+    persistence.fill_order(order)
+
+
+def _counterparty(book, order):
+    """Finds the best resting order an incoming order can trade with.
+
+    Resting MARKET orders go first, then the best price level.
+    A standard trade is made for the buying price, a MARKET one
+    for the price of the limit order.
+
+    :param book.OrderBook book: The book of the order's symbol.
+    :param book.RestingOrder order: The incoming order.
+    :returns: (resting Order, price) or `None`
+    """
+
+    if order.side == 'buy':
+        resting = book.market_sells.first()
+        if resting is None:
+            resting = book.best_ask()
+            if resting is None or resting.price > order.price:
+                return None
+        return resting, order.price
+
+    if order.side == 'sell':
+        resting = book.market_buys.first()
+        if resting is not None:
+            return resting, order.price
+        resting = book.best_bid()
+        if resting is None or resting.price < order.price:
+            return None
+        return resting, resting.price
+
+    resting = book.best_ask() if order.side == 'market_buy' \
+              else book.best_bid()
+    if resting is None:
+        return None
+    return resting, resting.price
+
+
+def match(order):
+    """Sweeps an incoming order through the opposite side of the book
+    of its symbol in a single pass, then puts its residual (if any)
+    into the book. Other books are not touched.
+
+    Orders are filled in place (remaining and filled quantities),
+    a partly filled resting order keeps its place in the book.
+    Each trade is saved as an execution by the `persistence` layer.
+
+    :param book.RestingOrder order: An active saved order,
+        not in the book yet.
+    :returns: List of trades, each as:
     .. code-block:: python
 
         {
+            'id': <execution id>,
+            'symbol': <symbol>,
             'price': <price>,
             'quantity': <quantity>,
             'time': now(),
@@ -92,46 +237,38 @@ def trade():
         }
     """
 
-    for search in [_market_buy, _market_sell, _standard_trade]:
-        found = search()
-        if found:
-            buy, sell, price = found
-            break
-    else:
-        return False
-
-    quantity = min(buy.quantity, sell.quantity)
-
-    buy.active = False
-    sell.active = False
-    buy.traded_to = sell
-    sell.traded_to = buy
-    db_session.add_all([buy, sell])
-
-    if buy.quantity < sell.quantity:
-        sell2 = Order(side=sell.side,
-                      code=sell.code,
-                      participant=sell.participant,
-                      price=sell.price,
-                      quantity=sell.quantity - buy.quantity,
-                      registered_at=sell.registered_at)
-        db_session.add(sell2)
-
-    elif sell.quantity < buy.quantity:
-        buy2 = Order(side=buy.side,
-                     code=buy.code,
-                     participant=buy.participant,
-                     price=buy.price,
-                     quantity=buy.quantity - sell.quantity,
-                     registered_at=buy.registered_at)
-        db_session.add(buy2)
-
-    db_session.commit()
-
-    return {
-        'price': price,
-        'quantity': quantity,
-        'time': datetime.now(),
-        'buy': buy,
-        'sell': sell,
-    }
+    book = books[order.symbol]
+    trades = []
+    now = datetime.now()
+
+    found = _counterparty(book, order)
+    while found:
+        resting, price = found
+        quantity = min(order.quantity, resting.quantity)
+
+        _fill(book, resting, quantity)
+        order.quantity -= quantity
+        order.filled += quantity
+
+        buy, sell = (order, resting) if order.side in ['buy', 'market_buy'] \
+                    else (resting, order)
+        trade = {
+            'symbol': order.symbol,
+            'price': price,
+            'quantity': quantity,
+            'time': now,
+            'buy': buy,
+            'sell': sell,
+        }
+        persistence.save_execution(trade)
+        trades.append(trade)
+
+        found = _counterparty(book, order) if order.quantity else None
+
+    if trades:
+        order.active = order.quantity > 0
+        persistence.fill_order(order)
+    if order.quantity:
+        book.add(order)
+
+    return trades
@@ -4,7 +4,8 @@ from factory import lazy_attribute, Sequence
 from factory.alchemy import SQLAlchemyModelFactory
 
 from .database import db_session
-from . import models
+from .book import RestingOrder
+from . import engine, models, persistence, settings
 
 
 lazy = lambda call: lazy_attribute(lambda obj: call())
@@ -18,13 +19,35 @@ class Participant(SQLAlchemyModelFactory):
         model = models.Participant
         sqlalchemy_session = db_session
 
+    @classmethod
+    def _create(cls, model_class, *args, **kwargs):
+        participant = model_class(*args, **kwargs)
+        persistence.save_participant(participant)
+        return participant
+
 
 class Order(SQLAlchemyModelFactory):
     class Meta:
         model = models.Order
         sqlalchemy_session = db_session
 
+    symbol = settings.DEFAULT_SYMBOL
+    participant_id = None
     code = Sequence(lambda n: n)
-    side = lazy_choice(['ask', 'bid'])
+    side = lazy_choice(['buy', 'sell'])
     price = lazy_randint(1, 1000)
     quantity = lazy_randint(1, 1000)
+    active = True
+
+    @classmethod
+    def _create(cls, model_class, *args, **kwargs):
+        """Saves a resting order (the books only hold those)."""
+
+        participant = kwargs.pop('participant', None)
+        if participant is not None:
+            kwargs['participant_id'] = participant.id
+        order = RestingOrder(id=None, **kwargs)
+        persistence.save_order(order)
+        if order.active:
+            engine.add(order)
+        return order
@@ -0,0 +1,495 @@
+"""Gateway processes feeding one matching process through shared memory.
+
+With `settings.GATEWAYS`, the connections are served by several gateway
+processes accepting on the same ports (`SO_REUSEPORT`): the server
+process is gateway 0 (see `Gateways`), the others are spawned
+(`_gateway()`). Gateways decode and check the messages (`server.parse()`)
+and put fixed-size commands (`COMMAND`) into their rings (see `ring`),
+so network and codec work scales across cores.
+
+One matching process (`_core()`) takes the commands of all the gateways
+in rounds, matches them single-threaded and in order (so the market is
+deterministic), persists and journals them like the server process
+would, and puts fixed-size results (`RESULT`) into the ring of each
+gateway: replies into the one of the participant's gateway (participant
+ids are partitioned by gateways, see `persistence.partition_ids()`),
+datastream messages into all of them, each gateway numbers
+and broadcasts them to its watchers alike.
+
+Rings don't notify, a one byte doorbell (a pipe) wakes the peer once
+per batch of records.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+import struct
+import time
+
+from .database import in_memory
+from .journal import SIDES
+from . import latency
+from . import models
+from . import persistence
+from .ring import Ring
+from . import server
+from .server import Command, MarketException
+from . import settings
+from .shards import Worker
+from .ticks import to_price, to_ticks
+from .wire import REPORTS
+
+
+logger = logging.getLogger(__name__)
+
+CREATE, CANCEL, DISCONNECT, LATENCY, STOP = range(1, 6)
+"""Kinds of commands."""
+
+REPORT, ERROR, ORDERBOOK, TRADE, END = range(1, 6)
+"""Kinds of results, `END` ends the results of a round."""
+
+BOOK_SIDES = ['bid', 'ask']
+
+COMMAND = struct.Struct('<BQ16sqBqq')
+"""Command: kind, participant_id, symbol, orderId, side (index in `SIDES`
++ 1), price (ticks, 0 if none), quantity."""
+
+RESULT = struct.Struct('<BQ16sqBqqd64s')
+"""Result: kind, participant_id, symbol, orderId, report (index in
+`REPORTS`) or side (index in `BOOK_SIDES`), price (ticks), quantity,
+time (timestamp of a trade), error (UTF-8, cut at 64 bytes)."""
+
+_END = RESULT.pack(END, 0, b'', 0, 0, 0, 0, 0, b'')
+
+
+def _pack_command(kind, participant_id=0, command=None):
+    """Packs a command.
+
+    :param int kind: Kind of the command.
+    :param int participant_id: Primary key of the participant.
+    :param server.Command command: The checked message (of `CREATE`
+        or `CANCEL`), its integers fit into `COMMAND` (see
+        `server.parse()`).
+    :rtype: bytes
+    :raises MarketException: If the symbol doesn't fit into `COMMAND`.
+    """
+
+    if command is None:
+        return COMMAND.pack(kind, participant_id, b'', 0, 0, 0, 0)
+    symbol = command.symbol.encode('utf-8')
+    if len(symbol) > 16:
+        raise MarketException('Unknown symbol.')
+    side = SIDES.index(command.side) + 1 if command.side else 0
+    return COMMAND.pack(kind, participant_id, symbol, command.code, side,
+                        command.price or 0, command.quantity or 0)
+
+
+def _unpack_command(record):
+    """Unpacks a command.
+
+    :returns: (kind, participant_id, server.Command or `None`)
+    """
+
+    kind, participant_id, symbol, code, side, price, quantity = \
+        COMMAND.unpack(record)
+    if kind not in [CREATE, CANCEL]:
+        return kind, participant_id, None
+    symbol = symbol.rstrip(b'\0').decode('utf-8')
+    if kind == CANCEL:
+        return kind, participant_id, Command('cancelOrder', symbol, code,
+                                             None, None, None)
+    side = SIDES[side - 1]
+    return kind, participant_id, Command(
+        'createOrder', symbol, code, side,
+        price if side in ['buy', 'sell'] else None, quantity)
+
+
+def _pack_reply(participant_id, msg):
+    """Packs a reply to a participant (an execution report or an error).
+
+    :rtype: bytes
+    """
+
+    if 'error' in msg:
+        return RESULT.pack(ERROR, participant_id, b'', 0, 0, 0, 0, 0,
+                           msg['error'].encode('utf-8')[:64])
+    symbol = msg['symbol']
+    price = msg.get('price')
+    return RESULT.pack(REPORT, participant_id, symbol.encode('utf-8'),
+                       msg['orderId'], REPORTS.index(msg['report']),
+                       0 if price is None else to_ticks(symbol, price),
+                       msg.get('quantity', 0), 0, b'')
+
+
+def _pack_datastream(msg):
+    """Packs a datastream message (a level update or a trade).
+
+    :rtype: bytes
+    """
+
+    symbol = msg['symbol']
+    price = to_ticks(symbol, msg['price'])
+    if msg['type'] == 'trade':
+        return RESULT.pack(TRADE, 0, symbol.encode('utf-8'), 0, 0, price,
+                           msg['quantity'], msg['time'], b'')
+    return RESULT.pack(ORDERBOOK, 0, symbol.encode('utf-8'), 0,
+                       BOOK_SIDES.index(msg['side']), price,
+                       msg['quantity'], 0, b'')
+
+
+def _unpack_result(record):
+    """Unpacks a result (but `END`).
+
+    :returns: (kind, participant_id, message)
+    """
+
+    kind, participant_id, symbol, code, index, price, quantity, time_, \
+        error = RESULT.unpack(record)
+    if kind == ERROR:
+        return kind, participant_id, {
+            'error': error.rstrip(b'\0').decode('utf-8', 'ignore')}
+
+    symbol = symbol.rstrip(b'\0').decode('utf-8')
+    if kind == REPORT:
+        msg = {
+            'message': 'executionReport',
+            'symbol': symbol,
+            'orderId': code,
+            'report': REPORTS[index],
+        }
+        if msg['report'] == 'FILL':
+            msg['price'] = to_price(symbol, price)
+            msg['quantity'] = quantity
+    elif kind == TRADE:
+        msg = {
+            'type': 'trade',
+            'symbol': symbol,
+            'time': time_,
+            'price': to_price(symbol, price),
+            'quantity': quantity,
+        }
+    else:
+        msg = {
+            'type': 'orderbook',
+            'symbol': symbol,
+            'side': BOOK_SIDES[index],
+            'price': to_price(symbol, price),
+            'quantity': quantity,
+        }
+    return kind, participant_id, msg
+
+
+def _deliver(results, replies, datastream):
+    """Puts the results of a round into the rings of the gateways.
+
+    :param list results: Rings of results of the gateways.
+    :returns: Indexes of the gateways given some.
+    :rtype: set
+    """
+
+    given = {participant_id % len(results)
+             for participant_id, msg in replies}
+    for participant_id, msg in replies:
+        results[participant_id % len(results)].put(
+            _pack_reply(participant_id, msg))
+    if datastream:
+        records = [_pack_datastream(msg) for msg in datastream]
+        given = set(range(len(results)))
+        for ring in results:
+            for record in records:
+                ring.put(record)
+    for index in given:
+        results[index].put(_END)
+    return given
+
+
+def _core(requests, results, doorbells, wakeups, recover):
+    """Main loop of the matching process.
+
+    :param list requests: Rings of commands of the gateways.
+    :param list results: Rings of results for the gateways.
+    :param list doorbells: Connections rung by the gateways having put
+        commands.
+    :param list wakeups: Connections waking the gateways, the first one
+        is sent the last participant id known by the process first.
+    :param bool recover: Rebuild the books from the snapshot and
+        the journal (instead of the DB)?
+    """
+
+    # stopped by the server process (`STOP`) once the gateways are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if in_memory:
+        models.create_db()
+
+    worker = Worker(recover)
+    # for the ids of new participants
+    wakeups[0].send(worker.last_participant)
+    # the price levels for the snapshots of the gateways
+    worker.pending.append((None, [], server._book_messages()))
+    stopping = False
+    while True:
+        replies, datastream = [], []
+        commands = [record for ring in requests for record in ring.get()]
+        for record in commands:
+            kind, participant_id, command = _unpack_command(record)
+            if kind in [CREATE, CANCEL]:
+                done = server.execute(command, participant_id, changes=False)
+            elif kind == DISCONNECT:
+                done = [], server.disconnect(participant_id)
+            elif kind == LATENCY:
+                latency.dump()
+                continue
+            else:
+                stopping = True
+                continue
+            replies.extend(done[0])
+            datastream.extend(done[1])
+
+        if replies or datastream:
+            datastream.extend(server._orderbook_messages())
+            worker.done(replies, datastream)
+
+        given = set()
+        for replies, datastream in worker.committed():
+            given |= _deliver(results, replies, datastream)
+        for index, ring in enumerate(results):
+            if ring.backlog and ring.retry():
+                given.add(index)
+        for index in given:
+            wakeups[index].send_bytes(b'')
+
+        worker.housekeeping()
+
+        if stopping and not worker.pending:
+            break
+        if not commands:
+            busy = worker.pending or any(ring.backlog for ring in results)
+            for doorbell in wait(doorbells, 0.001 if busy else 0.1):
+                while doorbell.poll():
+                    doorbell.recv_bytes()
+
+    worker.stop()
+    for ring in requests + results:
+        ring.close()
+
+
+def _gateway(index, count, requests, results, doorbell, wakeup, addresses,
+             last_participant):
+    """Main of a spawned gateway process, runs until `SIGINT`.
+
+    :param int index: Index of the gateway.
+    :param int count: Number of the gateways.
+    :param tuple addresses: (host, port, port_datastream, port_conflated)
+    :param int last_participant: The last participant id known by
+        the matching process.
+    """
+
+    # stopped by the server process, even if it ignores Ctrl+C
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if in_memory:
+        models.create_db()
+    persistence.partition_ids(count, index)
+    persistence.seed_ids(models.Participant, last_participant)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    link = Link(index, count, requests, results, doorbell, wakeup)
+    link.start(loop)
+    server.router = link
+    servers = server.listen(loop, *addresses, reuse_port=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    for each in servers:
+        each.close()
+        loop.run_until_complete(each.wait_closed())
+    link.stop()
+    loop.close()
+    persistence.writer.stop()
+
+
+class Link:
+    """A gateway's side of its rings, routes the messages of its
+    participants to the matching process (as `server.router`).
+    """
+
+    def __init__(self, index, count, requests, results, doorbell, wakeup):
+        self.index = index
+        """Index of the gateway."""
+
+        self.count = count
+        """Number of the gateways."""
+
+        self.requests = requests
+        """Ring of the commands."""
+
+        self.results = results
+        """Ring of the results."""
+
+        self.doorbell = doorbell
+        """Connection waking the matching process."""
+
+        self.wakeup = wakeup
+        """Connection rung by the matching process."""
+
+        self.loop = None
+        self.ringing = False
+
+        # results of the round being received
+        self.replies = []
+        self.datastream = []
+
+    def start(self, loop):
+        """Receives the results by the loop.
+
+        :param asyncio.AbstractEventLoop loop: Event loop of the gateway.
+        """
+
+        self.loop = loop
+        loop.add_reader(self.wakeup.fileno(), self._receive)
+
+    def stop(self):
+        self.loop.remove_reader(self.wakeup.fileno())
+        self.requests.close()
+        self.results.close()
+
+    def _put(self, record):
+        self.requests.put(record)
+        if not self.ringing:
+            # once per iteration of the loop
+            self.ringing = True
+            self.loop.call_soon(self._ring)
+
+    def _ring(self):
+        self.ringing = False
+        self.doorbell.send_bytes(b'')
+        if not self.requests.retry():
+            # the matching process is behind
+            self.ringing = True
+            self.loop.call_later(0.001, self._ring)
+
+    def submit(self, symbol, participant_id, message):
+        """Checks a message, routes it to the matching process.
+
+        :param str symbol: Symbol of the message.
+        :param int participant_id: Primary key of the participant.
+        :param dict message: Message of the participant.
+        :raises MarketException: If the message is not valid.
+        """
+
+        command = server.parse(message)
+        kind = CREATE if command.action == 'createOrder' else CANCEL
+        self._put(_pack_command(kind, participant_id, command))
+
+    def disconnect(self, participant_id):
+        """Makes the matching process cancel orders of a participant."""
+
+        self._put(_pack_command(DISCONNECT, participant_id))
+
+    def dump_latency(self):
+        """Makes the matching process log the latency of its stages."""
+
+        self._put(_pack_command(LATENCY))
+
+    def _receive(self):
+        while self.wakeup.poll():
+            self.wakeup.recv_bytes()
+        for record in self.results.get():
+            if record[0] == END:
+                server._dispatch(self.replies, self.datastream)
+                self.replies, self.datastream = [], []
+                continue
+            kind, participant_id, msg = _unpack_result(record)
+            if kind in [REPORT, ERROR]:
+                self.replies.append((participant_id, msg))
+            else:
+                self.datastream.append(msg)
+        server._flush()
+
+
+class Gateways(Link):
+    """Gateway 0 (the server process), starts and stops the matching
+    process and the other gateways.
+    """
+
+    def __init__(self, count):
+        self.rings = [(Ring(COMMAND.size, settings.RING_SLOTS),
+                       Ring(RESULT.size, settings.RING_SLOTS))
+                      for index in range(count)]
+        context = multiprocessing.get_context('spawn')
+        # (receiving, sending) of both directions of each gateway
+        self.doorbells = [context.Pipe(duplex=False) for index in range(count)]
+        self.wakeups = [context.Pipe(duplex=False) for index in range(count)]
+        super().__init__(0, count, *self.rings[0], self.doorbells[0][1],
+                         self.wakeups[0][0])
+
+        self.context = context
+        self.core = None
+        """The matching process."""
+
+        self.gateways = []
+        """The other gateway processes."""
+
+    def start(self, loop, recover=False, addresses=None):
+        """Starts the processes, results are handled by the loop.
+
+        :param asyncio.AbstractEventLoop loop: Event loop of the server.
+        :param bool recover: Should the matching process recover
+            the books?
+        :param tuple addresses: (host, port, port_datastream,
+            port_conflated) the other gateways listen on (no other
+            gateways if `None`).
+        """
+
+        persistence.partition_ids(self.count, 0)
+        self.core = self.context.Process(
+            target=_core, name='matching', daemon=True,
+            args=([requests for requests, results in self.rings],
+                  [results for requests, results in self.rings],
+                  [receiving for receiving, sending in self.doorbells],
+                  [sending for receiving, sending in self.wakeups],
+                  recover))
+        self.core.start()
+        # new participants follow the ones the matching process knows of,
+        # even if recovered (the DB may lag behind)
+        last = self.wakeup.recv()
+        persistence.seed_ids(models.Participant, last)
+        for index in range(1, self.count if addresses else 1):
+            process = self.context.Process(
+                target=_gateway, name='gateway-%d' % index, daemon=True,
+                args=(index, self.count) + self.rings[index]
+                + (self.doorbells[index][1], self.wakeups[index][0],
+                   addresses, last))
+            process.start()
+            self.gateways.append(process)
+        super().start(loop)
+        logger.info('Started the matching process and %d gateways'
+                    % self.count)
+
+    def stop(self):
+        """Stops the gateways, then the matching process (after
+        processing all the commands)."""
+
+        for process in self.gateways:
+            try:
+                os.kill(process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for process in self.gateways:
+            process.join()
+
+        self.requests.put(_pack_command(STOP))
+        while not self.requests.retry():
+            time.sleep(0.001)
+        self.doorbell.send_bytes(b'')
+        self.core.join()
+
+        self.loop.remove_reader(self.wakeup.fileno())
+        for requests, results in self.rings:
+            requests.close(unlink=True)
+            results.close(unlink=True)
@@ -0,0 +1,278 @@
+"""Append-only binary event journal.
+
+Every change of the book is appended as a sequence-numbered record,
+so the book can be rebuilt after a restart by streaming the journal
+(see `engine.recover()`).
+
+The file starts with `MAGIC` (identifying the format version),
+record layout (little endian): header `seq (Q), event (B)`,
+a fixed-width payload according to the event, CRC32 of both (I).
+A torn record at the end (e.g. after a crash) is ignored and cut off.
+
+The journal can be rotated at a checkpoint (see `snapshot`), the previous
+file is kept until the checkpoint is done and is read first.
+"""
+
+from datetime import datetime
+import logging
+import os
+import struct
+import zlib
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED = 1
+"""A new order was put into the market."""
+
+CANCELED = 2
+"""An order was canceled."""
+
+EXECUTED = 3
+"""A trade was made, both its orders were (partly) filled."""
+
+SIDES = ['buy', 'sell', 'market_buy', 'market_sell']
+
+MAGIC = b'WOODJNL4'
+"""File header, a file of another format version is refused."""
+
+PREVIOUS = '.prev'
+"""Suffix of the previous file, see `Journal.rotate()`."""
+
+OLD = '.old'
+"""Suffix of the files of a previous run, see `Journal.discard()`."""
+
+ORDER = struct.Struct('<Q16sqqBqqqd')
+"""Order record: id, symbol, code, participant_id, side, price (ticks,
+0 if none), remaining quantity, filled quantity, registered_at (timestamp).
+"""
+
+_header = struct.Struct('<QB')
+_crc = struct.Struct('<I')
+_payloads = {
+    ACCEPTED: ORDER,
+    # id
+    CANCELED: struct.Struct('<Q'),
+    # id, buy order id, sell order id, price, quantity, time (timestamp)
+    EXECUTED: struct.Struct('<QQQqqd'),
+}
+
+
+class Journal:
+    """Journal file, appended to by the market."""
+
+    def __init__(self, path):
+        self.path = path
+        """Path of the file, `None` disables journaling."""
+
+        self.seq = 0
+        """Sequence number of the last record."""
+
+        self.offset = None
+        """Size of the valid part of the file (`None` if not read yet)."""
+
+        self.file = None
+
+    def read(self, after=0):
+        """Streams the records, those of the previous file first
+        (see `rotate()`).
+
+        :param int after: Skip the records up to this sequence number
+            (e.g. covered by a snapshot).
+        :returns: Generator of (seq, event, tuple of values).
+        """
+
+        self.seq = after
+        if not self.path:
+            return
+
+        for path in [self.path + PREVIOUS, self.path]:
+            self.offset = 0
+            if os.path.exists(path):
+                yield from self._read_file(path, after)
+
+    def _read_file(self, path, after):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if len(magic) < len(MAGIC) and MAGIC.startswith(magic):
+                # torn header of a new file
+                return
+            if magic != MAGIC:
+                raise ValueError('%s is not a journal of this version'
+                                 % path)
+            self.offset = f.tell()
+
+            while True:
+                header = f.read(_header.size)
+                if len(header) < _header.size:
+                    break
+                seq, event = _header.unpack(header)
+                payload = _payloads.get(event)
+                if payload is None:
+                    break
+                data = f.read(payload.size)
+                crc = f.read(_crc.size)
+                if len(crc) < _crc.size or \
+                        _crc.unpack(crc)[0] != zlib.crc32(header + data):
+                    break
+
+                self.offset = f.tell()
+                if seq > after:
+                    self.seq = seq
+                    yield seq, event, payload.unpack(data)
+
+        if self.offset < os.path.getsize(path):
+            logger.warning('Ignoring a torn journal record at %s:%d'
+                           % (path, self.offset))
+
+    def open(self):
+        """Opens the file for appending, cuts off a torn record if any.
+
+        :raises ValueError: If the file is of another format version.
+        """
+
+        if not self.path:
+            return
+        if self.offset is None:
+            for record in self.read():
+                pass
+
+        self.file = open(self.path, 'ab')
+        self.file.truncate(self.offset)
+        if not self.offset:
+            self.file.write(MAGIC)
+            self.offset = len(MAGIC)
+        logger.info('Journal %s opened at seq %d' % (self.path, self.seq))
+
+    def rotate(self):
+        """Continues in a new file, the current one becomes the previous
+        one (until `drop_previous()`).
+
+        :returns: `False` if not rotated as the previous file still exists.
+        """
+
+        if self.file is None or os.path.exists(self.path + PREVIOUS):
+            return False
+
+        self.close()
+        os.replace(self.path, self.path + PREVIOUS)
+        self.offset = 0
+        self.open()
+        return True
+
+    def discard(self):
+        """Starts a new journal (not opened yet), the files of a previous
+        run are kept aside with the `OLD` suffix (replacing older ones).
+        """
+
+        if not self.path:
+            return
+        for path in [self.path, self.path + PREVIOUS]:
+            if os.path.exists(path):
+                logger.warning('Moving aside the journal %s' % path)
+                os.replace(path, path + OLD)
+        self.seq = 0
+        self.offset = 0
+
+    def drop_previous(self):
+        """Removes the previous file (if any)."""
+
+        if self.path and os.path.exists(self.path + PREVIOUS):
+            os.remove(self.path + PREVIOUS)
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def flush(self):
+        """Hands the appended records over to the OS
+        (and to the disk if `settings.JOURNAL_FSYNC`).
+        """
+
+        if self.file is not None:
+            self.file.flush()
+            if settings.JOURNAL_FSYNC:
+                os.fsync(self.file.fileno())
+
+    def _append(self, event, *values):
+        if self.file is None:
+            return
+        # a record failing to pack doesn't take a seq
+        payload = _payloads[event].pack(*values)
+        self.seq += 1
+        data = _header.pack(self.seq, event) + payload
+        self.file.write(data + _crc.pack(zlib.crc32(data)))
+
+    def accepted(self, order):
+        """Appends an ACCEPTED record.
+
+        :param book.RestingOrder order: A saved order.
+        """
+
+        self._append(ACCEPTED, *record_values(order))
+
+    def canceled(self, order):
+        """Appends a CANCELED record.
+
+        :param book.RestingOrder order: A saved order.
+        """
+
+        self._append(CANCELED, order.id)
+
+    def executed(self, trade):
+        """Appends an EXECUTED record.
+
+        :param dict trade: A saved trade (see `engine.match()`).
+        """
+
+        self._append(EXECUTED, trade['id'], trade['buy'].id,
+                     trade['sell'].id, trade['price'], trade['quantity'],
+                     trade['time'].timestamp())
+
+
+def order_values(values):
+    """Translates values of an `ORDER` record to order fields.
+
+    :param tuple values: As read by `Journal.read()`.
+    :rtype: dict
+    """
+
+    (id, symbol, code, participant_id, side, price, quantity, filled,
+     registered_at) = values
+    return {
+        'id': id,
+        'symbol': symbol.rstrip(b'\0').decode('ascii'),
+        'code': code,
+        'participant_id': participant_id or None,
+        'side': SIDES[side],
+        'price': price or None,
+        'quantity': quantity,
+        'filled': filled,
+        'registered_at': datetime.fromtimestamp(registered_at),
+    }
+
+
+def record_values(order):
+    """Translates an order to values of an `ORDER` record.
+
+    :param book.RestingOrder order: The order.
+    :rtype: tuple
+    """
+
+    return (order.id,
+            order.symbol.encode('ascii'),
+            order.code,
+            order.participant_id or 0,
+            SIDES.index(order.side),
+            order.price or 0,
+            order.quantity,
+            order.filled,
+            order.registered_at.timestamp())
+
+
+#: The journal used by the market.
+journal = Journal(settings.JOURNAL_PATH)
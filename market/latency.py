@@ -0,0 +1,174 @@
+"""Latency of the stages of processing messages.
+
+Each stage records its duration (monotonic clock, nanoseconds) into
+a histogram of its own, cheap enough for the production load:
+a bucket is a few (`SUB_BUCKETS`) linear steps within a power of two,
+so percentiles are known to about 12 % (the mean and the max exactly).
+
+Stages of a participant's message:
+
+- `parse`: decoding the JSON,
+- `process`: validating and saving the message (`server.process()`),
+- `match`: matching a created order (`engine.match()`),
+- `dispatch`: making the replies and the datastream messages
+  (`server._dispatch()`),
+- `flush`: flushing the journal, queueing a barrier (`server._flush()`),
+- `commit`: waiting for the group commit (the `sync` persistence mode),
+- `total`: from receiving the message to writing out the replies.
+
+The histograms are logged by `dump()`, e.g. on `SIGUSR1`
+(see `server.run()`).
+"""
+
+import logging
+import time
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+#: Linear buckets per a power of two (of nanoseconds).
+SUB_BUCKETS = 8
+
+_SUB_BITS = SUB_BUCKETS.bit_length() - 1
+
+
+class Histogram:
+    """Counts of durations in logarithmic buckets."""
+
+    __slots__ = ['counts', 'count', 'total', 'max']
+
+    def __init__(self):
+        self.counts = [0] * (SUB_BUCKETS * 64)
+        """Counts of the buckets (see `bucket()`)."""
+
+        self.count = 0
+        """Number of the durations."""
+
+        self.total = 0
+        """Sum of the durations (in ns)."""
+
+        self.max = 0
+        """The longest duration (in ns)."""
+
+    @staticmethod
+    def bucket(ns):
+        """Index of the bucket of a duration.
+
+        :param int ns: Duration in nanoseconds.
+        :rtype: int
+        """
+
+        shift = ns.bit_length() - _SUB_BITS - 1
+        if shift <= 0:
+            return ns
+        return shift * SUB_BUCKETS + (ns >> shift)
+
+    @staticmethod
+    def upper_bound(index):
+        """The longest duration (in ns) of a bucket."""
+
+        shift = index // SUB_BUCKETS - 1
+        if shift <= 0:
+            return index
+        return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+    def add(self, ns):
+        """Records a duration.
+
+        :param int ns: Duration in nanoseconds.
+        """
+
+        self.counts[self.bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, share):
+        """The duration (in ns) the `share` of the durations don't exceed
+        (the upper bound of its bucket).
+
+        :param float share: E.g. `0.99`.
+        :rtype: int
+        """
+
+        rank = share * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Statistics in microseconds.
+
+        :rtype: dict
+        """
+
+        us = lambda ns: round(ns / 1000, 1)
+        return {
+            'count': self.count,
+            'mean_us': us(self.total / self.count) if self.count else 0,
+            'p50_us': us(self.percentile(0.5)),
+            'p99_us': us(self.percentile(0.99)),
+            'p99.9_us': us(self.percentile(0.999)),
+            'max_us': us(self.max),
+        }
+
+
+#: Histograms of the stages (mapping stage -> Histogram).
+histograms = {}
+
+
+def now():
+    """The monotonic clock (in ns) stages are measured by.
+
+    :rtype: int
+    """
+
+    return time.perf_counter_ns()
+
+
+def record(stage, start):
+    """Records the duration of a stage which started at `start`.
+
+    :param str stage: Name of the stage.
+    :param int start: As returned by `now()`.
+    :returns: The end of the stage (the start of the next one).
+    :rtype: int
+    """
+
+    end = time.perf_counter_ns()
+    if settings.LATENCY_STATS:
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.add(end - start)
+    return end
+
+
+def summary():
+    """Statistics of all the stages.
+
+    :rtype: dict
+    """
+
+    return {stage: histogram.summary()
+            for stage, histogram in histograms.items()}
+
+
+def dump():
+    """Logs the statistics of all the stages."""
+
+    for stage, stats in sorted(summary().items()):
+        logger.info('Latency of %s: %s' % (stage, ', '.join(
+            '%s=%s' % item for item in stats.items())))
+
+
+def reset():
+    """Forgets all the recorded durations."""
+
+    histograms.clear()
@@ -0,0 +1,188 @@
+"""Metrics of the server in the Prometheus text format.
+
+Counters are counted by the server as it sends the messages (so they
+cover shard workers too), gauges are read when scraped. The latency
+histograms of the stages (see `latency`) are exported as well.
+
+`serve()` starts a tiny HTTP endpoint (`GET /metrics`) on the event
+loop, see `settings.METRICS_PORT`.
+"""
+
+import asyncio
+import logging
+
+from . import engine
+from . import latency
+from . import persistence
+
+
+logger = logging.getLogger(__name__)
+
+#: Counters (mapping name -> value), see `count()`.
+counters = {
+    'market_messages_received_total': 0,
+    'market_orders_created_total': 0,
+    'market_orders_canceled_total': 0,
+    'market_trades_total': 0,
+    'market_rejected_messages_total': 0,
+    'market_bytes_sent_total': 0,
+    'market_watcher_disconnects_total': 0,
+    'market_watcher_dropped_total': 0,
+    'market_watcher_resyncs_total': 0,
+    'market_watcher_conflated_total': 0,
+}
+
+_help = {
+    'market_messages_received_total': 'Messages received from participants.',
+    'market_orders_created_total': 'Orders created.',
+    'market_orders_canceled_total': 'Orders canceled by participants.',
+    'market_trades_total': 'Trades.',
+    'market_rejected_messages_total': 'Messages replied with an error.',
+    'market_bytes_sent_total': 'Bytes written to the clients.',
+    'market_watcher_disconnects_total': 'Slow watchers disconnected.',
+    'market_watcher_dropped_total': 'Messages dropped for slow watchers.',
+    'market_watcher_resyncs_total': 'Snapshots sent to slow watchers.',
+    'market_watcher_conflated_total':
+        'Level messages held back for slow watchers.',
+}
+
+#: Upper bounds (in seconds) of the exported latency buckets.
+LATENCY_BUCKETS = [
+    0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005,
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+]
+
+
+def count(name, value=1):
+    """Increments a counter.
+
+    :param str name: Name of the counter (see `counters`).
+    :param int value: The increment.
+    """
+
+    counters[name] += value
+
+
+def _gauges():
+    """Current values of the gauges.
+
+    :returns: List of (name, help, list of (labels, value)).
+    """
+
+    from . import server
+
+    orders, levels = [], []
+    for symbol, book in sorted(engine.books.items()):
+        for book_side in [book.bids, book.asks]:
+            labels = {'symbol': symbol, 'side': book_side.name}
+            levels.append((labels, len(book_side)))
+            orders.append((labels, sum(len(level.orders) for level
+                                       in book_side.levels.values())))
+
+    clients = list(server.participants.values()) + server.watchers \
+        + server.conflated_watchers
+    return [
+        ('market_participants', 'Connected participants.',
+         [({}, len(server.participants))]),
+        ('market_watchers', 'Connected watchers.',
+         [({}, len(server.watchers))]),
+        ('market_conflated_watchers', 'Connected conflated watchers.',
+         [({}, len(server.conflated_watchers))]),
+        ('market_book_orders', 'Resting limit orders (of this process).',
+         orders),
+        ('market_book_levels', 'Price levels (of this process).', levels),
+        ('market_outbox_messages', 'Messages not written yet.',
+         [({}, len(server.outbox))]),
+        ('market_write_buffer_bytes',
+         'Bytes buffered by the transports of the clients.',
+         [({}, sum(client.transport.get_write_buffer_size()
+                   for client in clients))]),
+        ('market_persistence_queue', 'Statements waiting for a commit.',
+         [({}, persistence.writer.queue.qsize())]),
+    ]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % item
+                             for item in sorted(labels.items()))
+
+
+def _histogram(stage, histogram):
+    """Lines of a latency histogram."""
+
+    lines = []
+    for bound in LATENCY_BUCKETS:
+        # buckets entirely under the bound
+        cumulative = sum(
+            number for index, number in enumerate(histogram.counts)
+            if number and histogram.upper_bound(index) <= bound * 10 ** 9)
+        lines.append('market_latency_seconds_bucket{stage="%s",le="%s"} %d'
+                     % (stage, bound, cumulative))
+    lines.append('market_latency_seconds_bucket{stage="%s",le="+Inf"} %d'
+                 % (stage, histogram.count))
+    lines.append('market_latency_seconds_sum{stage="%s"} %s'
+                 % (stage, histogram.total / 10 ** 9))
+    lines.append('market_latency_seconds_count{stage="%s"} %d'
+                 % (stage, histogram.count))
+    return lines
+
+
+def render():
+    """All the metrics in the Prometheus text format.
+
+    :rtype: str
+    """
+
+    lines = []
+    for name, value in counters.items():
+        lines += ['# HELP %s %s' % (name, _help[name]),
+                  '# TYPE %s counter' % name,
+                  '%s %d' % (name, value)]
+    for name, help, values in _gauges():
+        lines += ['# HELP %s %s' % (name, help),
+                  '# TYPE %s gauge' % name]
+        lines += ['%s%s %d' % (name, _labels(labels), value)
+                  for labels, value in values]
+
+    lines += ['# HELP market_latency_seconds Latency of the stages '
+              'of processing messages.',
+              '# TYPE market_latency_seconds histogram']
+    for stage, histogram in sorted(latency.histograms.items()):
+        lines += _histogram(stage, histogram)
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        # skip the headers
+        while (await reader.readline()).strip():
+            pass
+        if request.split()[:2] == [b'GET', b'/metrics']:
+            status, body = '200 OK', render()
+        else:
+            status, body = '404 Not Found', 'Not found.\n'
+        body = body.encode('utf-8')
+        writer.write(('HTTP/1.0 %s\r\n'
+                      'Content-Type: text/plain; version=0.0.4\r\n'
+                      'Content-Length: %d\r\n\r\n'
+                      % (status, len(body))).encode('ascii') + body)
+        await writer.drain()
+    except Exception:
+        logger.exception('Serving metrics failed')
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """Starts the metrics endpoint.
+
+    :param str host: Listen as (e.g. `localhost`).
+    :param int port: Listening port.
+    :rtype: asyncio.AbstractServer
+    """
+
+    return await asyncio.start_server(_handle, host, port)
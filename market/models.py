@@ -1,13 +1,14 @@
 import logging
 
 from sqlalchemy import (
-    Column, Boolean, DateTime, Enum, Integer, Numeric,
+    Column, Boolean, DateTime, Enum, Index, Integer, String,
     Table, ForeignKey,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
-from .database import Base, db_engine, db_session
+from .database import Base, db_engine
+from . import settings
 
 logger = logging.getLogger(__name__)
 
@@ -33,10 +34,9 @@ class Participant(Base):
         effectively deactivating all his orders.
         """
 
-        for order in self.orders:
-            order.active = False
-            db_session.add(order)
-        db_session.commit()
+        from . import engine
+
+        engine.cancel_all(self.id)
 
 
 class Order(Base):
@@ -47,27 +47,34 @@ class Order(Base):
     id = Column(Integer, primary_key=True)
     """Primary key."""
 
+    symbol = Column(String(16), nullable=False, index=True,
+                    default=settings.DEFAULT_SYMBOL)
+    """Symbol of the traded instrument."""
+
     code = Column(Integer, nullable=False, index=True)
     """Order's code as received in a message."""
 
     active = Column(Boolean, default=True, nullable=False, index=True)
     """Is the order tradeable? (Already traded or deleted are not.)"""
 
-    traded_to_id = Column(Integer, ForeignKey(id), nullable=True)
-    """Primary key of a linked traded order."""
-
     side = Column(Enum('buy', 'sell', 'market_buy', 'market_sell'),
-                  nullable=False, index=True)
+                  nullable=False)
     """Order's role/side."""
 
-    price = Column(Numeric, nullable=True, index=True)
-    """Price, can be Decimal."""
+    price = Column(Integer, nullable=True)
+    """Price in ticks of the symbol (see `ticks`)."""
 
     participant_id = Column(Integer, ForeignKey(Participant.id), nullable=True)
     """Primary key of a participant who created this order."""
 
     quantity = Column(Integer, nullable=False)
-    """Quantity."""
+    """Ordered quantity."""
+
+    remaining_quantity = Column(Integer, nullable=False)
+    """Quantity not filled yet (nor canceled)."""
+
+    filled_quantity = Column(Integer, nullable=False, default=0)
+    """Quantity filled so far (see `Execution`)."""
 
     registered_at = Column(DateTime, nullable=False, index=True,
                            default=func.now())
@@ -76,8 +83,13 @@ class Order(Base):
     participant = relationship('Participant', back_populates='orders')
     """Participant (object) who created this order."""
 
-    traded_to = relationship('Order', remote_side=[id], post_update=True)
-    """Linked traded order (object)."""
+    __table_args__ = (
+        Index('ix_order_side_active_price', 'side', 'active', 'price',
+              'registered_at'),
+        # only the live orders, read when loading the books
+        Index('ix_order_live', 'symbol', 'side', 'price', 'registered_at',
+              postgresql_where=active, sqlite_where=active),
+    )
 
     def __repr__(self):
         if self.side in ['buy', 'sell']:
@@ -98,6 +110,78 @@ class Order(Base):
             return 'ask'
 
 
+class Execution(Base):
+    """A trade between two orders (a fill of both)."""
+
+    __tablename__ = 'execution'
+
+    id = Column(Integer, primary_key=True)
+    """Primary key."""
+
+    symbol = Column(String(16), nullable=False, index=True)
+    """Symbol of the traded instrument."""
+
+    buy_order_id = Column(Integer, ForeignKey(Order.id), nullable=False,
+                          index=True)
+    """Primary key of the buying order."""
+
+    sell_order_id = Column(Integer, ForeignKey(Order.id), nullable=False,
+                           index=True)
+    """Primary key of the selling order."""
+
+    price = Column(Integer, nullable=False)
+    """Price in ticks of the symbol (see `ticks`)."""
+
+    quantity = Column(Integer, nullable=False)
+    """Traded quantity."""
+
+    executed_at = Column(DateTime, nullable=False, index=True)
+    """DateTime of the trade."""
+
+    buy_order = relationship('Order', foreign_keys=[buy_order_id])
+    """The buying order (object)."""
+
+    sell_order = relationship('Order', foreign_keys=[sell_order_id])
+    """The selling order (object)."""
+
+    def __repr__(self):
+        return '<Execution %(quantity)d pcs/$%(price)d>' % self.__dict__
+
+
+def _history_table(table, name):
+    """A table of the same columns for archived rows (without foreign
+    keys, archived rows may refer to live ones and vice versa).
+
+    :param sqlalchemy.Table table: The live table.
+    :param str name: Name of the new table.
+    :rtype: sqlalchemy.Table
+    """
+
+    return Table(name, Base.metadata,
+                 *[Column(column.name, column.type,
+                          primary_key=column.primary_key,
+                          nullable=column.nullable, index=column.index)
+                   for column in table.columns])
+
+
+class OrderHistory(Base):
+    """Archived (inactive) order, see `persistence.archive()`."""
+
+    __table__ = _history_table(Order.__table__, 'order_history')
+
+    def __repr__(self):
+        return '<OrderHistory %d>' % self.id
+
+
+class ExecutionHistory(Base):
+    """Archived execution, see `persistence.archive()`."""
+
+    __table__ = _history_table(Execution.__table__, 'execution_history')
+
+    def __repr__(self):
+        return '<ExecutionHistory %d>' % self.id
+
+
 def create_db():
     """Creates the DB schema."""
 
@@ -0,0 +1,382 @@
+"""Write-behind persistence.
+
+The matching path never talks to the DB directly, it only queues
+statements (and appends them to the `journal.journal`). A background
+thread executes them in group commits, i.e. a batch of statements
+in a single transaction, once `settings.PERSISTENCE_BATCH_SIZE`
+statements are queued or the oldest of them waited for
+`settings.PERSISTENCE_MAX_DELAY` seconds. Batches are cut only at
+boundaries (barriers, put after each processed message), so changes
+of one message are committed in one transaction.
+
+If a commit fails, the writer stops committing (the DB would get
+inconsistent), keeps the statements in `Writer.failed` and fails
+all the barriers, the market is then halted.
+
+Primary keys are assigned in-process, so queued rows can refer to each
+other before they are written.
+
+Inactive orders and their executions are moved to history tables
+in batches (`archive()`), so the live tables keep (about) the size
+of the books.
+"""
+
+from concurrent.futures import Future
+from datetime import datetime
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import bindparam, func, select
+
+from .database import db_engine, db_session
+from .journal import journal
+from .models import (
+    Execution, ExecutionHistory, Order, OrderHistory, Participant,
+)
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+_orders = Order.__table__
+_participants = Participant.__table__
+_executions = Execution.__table__
+
+_insert_order = _orders.insert()
+_insert_participant = _participants.insert()
+_deactivate_order = _orders.update() \
+    .where(_orders.c.id == bindparam('_id')) \
+    .values(active=False)
+_fill_order = _orders.update() \
+    .where(_orders.c.id == bindparam('_id')) \
+    .values(active=bindparam('_active'),
+            remaining_quantity=bindparam('_remaining'),
+            filled_quantity=bindparam('_filled'))
+_insert_execution = _executions.insert()
+
+#: History tables of the models (see `archive()`).
+_history = {
+    Order: OrderHistory,
+    Execution: ExecutionHistory,
+}
+
+
+class Writer:
+    """Executes queued statements in a background thread,
+    a batch at a time in one transaction.
+    """
+
+    _stop = object()
+
+    def __init__(self, batch_size, max_delay):
+        self.batch_size = batch_size
+        """Max. number of statements committed at once."""
+
+        self.max_delay = max_delay
+        """Max. time (in seconds) a statement waits for being committed."""
+
+        self.queue = queue.Queue()
+        self.thread = None
+
+        self.error = None
+        """Exception of a failed commit (`None` if all succeeded)."""
+
+        self.failed = []
+        """Statements not committed due to the `error`
+        (list of (statement, params))."""
+
+    def start(self):
+        """Starts the background thread (if not running yet)."""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='persistence',
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Commits everything queued and stops the background thread."""
+
+        if self.thread is not None:
+            self.queue.put(self._stop)
+            self.thread.join()
+            self.thread = None
+
+    def put(self, statement, params):
+        """Queues a statement.
+
+        :param statement: SQLAlchemy Core statement, or a function
+            executing statements, called as
+            `statement(connection, **params)`.
+        :param dict params: Its parameters.
+        """
+
+        self.start()
+        self.queue.put((statement, params))
+
+    def barrier(self):
+        """Marks a boundary of a batch, returns a future, done once
+        all the statements queued so far are committed.
+
+        :rtype: concurrent.futures.Future
+        """
+
+        self.start()
+        future = Future()
+        self.queue.put(future)
+        return future
+
+    def flush(self):
+        """Blocks until all the statements queued so far are committed."""
+
+        self.barrier().result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = 0
+            deadline = time.monotonic() + self.max_delay
+            while batch[-1] is not self._stop:
+                if not isinstance(batch[-1], Future):
+                    # never cut a batch between boundaries
+                    count += 1
+                    batch.append(self.queue.get())
+                    continue
+                timeout = deadline - time.monotonic()
+                if count >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is self._stop
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        statements = [item for item in batch if not isinstance(item, Future)]
+        futures = [item for item in batch if isinstance(item, Future)]
+
+        if self.error is not None:
+            self.failed.extend(statements)
+        elif statements:
+            try:
+                with db_engine.begin() as connection:
+                    for statement, group in itertools.groupby(
+                            statements, key=lambda item: item[0]):
+                        params = [params for _, params in group]
+                        if callable(statement):
+                            for each in params:
+                                statement(connection, **each)
+                        else:
+                            connection.execute(statement, params)
+                logger.debug('Committed %d statements' % len(statements))
+            except Exception as e:
+                logger.critical('Committing failed, no further commits '
+                                '(the journal keeps the changes)',
+                                exc_info=True)
+                self.error = e
+                self.failed.extend(statements)
+
+        for future in futures:
+            if self.error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(self.error)
+
+
+#: The writer used by the market.
+writer = Writer(settings.PERSISTENCE_BATCH_SIZE,
+                settings.PERSISTENCE_MAX_DELAY)
+
+#: The last assigned primary keys (mapping model -> int).
+_ids = {}
+
+#: New primary keys are (count, index) such that `id % count == index`,
+#: see `partition_ids()`.
+_partition = (1, 0)
+
+
+def partition_ids(count, index):
+    """Assigns only primary keys of one of several partitions, so that
+    processes sharing the DB don't assign the same ones.
+
+    :param int count: Number of the partitions.
+    :param int index: Partition of this process (from 0).
+    """
+
+    global _partition
+    _partition = (count, index)
+
+
+def next_id(model):
+    """Assigns a new primary key.
+
+    :param model: A model, e.g. `models.Order`.
+    :rtype: int
+    """
+
+    count, index = _partition
+    new = last_id(model) + 1
+    _ids[model] = new + (index - new) % count
+    return _ids[model]
+
+
+def last_id(model):
+    """The last assigned primary key.
+
+    :param model: A model, e.g. `models.Order`.
+    :rtype: int
+    """
+
+    if model not in _ids:
+        seed_ids(model)
+    return _ids[model]
+
+
+def seed_ids(model, last=0):
+    """Makes new primary keys follow both the DB and the given one.
+
+    :param model: A model, e.g. `models.Order`.
+    :param int last: The last used primary key known.
+    """
+
+    for table in [model, _history.get(model)]:
+        if table is not None:
+            last = max(last,
+                       db_session.query(func.max(table.id)).scalar() or 0)
+    _ids[model] = last
+
+
+def save_participant(participant):
+    """Queues inserting a new participant, assigns its `id`.
+
+    :param models.Participant participant: A new participant.
+    """
+
+    participant.id = next_id(Participant)
+    writer.put(_insert_participant, {'id': participant.id})
+
+
+def save_order(order):
+    """Queues inserting a new order, assigns its `id`
+    (and `symbol`, `registered_at` if not set).
+
+    :param book.RestingOrder order: A new order.
+    """
+
+    order.id = next_id(Order)
+    if order.symbol is None:
+        order.symbol = settings.DEFAULT_SYMBOL
+    if order.registered_at is None:
+        order.registered_at = datetime.now()
+
+    journal.accepted(order)
+    writer.put(_insert_order, {
+        'id': order.id,
+        'symbol': order.symbol,
+        'code': order.code,
+        'active': order.active,
+        'side': order.side,
+        'price': order.price,
+        'participant_id': order.participant_id,
+        'quantity': order.quantity + order.filled,
+        'remaining_quantity': order.quantity,
+        'filled_quantity': order.filled,
+        'registered_at': order.registered_at,
+    })
+
+
+def deactivate_order(order):
+    """Queues deactivating an order.
+
+    :param book.RestingOrder order: A saved order.
+    """
+
+    journal.canceled(order)
+    writer.put(_deactivate_order, {'_id': order.id})
+
+
+def fill_order(order):
+    """Queues updating the quantities of a (partly) filled order
+    (deactivated if nothing remains).
+
+    Not journaled, it follows from the executions.
+
+    :param book.RestingOrder order: A saved order.
+    """
+
+    writer.put(_fill_order, {'_id': order.id,
+                             '_active': order.active,
+                             '_remaining': order.quantity,
+                             '_filled': order.filled})
+
+
+def save_execution(trade):
+    """Queues inserting an execution, assigns its `id`.
+
+    :param dict trade: A trade (see `engine.match()`), its orders saved.
+    """
+
+    trade['id'] = next_id(Execution)
+    journal.executed(trade)
+    writer.put(_insert_execution, {
+        'id': trade['id'],
+        'symbol': trade['symbol'],
+        'buy_order_id': trade['buy'].id,
+        'sell_order_id': trade['sell'].id,
+        'price': trade['price'],
+        'quantity': trade['quantity'],
+        'executed_at': trade['time'],
+    })
+
+
+def _archive(connection, batch_size, count, index):
+    inactive = ~_orders.c.active
+    if count > 1:
+        # other processes archive their own orders
+        inactive &= _orders.c.id % count == index
+    ids = connection.execute(select(_orders.c.id).where(inactive)
+                             .order_by(_orders.c.id)
+                             .limit(batch_size)).scalars().all()
+    if not ids:
+        return
+
+    archived = inactive & (_orders.c.id <= ids[-1])
+    archived_ids = select(_orders.c.id).where(archived)
+    of_archived = _executions.c.buy_order_id.in_(archived_ids) \
+        | _executions.c.sell_order_id.in_(archived_ids)
+    # executions first, they refer to the orders
+    for model, where in [(Execution, of_archived), (Order, archived)]:
+        table = model.__table__
+        connection.execute(_history[model].__table__.insert().from_select(
+            list(table.c.keys()), select(*table.c).where(where)))
+        connection.execute(table.delete().where(where))
+    logger.info('Archived %d orders' % len(ids))
+
+
+def archive(batch_size):
+    """Queues moving (a batch of the oldest) inactive orders and all
+    their executions to the history tables (`models.OrderHistory`,
+    `models.ExecutionHistory`), in one transaction.
+
+    Only the orders of this process' partition (see `partition_ids()`)
+    are moved. Inactive orders are not changed any more, so their rows
+    can be moved in the background.
+
+    :param int batch_size: Max. number of orders moved.
+    """
+
+    count, index = _partition
+    writer.put(_archive, {'batch_size': batch_size,
+                          'count': count,
+                          'index': index})
+    writer.barrier()
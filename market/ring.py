@@ -0,0 +1,113 @@
+"""Lock-free rings of fixed-size records in shared memory.
+
+A ring connects exactly one producer process with one consumer process
+(see `gateways`). The header holds two counters on separate cache
+lines: `head` (records read so far, written by the consumer only) and
+`tail` (records written so far, written by the producer only), the
+records follow in `slots` slots of `size` bytes.
+
+The producer copies a record into its slot first and only then
+publishes it by advancing `tail`, the consumer copies records out before
+advancing `head`, so neither side ever waits for a lock. The counters
+are aligned 8-byte words stored at once (by `ctypes`), and stores are
+not reordered (x86-64, where the market runs).
+
+Rings don't notify: the peer is woken by a doorbell (see `gateways`)
+once per batch of records.
+"""
+
+from collections import deque
+import ctypes
+from multiprocessing import shared_memory
+
+
+_HEAD = 0
+_TAIL = 64
+_HEADER = 128
+
+
+class Ring:
+    """A ring, created by the owner process (`name=None`), attached
+    by the others (pickling a ring attaches it by its name).
+    """
+
+    def __init__(self, size, slots, name=None):
+        self.size = size
+        """Size of a record (bytes)."""
+
+        self.slots = slots
+        """Capacity (records)."""
+
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=_HEADER + size * slots)
+        self._head = ctypes.c_uint64.from_buffer(self.shm.buf, _HEAD)
+        self._tail = ctypes.c_uint64.from_buffer(self.shm.buf, _TAIL)
+
+        self.backlog = deque()
+        """Records of this process not fitting into the ring yet
+        (see `put()`)."""
+
+    def __reduce__(self):
+        return Ring, (self.size, self.slots, self.shm.name)
+
+    def __len__(self):
+        """Records not read yet."""
+
+        return self._tail.value - self._head.value
+
+    def _offset(self, count):
+        return _HEADER + (count % self.slots) * self.size
+
+    def put(self, record):
+        """Appends a record (by the producer), or keeps it in `backlog`
+        while the ring is full (see `retry()`).
+
+        :param bytes record: Exactly `size` bytes.
+        """
+
+        if self.backlog or not self._put(record):
+            self.backlog.append(record)
+
+    def _put(self, record):
+        tail = self._tail.value
+        if tail - self._head.value >= self.slots:
+            return False
+        offset = self._offset(tail)
+        self.shm.buf[offset:offset + self.size] = record
+        self._tail.value = tail + 1
+        return True
+
+    def retry(self):
+        """Moves records from `backlog` into the ring while there's room.
+
+        :returns: Are all of them in?
+        :rtype: bool
+        """
+
+        while self.backlog and self._put(self.backlog[0]):
+            self.backlog.popleft()
+        return not self.backlog
+
+    def get(self):
+        """Takes all the records written so far (by the consumer).
+
+        :rtype: list of bytes
+        """
+
+        head = self._head.value
+        tail = self._tail.value
+        buf = self.shm.buf
+        records = []
+        for count in range(head, tail):
+            offset = self._offset(count)
+            records.append(bytes(buf[offset:offset + self.size]))
+        self._head.value = tail
+        return records
+
+    def close(self, unlink=False):
+        """Detaches this process (and removes the ring if `unlink`)."""
+
+        del self._head, self._tail
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -1,11 +1,21 @@
 import asyncio
-import simplejson as json
+from collections import namedtuple
+from decimal import InvalidOperation
 import logging
+import re
+import signal
 
-from .database import db_session
+from . import codecs
 from . import engine
-from .models import Order
+from .journal import journal
+from . import latency
+from . import metrics
+from .book import RestingOrder
 from . import models
+from . import persistence
+from . import settings
+from .ticks import to_price, to_ticks
+from . import wire
 
 
 logger = logging.getLogger(__name__)
@@ -15,51 +25,152 @@ class MarketException(Exception):
     pass
 
 
-def process(message, participant):
-    order = None
+_symbol_re = re.compile(r'^[A-Za-z0-9._-]{1,16}$')
+
+
+def _symbol(message):
+    """Returns a symbol of a message (`settings.DEFAULT_SYMBOL`
+    if not specified).
+
+    :raises MarketException: If the symbol is not tradeable.
+    """
+
+    symbol = message.get('symbol', settings.DEFAULT_SYMBOL)
+    if settings.SYMBOLS is None:
+        valid = isinstance(symbol, str) and _symbol_re.match(symbol)
+    else:
+        valid = symbol in settings.SYMBOLS
+    if not valid:
+        raise MarketException('Unknown symbol.')
+    return symbol
+
+
+#: Integers saved from messages (orderId, quantity, price in ticks)
+#: are 64-bit in the DB, the journal and the binary protocol.
+_INT64 = range(-2 ** 63, 2 ** 63)
+
+
+def _number(value, integer=False):
+    """Checks a numeric field of a message.
+
+    :raises MarketException: If it's not a (positive) number,
+        or an integer out of `_INT64`.
+    """
+
+    types = int if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, types) \
+            or not value > 0 or integer and value not in _INT64:
+        raise MarketException('Bad number.')
+    return value
+
+
+def _order_id(value):
+    """Checks `orderId` of a message.
+
+    :raises MarketException: If it's not an integer within `_INT64`.
+    """
+
+    if isinstance(value, bool) or not isinstance(value, int) \
+            or value not in _INT64:
+        raise MarketException('Bad order id.')
+    return value
+
+
+#: A checked message of a participant (see `parse()`), its price
+#: in ticks (`None` for market orders and cancels).
+Command = namedtuple('Command', ['action', 'symbol', 'code', 'side',
+                                 'price', 'quantity'])
+
+
+def parse(message):
+    """Checks a message of a participant and converts its values,
+    whatever the state of the market.
+
+    :param dict message: Message of the participant.
+    :rtype: Command
+    :raises MarketException: If the message is not valid.
+    """
 
     try:
         action = message['message']
         order_code = message['orderId']
     except KeyError:
         raise MarketException('Unsufficient data.')
+    symbol = _symbol(message)
+    order_code = _order_id(order_code)
+
+    if action == 'cancelOrder':
+        return Command(action, symbol, order_code, None, None, None)
+    if action != 'createOrder':
+        logger.warning('Unknown action: %s' % action)
+        raise MarketException('Unknown action.')
+
+    try:
+        side = str(message['side']).lower()
+        quantity = _number(message['quantity'], integer=True)
+        price = _number(message['price']) if side in ['buy', 'sell'] \
+                else None
+    except KeyError:
+        raise MarketException('Unsufficient data.')
+    if side not in ['buy', 'sell', 'market_buy', 'market_sell']:
+        raise MarketException('Unknown side.')
+    if price is not None:
+        try:
+            price = to_ticks(symbol, price)
+        except InvalidOperation:
+            raise MarketException('Bad number.')
+        except ValueError:
+            raise MarketException('Price not on a tick.')
+        if price not in _INT64:
+            raise MarketException('Bad number.')
+    return Command(action, symbol, order_code, side, price, quantity)
+
+
+def process(message, participant_id):
+    """Applies a message of a participant to the market.
+
+    :param message: Message of the participant (dict), or a `Command`
+        parsed from it already.
+    :param int participant_id: Primary key of the participant.
+    :returns: (new order or `None`, the reply)
+    :raises MarketException: If the message can't be applied.
+    """
+
+    order = None
+
+    if persistence.writer.error is not None:
+        raise MarketException('Market halted.')
+
+    command = message if isinstance(message, Command) else parse(message)
+    action, symbol, order_code = command[:3]
 
     if action == 'createOrder':
-        if Order.query.filter_by(code=order_code).count():
+        if engine.books.find(symbol, participant_id, order_code):
             raise MarketException('Order already exists.')
-        try:
-            order = Order(
-                code=order_code,
-                participant=participant,
-                side=message['side'].lower(),
-                quantity=message['quantity'],
-            )
-            if order.side in ['buy', 'sell']:
-                order.price = message['price']
-            db_session.add(order)
-            db_session.commit()
-        except KeyError:
-            raise MarketException('Unsufficient data.')
+        order = RestingOrder(
+            id=None,
+            symbol=symbol,
+            code=order_code,
+            participant_id=participant_id,
+            side=command.side,
+            price=command.price,
+            quantity=command.quantity,
+        )
+        persistence.save_order(order)
         logger.info('Order created: %s' % order)
         report = 'NEW'
 
-    elif action == 'cancelOrder':
-        order_query = Order.query.filter_by(code=order_code,
-                                            active=True,
-                                            participant=participant)
-        if not order_query.count():
+    else:
+        canceled = engine.books.find(symbol, participant_id, order_code)
+        if canceled is None:
             raise MarketException('Order does not exist.')
-        order_query.update({Order.active: False})
-        db_session.commit()
+        engine.cancel(canceled)
         logger.debug('Order canceled: id=%d' % order_code)
         report = 'CANCELED'
 
-    else:
-        logger.warning('Unknown action: %s' % action)
-        raise MarketException('Unknown action.')
-
     return order, {
         'message': 'executionReport',
+        'symbol': symbol,
         'orderId': order_code,
         'report': report,
     }
@@ -71,9 +182,34 @@ participants = {}
 #: Watching clients (list of DatastreamProtocol instances).
 watchers = []
 
+#: Watching clients of the conflated datastream
+#: (list of ConflatedDatastreamProtocol instances).
+conflated_watchers = []
+
+#: Datastream messages for the conflated datastream, waiting for
+#: `_send_conflated()` (mapping price level or seq id of a trade
+#: -> message).
+conflated = {}
+
+#: Messages not written yet (list of (transport, bytes)), see `_flush()`.
+outbox = []
+
+#: The last seq id of the datastream, shared by all the watchers
+#: (see `_broadcast()`).
+datastream_seq_id = 0
+
+#: Price levels as sent to the watchers, for snapshots (mapping
+#: (symbol, side) -> mapping price -> quantity), see `_snapshot()`.
+#: Seeded from the books on start (see `_book_messages()`).
+levels = {}
+
+#: Router to shard workers (`shards.Router`), `None` if matching
+#: in this process.
+router = None
+
 
 def _send(client, msg):
-    """Sends a message to the client.
+    """Sends a message to the client (when `_flush()` is called).
 
     :param asyncio.Protocol client: Client containing `.transport`.
     :param dict msg: Message to be JSONified.
@@ -82,77 +218,286 @@ def _send(client, msg):
     client.outcoming_seq_id += 1
     msg['seqId'] = client.outcoming_seq_id
 
-    client.transport.write(json.dumps(msg).encode('utf-8') + b'\n')
+    outbox.append((client.transport, client.codec.encode(msg)))
     logger.debug('Message sent: %s' % msg)
 
 
-def _send_datastream_orderbook(order):
-    """Informs watchers about a new order (anonymously).
+def _broadcast(msg):
+    """Sends a datastream message to all the watchers (when `_flush()`
+    is called). It's numbered by the shared `datastream_seq_id` and
+    encoded once, all the watchers get the same bytes.
 
-    :param models.Order order: A new order.
+    :param dict msg: Message to be JSONified.
     """
 
-    msg = {
-        'type': 'orderbook',
-        'side': order.side_datastream,
-        'price': order.price,
-        'quantity': order.quantity,
-    }
+    global datastream_seq_id
+
+    datastream_seq_id += 1
+    msg['seqId'] = datastream_seq_id
+    if msg['type'] == 'orderbook':
+        prices = levels.setdefault((msg['symbol'], msg['side']), {})
+        if msg['quantity']:
+            prices[msg['price']] = msg['quantity']
+        else:
+            prices.pop(msg['price'], None)
 
+    data = DatastreamProtocol.codec.encode(msg)
     for watcher in watchers:
-        _send(watcher, msg)
+        watcher.deliver(msg, data)
+    if conflated_watchers:
+        if msg['type'] == 'orderbook':
+            conflated[msg['symbol'], msg['side'], msg['price']] = msg
+        else:
+            conflated[msg['seqId']] = msg
+    logger.debug('Message broadcast: %s' % msg)
+
+
+def _send_conflated():
+    """Sends the messages collected since the last call (the latest
+    one of each price level and all the trades, in the order of their
+    seq ids) to the watchers of the conflated datastream.
+    """
+
+    if not conflated:
+        return
+    for msg in sorted(conflated.values(), key=lambda msg: msg['seqId']):
+        data = ConflatedDatastreamProtocol.codec.encode(msg)
+        for watcher in conflated_watchers:
+            watcher.deliver(msg, data)
+    conflated.clear()
+    _flush()
+
+
+def _snapshot():
+    """Datastream message with all the price levels (full depth)
+    as of the current `datastream_seq_id` (its `seqId`).
+
+    :rtype: dict
+    """
+
+    snapshot = []
+    for (symbol, side), prices in sorted(levels.items()):
+        for price, quantity in sorted(prices.items(),
+                                      reverse=side == 'bid'):
+            snapshot.append({
+                'symbol': symbol,
+                'side': side,
+                'price': price,
+                'quantity': quantity,
+            })
+    return {'type': 'snapshot', 'seqId': datastream_seq_id,
+            'levels': snapshot}
+
+
+def _write(messages):
+    for transport, data in messages:
+        if transport.is_closing():
+            continue
+        try:
+            transport.write(data)
+            metrics.count('market_bytes_sent_total', len(data))
+        except Exception:
+            logger.exception('Writing to %s failed'
+                             % str(transport.get_extra_info('peername')))
+
+
+def _flush(received=None):
+    """Writes out the messages from `outbox`.
+
+    In the `sync` persistence mode only once all the changes made so far
+    are committed, participants get an error instead if committing fails.
+
+    :param int received: When the message being replied was received
+        (`latency.now()`), if any.
+    """
+
+    start = latency.now()
+    messages = outbox[:]
+    del outbox[:]
+    journal.flush()
+    # a boundary of the writer's batches, even if not waited for
+    committing = persistence.writer.barrier()
+    flushed = latency.record('flush', start)
+
+    if settings.PERSISTENCE_MODE != 'sync' \
+            or persistence.writer.error is not None:
+        # when halted, only errors are replied
+        _write(messages)
+        if received is not None:
+            latency.record('total', received)
+        return
+
+    def committed(future):
+        if received is not None:
+            latency.record('commit', flushed)
+        if future.exception():
+            logger.error('Changes not committed, replying with an error')
+            _write_errors(messages)
+        else:
+            _write(messages)
+        if received is not None:
+            latency.record('total', received)
+
+    asyncio.wrap_future(committing).add_done_callback(committed)
+
+
+def _write_errors(messages):
+    """Informs the participants of the messages (instead of sending them)
+    that their changes were not committed. Watchers get nothing.
+    """
 
+    clients = {client.transport: client for client in participants.values()}
+    for transport in {transport for transport, data in messages}:
+        if transport in clients:
+            _send(clients[transport], {'error': 'Not committed.'})
+    _write(outbox[:])
+    del outbox[:]
 
-def _send_datastream_trade(trade):
-    """Informs watchers about a new trade (anonymously).
+
+def _orderbook_messages():
+    """Messages with new total quantities of the price levels changed
+    since the last call (anonymous).
+
+    :rtype: list
+    """
+
+    return [{
+        'type': 'orderbook',
+        'symbol': symbol,
+        'side': side,
+        'price': to_price(symbol, price),
+        'quantity': quantity,
+    } for symbol, side, price, quantity in engine.books.pop_changes()]
+
+
+def _book_messages():
+    """Messages with total quantities of all the price levels
+    of the books (of this process), e.g. of the loaded ones.
+
+    :rtype: list
+    """
+
+    return [{
+        'type': 'orderbook',
+        'symbol': symbol,
+        'side': side.name,
+        'price': to_price(symbol, level.price),
+        'quantity': level.quantity,
+    } for symbol, book in sorted(engine.books.items())
+        for side in [book.bids, book.asks] for level in side]
+
+
+def _trade_message(trade):
+    """Datastream message about a new trade (anonymous).
 
     :param dict trade: Trade (as returned from the engine).
     """
 
-    msg = {
+    return {
         'type': 'trade',
+        'symbol': trade['symbol'],
         'time': trade['time'].timestamp(),
-        'price': trade['price'],
+        'price': to_price(trade['symbol'], trade['price']),
         'quantity': trade['quantity'],
     }
 
-    for watcher in watchers:
-        _send(watcher, msg)
+
+def _fill_report(trade, side):
+    """Execution report of a trade for one of its participants.
+
+    :param dict trade: Trade (as returned from the engine).
+    :param str side: `buy` or `sell`.
+    """
+
+    return {
+        'message': 'executionReport',
+        'symbol': trade['symbol'],
+        'orderId': trade[side].code,
+        'report': 'FILL',
+        'price': to_price(trade['symbol'], trade['price']),
+        'quantity': trade['quantity'],
+    }
 
 
-def _make_trades():
-    """As long as new trades can be make, make them
-    and inform both participants and watchers.
+def execute(message, participant_id, changes=True):
+    """Processes a message of a participant, matches a created order.
+
+    Transports are not touched, so it can run in a shard worker
+    (see `shards`) or the matching process (see `gateways`) as well
+    as here.
+
+    :param message: Message of the participant (dict or `Command`).
+    :param int participant_id: Primary key of the participant.
+    :param bool changes: Include messages of the changed price levels?
+        (A batch of messages takes them once, see `_orderbook_messages()`.)
+    :returns: (list of (participant_id, message) for the participants,
+        list of messages for the watchers)
     """
 
-    trade = engine.trade()
-    while trade:
-        logger.info('Trade: %s' % trade)
+    order = None
+    start = latency.now()
+    try:
+        order, reply = process(message, participant_id)
+    except MarketException as e:
+        logger.warning('Bad input: %s' % e)
+        reply = {'error': str(e)}
+    start = latency.record('process', start)
+
+    replies = [(participant_id, reply)]
+    datastream = []
+    if order:
+        trades = engine.match(order)
+        latency.record('match', start)
+        for trade in trades:
+            logger.info('Trade: %s' % trade)
+            replies.extend((trade[side].participant_id,
+                            _fill_report(trade, side))
+                           for side in ['buy', 'sell'])
+            datastream.append(_trade_message(trade))
+    if changes:
+        datastream.extend(_orderbook_messages())
+    return replies, datastream
+
+
+def disconnect(participant_id):
+    """Cancels all the orders of a disconnected participant.
+
+    :returns: List of messages for the watchers.
+    """
 
-        for side in ['buy', 'sell']:
-            pid = trade[side].participant.id
-            if not pid in participants:
-                logger.warning('%s is already disconnected'
-                               % trade[side].participant)
-                continue
+    engine.cancel_all(participant_id)
+    return _orderbook_messages()
 
-            _send(participants[pid],
-                  {
-                    'message': 'executionReport',
-                    'orderId': trade[side].id,
-                    'report': 'FILL',
-                    'price': trade['price'],
-                    'quantity': trade['quantity'],
-                  },
-            )
 
-        _send_datastream_trade(trade)
+def _dispatch(replies, datastream):
+    """Sends messages (as returned by `execute()`) to the participants
+    and to all the watchers (when `_flush()` is called).
+    """
 
-        trade = engine.trade()
+    for participant_id, msg in replies:
+        if 'error' in msg:
+            metrics.count('market_rejected_messages_total')
+        elif msg.get('report') == 'NEW':
+            metrics.count('market_orders_created_total')
+        elif msg.get('report') == 'CANCELED':
+            metrics.count('market_orders_canceled_total')
+        if participant_id not in participants:
+            logger.warning('Participant %s is already disconnected'
+                           % participant_id)
+            continue
+        _send(participants[participant_id], msg)
+
+    for msg in datastream:
+        if msg['type'] == 'trade':
+            metrics.count('market_trades_total')
+        _broadcast(msg)
 
 
 class ParticipantProtocol(asyncio.Protocol):
     """Protocol for active clients, those making bids/asks.
+
+    Messages are JSON lines (`codecs.JSON`), or binary ones
+    (`codecs.BINARY`, see `wire`) if the client starts with `wire.MAGIC`.
     """
 
     def connection_made(self, transport):
@@ -161,81 +506,332 @@ class ParticipantProtocol(asyncio.Protocol):
         logger.debug('Connected: %s' % str(self.peername))
 
         self.participant = models.Participant()
-        db_session.add(self.participant)
-        db_session.commit()
+        persistence.save_participant(self.participant)
 
         participants[self.participant.id] = self
 
         self.incoming_seq_id = 0
         self.outcoming_seq_id = 0
 
+        self.codec = None
+        """Codec of the messages (see `codecs`), `None` until the first
+        bytes of the client are received."""
+
+        self.buffer = b''
+        """Received data not ending with a newline (or not making
+        a whole binary message) yet."""
+
+        self.discarding = False
+        """Is the rest of a too long message to be skipped?"""
+
     def data_received(self, data):
-        message = json.loads(data.decode('utf-8'))
+        """Processes all the complete messages received so far
+        as a batch, their replies are flushed at once.
+        """
+
+        received = latency.now()
+        self.buffer += data
+        if self.codec is None:
+            if len(self.buffer) < len(wire.MAGIC) \
+                    and wire.MAGIC.startswith(self.buffer):
+                # wait for the rest of it
+                return
+            if self.buffer.startswith(wire.MAGIC):
+                self.codec = codecs.BINARY
+                self.buffer = self.buffer[len(wire.MAGIC):]
+                self.transport.write(wire.MAGIC)
+            else:
+                self.codec = codecs.JSON
+
+        lines, self.buffer = self.codec.split(self.buffer)
+        if self.discarding and lines:
+            # the end of a too long message
+            del lines[0]
+            self.discarding = False
+
+        replies, datastream = [], []
+        for line in lines:
+            if line.strip():
+                done = self._execute(line)
+                replies.extend(done[0])
+                datastream.extend(done[1])
+
+        if len(self.buffer) > settings.MAX_MESSAGE_SIZE:
+            self.buffer = b''
+            if not self.discarding:
+                logger.warning('Bad input: a too long message')
+                replies.append((self.participant.id,
+                                {'error': 'Message too long.'}))
+                self.discarding = True
+
+        if not replies:
+            return
+        if router is None:
+            datastream.extend(_orderbook_messages())
+        start = latency.now()
+        _dispatch(replies, datastream)
+        latency.record('dispatch', start)
+        _flush(received)
+
+    def _execute(self, line):
+        """Processes a message (or routes it to its shard worker).
+
+        :param bytes line: The message (as split by the codec).
+        :returns: As `execute()`, without changes of the price levels.
+        """
+
+        start = latency.now()
+        try:
+            message = self.codec.decode(line)
+        except ValueError:
+            message = None
+        latency.record('parse', start)
+        metrics.count('market_messages_received_total')
         logger.debug('Message received: %s' % message)
         self.incoming_seq_id += 1
 
-        order = None
-
         try:
+            if not isinstance(message, dict):
+                raise MarketException('Bad message.')
             if 'seqId' in message:
                 if not message['seqId'] == self.incoming_seq_id:
                     raise MarketException('Bad seq id, expected %d'
                                           % self.incoming_seq_id)
-            order, reply = process(message, self.participant)
+            if router is not None:
+                router.submit(_symbol(message), self.participant.id, message)
+                return [], []
+            return execute(message, self.participant.id, changes=False)
         except MarketException as e:
             logger.warning('Bad input: %s' % e)
-            reply = {'error': str(e)}
-
-        _send(self, reply)
-        if order:
-            _send_datastream_orderbook(order)
-
-        _make_trades()
+            return [(self.participant.id, {'error': str(e)})], []
 
     def connection_lost(self, exc):
         logger.debug('Disconnected: %s' % str(self.peername))
-        self.participant.deactivate()
         del participants[self.participant.id]
+        if router is not None:
+            router.disconnect(self.participant.id)
+            return
+        _dispatch([], disconnect(self.participant.id))
+        _flush()
 
 
 class DatastreamProtocol(asyncio.Protocol):
     """Protocol for anonymous watchers.
 
-    .. todo::
-        What about cancelling orders? Should watchers be informed?
-        What's the format?
+    A watcher gets a `snapshot` message of all the price levels first
+    (see `_snapshot()`), then trades and new total quantities of changed
+    price levels (0 when a level is gone). Their seq ids are shared
+    (a watcher connecting later starts with a higher one), a gap means
+    a lost message.
+
+    A watcher not reading fast enough (`settings.WATCHER_BUFFER_SIZE`
+    bytes not written to it) is disconnected, resynced (messages are
+    dropped, a `snapshot` message of all the levels follows once it
+    catches up) or gets the latest quantities of the changed levels
+    later (and no trades meanwhile), see `settings.WATCHER_POLICY`.
+    Messages with a seq id not higher than the one of a snapshot
+    are older than it.
     """
 
+    #: Connected watchers of this datastream.
+    clients = watchers
+
+    #: Codec of the messages (see `codecs`).
+    codec = codecs.JSON
+
     def connection_made(self, transport):
         self.transport = transport
         self.peername = transport.get_extra_info('peername')
         logger.debug('Connected (watcher): %s' % str(self.peername))
 
-        watchers.append(self)
-
-        self.outcoming_seq_id = 0
+        self.clients.append(self)
+
+        self.paused = False
+        """Is the write buffer of the transport full?"""
+
+        self.stale = False
+        """Were messages dropped (a snapshot is due)?"""
+
+        self.conflated = {}
+        """The latest messages of price levels held back
+        (mapping (symbol, side, price) -> message)."""
+
+        transport.set_write_buffer_limits(high=settings.WATCHER_BUFFER_SIZE)
+
+        # the following messages change the snapshot
+        outbox.append((transport, self.codec.encode(_snapshot())))
+        _flush()
+
+    def deliver(self, msg, data):
+        """Sends a datastream message (when `_flush()` is called),
+        or applies `settings.WATCHER_POLICY` if this watcher is too slow.
+
+        :param dict msg: The message.
+        :param bytes data: The encoded message.
+        """
+
+        if not self.paused:
+            outbox.append((self.transport, data))
+        elif settings.WATCHER_POLICY == 'disconnect':
+            if not self.transport.is_closing():
+                logger.warning('Disconnecting a slow watcher: %s'
+                               % str(self.peername))
+                metrics.count('market_watcher_disconnects_total')
+                self.transport.abort()
+        elif settings.WATCHER_POLICY == 'conflate' \
+                and msg['type'] == 'orderbook':
+            self.conflated[msg['symbol'], msg['side'], msg['price']] = msg
+            metrics.count('market_watcher_conflated_total')
+        else:
+            # trades can't be conflated
+            self.stale = settings.WATCHER_POLICY == 'resync'
+            metrics.count('market_watcher_dropped_total')
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        """Catches up: sends a snapshot if messages were dropped,
+        or the held back latest messages of price levels.
+        """
+
+        self.paused = False
+        if self.stale:
+            logger.info('Resyncing a slow watcher: %s' % str(self.peername))
+            metrics.count('market_watcher_resyncs_total')
+            outbox.append((self.transport, self.codec.encode(_snapshot())))
+            self.stale = False
+        else:
+            outbox.extend((self.transport, self.codec.encode(msg))
+                          for msg in sorted(self.conflated.values(),
+                                            key=lambda msg: msg['seqId']))
+        self.conflated.clear()
+        _flush()
 
     def connection_lost(self, exc):
         logger.debug('Disconnected (watcher): %s' % str(self.peername))
-        watchers.remove(self)
+        self.clients.remove(self)
+
+
+class ConflatedDatastreamProtocol(DatastreamProtocol):
+    """Protocol for anonymous watchers of the conflated datastream.
+
+    They get the same messages, but only once per
+    `settings.CONFLATION_INTERVAL`: all the trades and the latest
+    quantity of each changed price level (seq ids of skipped changes
+    are missing).
+    """
+
+    clients = conflated_watchers
+
+
+def _checkpoint(loop):
+    """Checkpoints the book periodically, the snapshot is written
+    in an executor.
+    """
+
+    finish = engine.checkpoint()
+    if finish:
+        loop.run_in_executor(None, finish)
+    loop.call_later(settings.SNAPSHOT_INTERVAL, _checkpoint, loop)
+
+
+def _conflate(loop):
+    """Sends the conflated datastream periodically."""
 
+    _send_conflated()
+    loop.call_later(settings.CONFLATION_INTERVAL, _conflate, loop)
 
-def run(host, port, port_datastream):
+
+def _dump_latency():
+    """Logs the latency of the stages (of the workers too)."""
+
+    latency.dump()
+    if router is not None:
+        router.dump_latency()
+
+
+def _archive(loop):
+    """Archives inactive orders periodically."""
+
+    persistence.archive(settings.ARCHIVE_BATCH_SIZE)
+    loop.call_later(settings.ARCHIVE_INTERVAL, _archive, loop)
+
+
+def listen(loop, host, port, port_datastream, port_conflated=None,
+           reuse_port=None):
+    """Starts serving the participants and the watchers.
+
+    :param asyncio.AbstractEventLoop loop: The event loop.
+    :param bool reuse_port: Share the ports with other processes
+        (`SO_REUSEPORT`)?
+    :returns: List of the servers.
+
+    See `run()` for the rest.
+    """
+
+    servers = [loop.run_until_complete(loop.create_server(
+        protocol, host, each, reuse_port=reuse_port))
+        for protocol, each in [(ParticipantProtocol, port),
+                               (DatastreamProtocol, port_datastream),
+                               (ConflatedDatastreamProtocol, port_conflated)]
+        if each]
+    if port_conflated:
+        loop.call_later(settings.CONFLATION_INTERVAL, _conflate, loop)
+    return servers
+
+
+def run(host, port, port_datastream, recover=False, port_conflated=None):
     """Runs both active & watcher services. Runs until Ctrl+C.
 
     :param str host: Listen as (e.g. `localhost`).
     :param int port: Listening port for active clients.
     :param int port_datatream: Listening port for watchers.
+    :param bool recover: Rebuild the book from the snapshot and
+        the journal (instead of the DB)?
+    :param int port_conflated: Listening port for watchers of
+        the conflated datastream (see `ConflatedDatastreamProtocol`),
+        optional.
+
+    With `settings.SHARDS`, matching runs in worker processes
+    (see `shards`), this process only serves the connections.
+    With `settings.GATEWAYS`, more processes serve them, all of them
+    feeding one matching process (see `gateways`).
+
+    `SIGUSR1` logs the latency of the stages (see `latency`),
+    metrics are served on `settings.METRICS_PORT` (see `metrics`).
     """
 
-    loop = asyncio.get_event_loop()
+    global router
 
-    coro = loop.create_server(ParticipantProtocol, host, port)
-    server = loop.run_until_complete(coro)
+    loop = asyncio.get_event_loop()
 
-    coro_datastream = loop.create_server(DatastreamProtocol, host,
-                                         port_datastream)
-    server_datastream = loop.run_until_complete(coro_datastream)
+    if settings.GATEWAYS:
+        from .gateways import Gateways
+        router = Gateways(settings.GATEWAYS)
+        router.start(loop, recover, (host, port, port_datastream,
+                                     port_conflated))
+    elif settings.SHARDS:
+        from .shards import Router
+        router = Router(settings.SHARDS)
+        router.start(loop, recover)
+    else:
+        engine.start(recover)
+        # the workers send theirs when started
+        _dispatch([], _book_messages())
+
+    servers = listen(loop, host, port, port_datastream, port_conflated,
+                     reuse_port=bool(settings.GATEWAYS) or None)
+    if settings.METRICS_PORT:
+        servers.append(loop.run_until_complete(
+            metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)))
+
+    if settings.SNAPSHOT_PATH and settings.JOURNAL_PATH \
+            and router is None:
+        loop.call_later(settings.SNAPSHOT_INTERVAL, _checkpoint, loop)
+    if settings.ARCHIVE_INTERVAL and router is None:
+        loop.call_later(settings.ARCHIVE_INTERVAL, _archive, loop)
+    loop.add_signal_handler(signal.SIGUSR1, _dump_latency)
 
     logger.info('Listening on %s:%s,%s' % (host, port, port_datastream))
     try:
@@ -243,8 +839,12 @@ def run(host, port, port_datastream):
     except KeyboardInterrupt:
         pass
 
-    server.close()
-    server_datastream.close()
-    loop.run_until_complete(server.wait_closed())
-    loop.run_until_complete(server_datastream.wait_closed())
+    for each in servers:
+        each.close()
+        loop.run_until_complete(each.wait_closed())
+    if router is not None:
+        router.stop()
     loop.close()
+
+    persistence.writer.stop()
+    journal.close()
@@ -9,6 +9,86 @@ BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 #: DB connection.
 DB_URL = 'sqlite:///:memory:'
 
+#: Symbol of orders and messages not specifying one.
+DEFAULT_SYMBOL = 'WOOD'
+
+#: Tradeable symbols, `None` allows any (up to 16 characters).
+SYMBOLS = None
+
+#: Price tick size of symbols not in `TICK_SIZES`,
+#: prices are kept as integer numbers of ticks (see `ticks`).
+TICK_SIZE = '0.01'
+
+#: Price tick sizes of symbols (mapping symbol -> str).
+TICK_SIZES = {}
+
+#: Number of matching worker processes, symbols are partitioned among
+#: them by a hash, `0` matches in the server process (see `shards`).
+SHARDS = 0
+
+#: Number of gateway processes serving the connections (on the same
+#: ports, `SO_REUSEPORT`), they feed one matching process through rings
+#: in shared memory (see `gateways`), `0` disables. Overrides `SHARDS`.
+GATEWAYS = 0
+
+#: Records a ring between a gateway and the matching process holds.
+RING_SLOTS = 65536
+
+#: Max. length (in bytes) of a message of a participant.
+MAX_MESSAGE_SIZE = 65536
+
+#: Max. bytes not written yet to a watcher, a slower watcher is handled
+#: by `WATCHER_POLICY`.
+WATCHER_BUFFER_SIZE = 1048576
+
+#: What to do with a slow watcher: `disconnect` it, `resync` it (drop
+#: messages, send a snapshot once it catches up) or `conflate` (keep
+#: only the latest quantities of levels, drop trades).
+WATCHER_POLICY = 'resync'
+
+#: Seconds between the messages of the conflated datastream
+#: (see `server.run()`).
+CONFLATION_INTERVAL = 0.01
+
+#: Persistence mode: `sync` replies only after the data are committed,
+#: `async` replies immediately and the data are committed later.
+PERSISTENCE_MODE = 'sync'
+
+#: Max. number of statements committed at once.
+PERSISTENCE_BATCH_SIZE = 1000
+
+#: Max. time (in seconds) a statement waits for being committed.
+PERSISTENCE_MAX_DELAY = 0.005
+
+#: Time (in seconds) between archivals of inactive orders,
+#: `None` keeps them in the live tables (see `persistence.archive()`).
+ARCHIVE_INTERVAL = 1
+
+#: Max. number of orders archived at once.
+ARCHIVE_BATCH_SIZE = 10000
+
+#: Path of the event journal, `None` disables journaling.
+JOURNAL_PATH = None
+
+#: Sync the journal to the disk after each processed message?
+JOURNAL_FSYNC = False
+
+#: Path of the book snapshot, `None` disables checkpoints.
+#: (Needs the journal.)
+SNAPSHOT_PATH = None
+
+#: Time (in seconds) between checkpoints.
+SNAPSHOT_INTERVAL = 60
+
+#: Record the latency of the stages of processing messages
+#: (see `latency`)?
+LATENCY_STATS = True
+
+#: Host and port of the metrics endpoint (see `metrics`),
+#: `None` port disables it.
+METRICS_HOST = 'localhost'
+METRICS_PORT = 7003
+
 #: Sentry URL. If not `None`, logging to specified Sentry.
 SENTRY_DSN = None
 
@@ -0,0 +1,267 @@
+"""Sharding of matching across worker processes.
+
+Symbols are partitioned among `settings.SHARDS` worker processes
+by a stable hash (`shard_of()`). Each worker owns the books of its
+symbols, their journal (the path suffixed with the shard index) and
+persists its orders, so messages of one symbol are processed in order
+by one process. Workers archive their own inactive orders. The steps
+of their loop are shared with the matching process of `gateways`
+(`Worker`).
+
+The server process stays the gateway: it keeps the connections, checks
+seq ids and symbols, routes messages to the owning workers (`Router`)
+and sends out the messages they return (see `server.execute()`).
+"""
+
+from collections import deque
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from . import engine
+from .database import in_memory
+from .journal import journal
+from . import latency
+from . import models
+from . import persistence
+from . import server
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(symbol, count):
+    """The index of the worker owning a symbol (stable across runs).
+
+    :param str symbol: Symbol.
+    :param int count: Number of the workers.
+    :rtype: int
+    """
+
+    return zlib.crc32(symbol.encode('utf-8')) % count
+
+
+class Worker:
+    """Steps of the loop of a process matching commands (a shard worker
+    or the matching process of `gateways`): starting the engine, holding
+    the results until they are committed, checkpoints and archiving.
+    """
+
+    def __init__(self, recover):
+        """Loads or recovers the books, opens the journal.
+
+        :param bool recover: Rebuild the books from the snapshot and
+            the journal (instead of the DB)?
+        """
+
+        self.last_participant = engine.start(recover)
+        """The last participant id known by the process."""
+
+        self.pending = deque()
+        """(barrier or None, replies, datastream) waiting for being
+        committed."""
+
+        self.checkpoint_at = time.monotonic() + settings.SNAPSHOT_INTERVAL
+        self.archive_at = time.monotonic() + (settings.ARCHIVE_INTERVAL or 0)
+
+    def done(self, replies, datastream):
+        """Holds results of commands until their changes are committed
+        (just until flushed to the journal unless `PERSISTENCE_MODE`
+        is sync).
+        """
+
+        journal.flush()
+        barrier = persistence.writer.barrier()
+        if settings.PERSISTENCE_MODE != 'sync':
+            barrier = None
+        self.pending.append((barrier, replies, datastream))
+
+    def committed(self):
+        """Takes the results committed so far, in order (replies
+        of failed commits become 'Not committed.' errors).
+
+        :returns: (replies, datastream) pairs
+        :rtype: list
+        """
+
+        committed = []
+        while self.pending and (self.pending[0][0] is None
+                                or self.pending[0][0].done()):
+            barrier, replies, datastream = self.pending.popleft()
+            if barrier is not None and barrier.exception():
+                replies = [(participant_id, {'error': 'Not committed.'})
+                           for participant_id
+                           in {pid for pid, msg in replies}]
+                datastream = []
+            committed.append((replies, datastream))
+        return committed
+
+    def housekeeping(self):
+        """Checkpoints the books and archives orders when it's time."""
+
+        if settings.SNAPSHOT_PATH and journal.path \
+                and time.monotonic() > self.checkpoint_at:
+            finish = engine.checkpoint()
+            if finish:
+                threading.Thread(target=finish).start()
+            self.checkpoint_at = \
+                time.monotonic() + settings.SNAPSHOT_INTERVAL
+
+        if settings.ARCHIVE_INTERVAL and time.monotonic() > self.archive_at:
+            persistence.archive(settings.ARCHIVE_BATCH_SIZE)
+            self.archive_at = time.monotonic() + settings.ARCHIVE_INTERVAL
+
+    def stop(self):
+        """Waits for the changes being written, closes the journal."""
+
+        persistence.writer.stop()
+        journal.close()
+
+
+def _serve(index, count, commands, results, recover):
+    """Main loop of a worker process.
+
+    :param int index: Shard index.
+    :param int count: Number of the workers.
+    :param multiprocessing.Queue commands: Incoming commands, `None` stops.
+    :param multiprocessing.connection.Connection results: Outgoing
+        (replies, datastream messages), in the order of the commands,
+        preceded by the last participant id known by the worker.
+    :param bool recover: Rebuild the books from the snapshot and
+        the journal (instead of the DB)?
+    """
+
+    if settings.JOURNAL_PATH:
+        journal.path = '%s.%d' % (settings.JOURNAL_PATH, index)
+    if settings.SNAPSHOT_PATH:
+        settings.SNAPSHOT_PATH = '%s.%d' % (settings.SNAPSHOT_PATH, index)
+    if in_memory:
+        models.create_db()
+
+    persistence.partition_ids(count, index)
+    worker = Worker(recover)
+    # the last participant id for the gateway's ids, the price levels
+    # for its snapshots
+    results.send(worker.last_participant)
+    results.send(([], server._book_messages()))
+
+    while True:
+        try:
+            command = commands.get(
+                timeout=0.001 if worker.pending else 0.1)
+        except queue.Empty:
+            command = False
+        if command is None:
+            break
+
+        if command:
+            action, participant_id, message = command
+            if action == 'latency':
+                latency.dump()
+                continue
+            if action == 'message':
+                worker.done(*server.execute(message, participant_id))
+            else:
+                worker.done([], server.disconnect(participant_id))
+
+        for done in worker.committed():
+            results.send(done)
+        worker.housekeeping()
+
+    worker.stop()
+
+
+class Router:
+    """Starts the worker processes and routes messages to them
+    (from the event loop of the server).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        """Number of the workers."""
+
+        self.commands = []
+        """Queues of commands of the workers."""
+
+        self.results = []
+        """Connections receiving results of the workers."""
+
+        self.processes = []
+        self.loop = None
+
+    def start(self, loop, recover=False):
+        """Starts the workers, their results are handled by the loop.
+
+        :param asyncio.AbstractEventLoop loop: Event loop of the server.
+        :param bool recover: Should the workers recover their books?
+        """
+
+        self.loop = loop
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.count):
+            commands = context.Queue()
+            receiving, sending = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_serve, name='shard-%d' % index, daemon=True,
+                args=(index, self.count, commands, sending, recover))
+            process.start()
+            sending.close()
+
+            self.commands.append(commands)
+            self.results.append(receiving)
+            self.processes.append(process)
+
+        # new participants follow the ones the workers know of, even if
+        # recovered (the DB may lag behind)
+        last = max(receiving.recv() for receiving in self.results)
+        persistence.seed_ids(models.Participant, last)
+        for receiving in self.results:
+            loop.add_reader(receiving.fileno(), self._receive, receiving)
+        logger.info('Started %d shard workers' % self.count)
+
+    def stop(self):
+        """Stops the workers (after processing all the commands)."""
+
+        for commands, receiving in zip(self.commands, self.results):
+            self.loop.remove_reader(receiving.fileno())
+            commands.put(None)
+        for process in self.processes:
+            process.join()
+
+    def submit(self, symbol, participant_id, message):
+        """Routes a message to the worker owning its symbol.
+
+        :param str symbol: Symbol of the message.
+        :param int participant_id: Primary key of the participant.
+        :param dict message: Message of the participant.
+        """
+
+        self.commands[shard_of(symbol, self.count)].put(
+            ('message', participant_id, message))
+
+    def disconnect(self, participant_id):
+        """Makes all the workers cancel orders of a participant."""
+
+        for commands in self.commands:
+            commands.put(('disconnect', participant_id, None))
+
+    def dump_latency(self):
+        """Makes all the workers log the latency of their stages."""
+
+        for commands in self.commands:
+            commands.put(('latency', None, None))
+
+    def _receive(self, receiving):
+        while receiving.poll():
+            try:
+                replies, datastream = receiving.recv()
+            except EOFError:
+                logger.error('A shard worker is gone')
+                self.loop.remove_reader(receiving.fileno())
+                return
+            server._dispatch(replies, datastream)
+        server._flush()
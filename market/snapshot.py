@@ -0,0 +1,128 @@
+"""Compact snapshots of the book for a fast restart.
+
+A snapshot is a header followed by fixed-width records (`journal.ORDER`)
+of all the resting orders, in their priority order. It is loaded through
+`mmap`, without the ORM, and only the journal records following it have
+to be replayed.
+
+A checkpoint captures the book on the event loop and rotates the journal
+at the same moment, the snapshot file is then written elsewhere.
+The previous journal file is dropped once the snapshot is safely written.
+"""
+
+from itertools import chain
+import logging
+import mmap
+import os
+import struct
+
+from .book import RestingOrder
+from .journal import ORDER, order_values, record_values
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'WOODSNP4'
+
+# magic, journal seq, number of orders,
+# last order, participant and execution ids
+_header = struct.Struct('<8sQQQQQ')
+
+
+def capture(books):
+    """Captures all the orders of the books, in their priority order.
+
+    :param book.Registry books: The books.
+    :returns: List of record values.
+    """
+
+    return [record_values(order)
+            for book in books.values()
+            for order in chain(chain.from_iterable(book.bids),
+                               chain.from_iterable(book.asks),
+                               book.market_buys,
+                               book.market_sells)]
+
+
+def write(path, seq, records, last_ids):
+    """Writes a snapshot (atomically, the file is replaced at the end).
+
+    :param str path: Snapshot file.
+    :param int seq: The last journal seq covered by the snapshot.
+    :param list records: As returned by `capture()`.
+    :param tuple last_ids: The last assigned primary keys of orders,
+        participants and executions.
+    """
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_header.pack(MAGIC, seq, len(records), *last_ids))
+        for values in records:
+            f.write(ORDER.pack(*values))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    logger.info('Snapshot of %d orders at seq %d written'
+                % (len(records), seq))
+
+
+def load(path):
+    """Loads a snapshot.
+
+    :param str path: Snapshot file.
+    :returns: (seq, list of book.RestingOrder, last ids as for `write()`),
+        or `None` if there is no snapshot.
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, seq, count, *last_ids = _header.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('%s is not a snapshot' % path)
+
+        end = _header.size + count * ORDER.size
+        with memoryview(data)[_header.size:end] as records:
+            orders = [RestingOrder(**order_values(values))
+                      for values in ORDER.iter_unpack(records)]
+
+    return seq, orders, tuple(last_ids)
+
+
+def discard(path):
+    """Keeps a snapshot of a previous run aside (suffix `.old`).
+
+    :param str path: Snapshot file.
+    """
+
+    if path and os.path.exists(path):
+        logger.warning('Moving aside the snapshot %s' % path)
+        os.replace(path, path + '.old')
+
+
+def checkpoint(books, journal, path, last_ids):
+    """Captures the books and rotates the journal.
+
+    :param book.Registry books: The books.
+    :param journal.Journal journal: The (open) journal.
+    :param str path: Snapshot file.
+    :param tuple last_ids: As for `write()`.
+    :returns: A function writing the snapshot and dropping the previous
+        journal file (can be run in another thread), or `None` if the
+        previous checkpoint has not finished yet.
+    """
+
+    journal.flush()
+    seq = journal.seq
+    if not journal.rotate():
+        logger.warning('Skipping a checkpoint, the previous one is not done')
+        return None
+    records = capture(books)
+
+    def finish():
+        write(path, seq, records, last_ids)
+        journal.drop_previous()
+
+    return finish
@@ -0,0 +1,63 @@
+"""Fixed-point prices.
+
+Inside the market (books, engine, journal, DB) prices are integers,
+numbers of ticks of the symbol (`settings.TICK_SIZES`,
+`settings.TICK_SIZE`), so comparing and sorting them is cheap.
+They are converted only in messages.
+"""
+
+from decimal import Decimal
+
+from . import settings
+
+
+#: Tick sizes of the symbols seen so far (mapping symbol -> Decimal).
+_sizes = {}
+
+
+def tick_size(symbol):
+    """The tick size of a symbol.
+
+    :rtype: decimal.Decimal
+    """
+
+    size = _sizes.get(symbol)
+    if size is None:
+        size = Decimal(str(settings.TICK_SIZES.get(symbol,
+                                                   settings.TICK_SIZE)))
+        _sizes[symbol] = size
+    return size
+
+
+def to_ticks(symbol, price):
+    """Converts a price of a message to ticks.
+
+    :param str symbol: Symbol.
+    :param price: Price (int, float or Decimal).
+    :rtype: int
+    :raises ValueError: If the price is not a multiple of the tick size.
+    :raises decimal.InvalidOperation: If the price is not finite, or too
+        large for the precision of the decimal context.
+    """
+
+    ticks, rest = divmod(Decimal(str(price)), tick_size(symbol))
+    if rest:
+        raise ValueError('%s is not a multiple of the tick size of %s'
+                         % (price, symbol))
+    return int(ticks)
+
+
+def to_price(symbol, ticks):
+    """Converts ticks to a price for a message.
+
+    :param str symbol: Symbol.
+    :param int ticks: Price in ticks (or `None`).
+    :returns: int if the price is whole, Decimal otherwise (or `None`).
+    """
+
+    if ticks is None:
+        return None
+    price = ticks * tick_size(symbol)
+    if price == price.to_integral_value():
+        return int(price)
+    return price.normalize()
@@ -0,0 +1,195 @@
+"""Binary wire protocol of the participant channel.
+
+An alternative to JSON lines for high-frequency participants: messages
+of fixed layouts (little endian) packed by `struct`, so neither parsing
+nor encoding touches JSON. A connection speaks it once its first bytes
+are `MAGIC`, the server acknowledges it by sending `MAGIC` back (a server
+without the binary protocol replies with a JSON error instead).
+
+Each message starts with its type (one byte), the rest of the layout
+follows from it. Messages are decoded to (and encoded from) the same
+dicts as the JSON ones, so they mean the same (see `server.process()`):
+
+- `createOrder` (`CREATE`, type `C`): symbol (16 bytes, padded by
+  zero bytes, empty for `settings.DEFAULT_SYMBOL`), seqId (0 if not
+  checked), orderId, side (index in `SIDES` + 1), price (ticks, ignored
+  by market orders), quantity,
+- `cancelOrder` (`CANCEL`, type `X`): symbol, seqId, orderId,
+- `executionReport` (`REPORT`, type `R`): symbol, seqId, orderId,
+  report (index in `REPORTS` + 1), price (ticks, 0 if none), quantity
+  (0 if none),
+- error (`ERROR`, type `E`): seqId, length of the text, the text
+  (UTF-8).
+"""
+
+import struct
+
+from . import settings
+from .ticks import to_price, to_ticks
+
+
+MAGIC = b'WOODBIN1'
+"""The first bytes of a connection speaking the binary protocol."""
+
+SIDES = ['BUY', 'SELL', 'MARKET_BUY', 'MARKET_SELL']
+
+REPORTS = ['NEW', 'CANCELED', 'FILL']
+
+CREATE = struct.Struct('<c16sIqBqq')
+"""Layout of `createOrder`."""
+
+CANCEL = struct.Struct('<c16sIq')
+"""Layout of `cancelOrder`."""
+
+REPORT = struct.Struct('<c16sIqBqq')
+"""Layout of `executionReport`."""
+
+ERROR = struct.Struct('<cIH')
+"""Layout of an error (followed by its text)."""
+
+_layouts = {b'C': CREATE, b'X': CANCEL}
+_actions = {b'C': 'createOrder', b'X': 'cancelOrder'}
+
+
+def split(data):
+    """Splits received data into messages (of participants).
+
+    :param bytes data: Received data.
+    :returns: (list of complete messages, the incomplete rest).
+        An unknown type can't be skipped, the rest of the data is
+        returned as one (bad) message then.
+    """
+
+    messages = []
+    start = 0
+    while start < len(data):
+        layout = _layouts.get(data[start:start + 1])
+        if layout is None:
+            messages.append(data[start:])
+            return messages, b''
+        end = start + layout.size
+        if end > len(data):
+            break
+        messages.append(data[start:end])
+        start = end
+    return messages, data[start:]
+
+
+def decode(data):
+    """Decodes a message of a participant.
+
+    :param bytes data: A message (as split by `split()`).
+    :returns: The message (as if it were JSON).
+    :rtype: dict
+    :raises ValueError: If it's not a known message.
+    """
+
+    kind = data[:1]
+    layout = _layouts.get(kind)
+    if layout is None or len(data) != layout.size:
+        raise ValueError('Unknown message: %r' % data[:1])
+
+    fields = layout.unpack(data)
+    message = {'message': _actions[kind], 'orderId': fields[3]}
+    symbol = fields[1].rstrip(b'\0').decode('ascii', 'replace')
+    if symbol:
+        message['symbol'] = symbol
+    if fields[2]:
+        message['seqId'] = fields[2]
+    if layout is CREATE:
+        side, price, quantity = fields[4:]
+        message['side'] = SIDES[side - 1] if 0 < side <= len(SIDES) \
+            else None
+        message['quantity'] = quantity
+        if message['side'] in ['BUY', 'SELL']:
+            message['price'] = to_price(symbol or settings.DEFAULT_SYMBOL,
+                                        price)
+    return message
+
+
+def encode(msg):
+    """Encodes a message for a participant.
+
+    :param dict msg: An execution report or an error (with `seqId`).
+    :rtype: bytes
+    """
+
+    if 'error' in msg:
+        text = msg['error'].encode('utf-8')
+        return ERROR.pack(b'E', msg['seqId'], len(text)) + text
+
+    symbol = msg['symbol']
+    price = msg.get('price')
+    return REPORT.pack(
+        b'R', symbol.encode('ascii'), msg['seqId'], msg['orderId'],
+        REPORTS.index(msg['report']) + 1,
+        0 if price is None else to_ticks(symbol, price),
+        msg.get('quantity', 0))
+
+
+def read(data):
+    """Splits data received from the server into messages
+    (for clients).
+
+    :param bytes data: Received data (without `MAGIC`).
+    :returns: (list of decoded messages, the incomplete rest).
+    """
+
+    messages = []
+    while data:
+        kind = data[:1]
+        if kind == b'R':
+            if len(data) < REPORT.size:
+                break
+            fields = REPORT.unpack_from(data)
+            symbol = fields[1].rstrip(b'\0').decode('ascii')
+            msg = {
+                'message': 'executionReport',
+                'symbol': symbol,
+                'orderId': fields[3],
+                'report': REPORTS[fields[4] - 1],
+                'seqId': fields[2],
+            }
+            if msg['report'] == 'FILL':
+                msg['price'] = to_price(symbol, fields[5])
+                msg['quantity'] = fields[6]
+            size = REPORT.size
+        elif kind == b'E':
+            if len(data) < ERROR.size:
+                break
+            kind, seq_id, length = ERROR.unpack_from(data)
+            size = ERROR.size + length
+            if len(data) < size:
+                break
+            msg = {'error': data[ERROR.size:size].decode('utf-8'),
+                   'seqId': seq_id}
+        else:
+            raise ValueError('Unknown message: %r' % kind)
+        messages.append(msg)
+        data = data[size:]
+    return messages, data
+
+
+def create_order(order_id, side, price, quantity, symbol='', seq_id=0):
+    """Encodes `createOrder` (for clients).
+
+    :param int order_id: Order's code.
+    :param str side: One of `SIDES`.
+    :param int price: Price in ticks (0 for market orders).
+    :param int quantity: Quantity.
+    :param str symbol: Symbol (empty for the default one).
+    :param int seq_id: Seq id (0 if not checked).
+    :rtype: bytes
+    """
+
+    return CREATE.pack(b'C', symbol.encode('ascii'), seq_id, order_id,
+                       SIDES.index(side) + 1, price, quantity)
+
+
+def cancel_order(order_id, symbol='', seq_id=0):
+    """Encodes `cancelOrder` (for clients), see `create_order()`.
+
+    :rtype: bytes
+    """
+
+    return CANCEL.pack(b'X', symbol.encode('ascii'), seq_id, order_id)
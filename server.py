@@ -12,12 +12,17 @@ arg_parser = argparse.ArgumentParser(
 )
 arg_parser.add_argument('--create-db', action='store_true',
                         help='Creates DB schema.')
+arg_parser.add_argument('--recover', action='store_true',
+                        help='Rebuilds the order book from the snapshot '
+                             'and the journal.')
 arg_parser.add_argument('--host', nargs='?', default='localhost',
                         help='Listen as, default is localhost.')
 arg_parser.add_argument('--port', nargs='?', default=7001, type=int,
                         help='Listen on, default is 7001.')
 arg_parser.add_argument('--port-datastream', nargs='?', default=7002, type=int,
                         help='Datastream listen on, default is 7002.')
+arg_parser.add_argument('--port-conflated', type=int,
+                        help='Conflated datastream listen on, optional.')
 
 
 if __name__ == '__main__':
@@ -26,4 +31,5 @@ if __name__ == '__main__':
     if args.create_db:
         models.create_db()
 
-    run(args.host, args.port, args.port_datastream)
+    run(args.host, args.port, args.port_datastream, args.recover,
+        args.port_conflated)
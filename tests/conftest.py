@@ -3,7 +3,9 @@ import pytest
 from market import settings
 settings.DB_URL = 'sqlite:///:memory:'
 
-from market import models
+from market import engine, models, persistence, server
+from market.database import db_session
+from market.journal import journal as market_journal
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -14,6 +16,39 @@ def db_prepare():
 
 @pytest.yield_fixture(scope='function', autouse=True)
 def db_clean():
-    """Removes all the orders after each test."""
+    """Removes all the orders (and executions) after each test."""
     yield
+    persistence.writer.flush()
+    models.ExecutionHistory.query.delete()
+    models.OrderHistory.query.delete()
+    models.Execution.query.delete()
     models.Order.query.delete()
+    db_session.commit()
+    engine.books.clear()
+
+
+@pytest.yield_fixture(scope='function', autouse=True)
+def server_clean():
+    """Forgets the clients (and their messages) of each test,
+    their event loop is closed afterwards."""
+    yield
+    server.participants.clear()
+    del server.watchers[:]
+    del server.conflated_watchers[:]
+    server.conflated.clear()
+    del server.outbox[:]
+    server.datastream_seq_id = 0
+    server.levels.clear()
+
+
+@pytest.yield_fixture
+def journal(tmpdir, monkeypatch):
+    """The market's journal writing to a temporary file."""
+
+    journal = market_journal
+    monkeypatch.setattr(journal, 'path', str(tmpdir.join('journal.bin')))
+    monkeypatch.setattr(journal, 'offset', None)
+    monkeypatch.setattr(journal, 'seq', 0)
+    journal.open()
+    yield journal
+    journal.close()
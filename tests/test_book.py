@@ -0,0 +1,163 @@
+from collections import namedtuple
+
+from market.book import OrderBook, Registry, RestingOrder
+
+
+Order = namedtuple('Order', ['side', 'price', 'code', 'quantity',
+                             'participant_id'])
+Order.__new__.__defaults__ = (1, None)
+
+
+def test_empty():
+    """Tests an empty book."""
+
+    book = OrderBook()
+    assert book.best_bid() is None
+    assert book.best_ask() is None
+    assert book.market_buys.first() is None
+
+
+def test_best_prices():
+    """Tests finding the best prices on both sides."""
+
+    book = OrderBook()
+    for price in [145, 142, 144]:
+        book.add(Order('buy', price, price))
+    for price in [151, 149, 156]:
+        book.add(Order('sell', price, price))
+
+    assert book.best_bid().price == 145
+    assert book.best_ask().price == 149
+    assert [level.price for level in book.bids] == [145, 144, 142]
+    assert [level.price for level in book.asks] == [149, 151, 156]
+
+
+def test_time_priority():
+    """Tests FIFO of a price level."""
+
+    book = OrderBook()
+    first, second = Order('buy', 145, 1), Order('buy', 145, 2)
+    book.add(first)
+    book.add(second)
+    assert book.best_bid() is first
+
+    book.remove(first)
+    assert book.best_bid() is second
+
+
+def test_reduce():
+    """Tests reducing an order in place, keeping its priority."""
+
+    book = OrderBook()
+    first = RestingOrder(1, 'WOOD', 1, None, 'sell', 149, 100)
+    book.add(first)
+    book.add(RestingOrder(2, 'WOOD', 2, None, 'sell', 149, 50))
+    book.pop_changes()
+
+    book.reduce(first, 30)
+    assert book.best_ask() is first
+    assert first.quantity == 70
+    assert book.pop_changes() == [('ask', 149, 120)]
+
+    book.reduce(first, 70)
+    assert first.quantity == 0
+    assert book.best_ask().code == 2
+    assert book.pop_changes() == [('ask', 149, 50)]
+    assert book.find(None, 1) is None
+
+
+def test_remove_level():
+    """Tests that an emptied price level disappears."""
+
+    book = OrderBook()
+    best, other = Order('sell', 149, 1), Order('sell', 151, 2)
+    book.add(best)
+    book.add(other)
+
+    book.remove(best)
+    assert book.best_ask() is other
+    assert len(book.asks) == 1
+
+    book.remove(other)
+    assert book.best_ask() is None
+
+
+def test_market_orders():
+    """Tests queueing MARKET orders."""
+
+    book = OrderBook()
+    first, second = Order('market_buy', None, 1), Order('market_buy', None, 2)
+    book.add(first)
+    book.add(second)
+    assert book.market_buys.first() is first
+    assert book.best_bid() is None
+
+    book.clear()
+    assert book.market_buys.first() is None
+
+
+def test_depth():
+    """Tests maintaining total quantities of price levels."""
+
+    book = OrderBook()
+    first = Order('buy', 145, 1, 100)
+    book.add(first)
+    book.add(Order('buy', 145, 2, 200))
+    book.add(Order('buy', 144, 3, 300))
+    book.add(Order('sell', 149, 4, 500))
+    assert book.bids.quantity(145) == 300
+    assert book.pop_changes() == [('bid', 145, 300), ('bid', 144, 300),
+                                  ('ask', 149, 500)]
+    assert book.pop_changes() == []
+
+    book.remove(first)
+    assert book.pop_changes() == [('bid', 145, 200)]
+
+    book.remove(book.best_ask())
+    assert book.pop_changes() == [('ask', 149, 0)]
+
+
+def test_index():
+    """Tests finding orders by their owners and codes."""
+
+    book = OrderBook()
+    order = Order('buy', 145, 1, 100, 7)
+    book.add(order)
+    book.add(Order('sell', 149, 1, 100, 8))
+    book.add(Order('market_sell', None, 2, 100, 7))
+
+    assert book.find(7, 1) is order
+    assert book.find(8, 2) is None
+    assert book.find(9, 1) is None
+    assert sorted(o.code for o in book.orders_of(7)) == [1, 2]
+
+    book.remove(order)
+    assert book.find(7, 1) is None
+    assert len(book.orders_of(7)) == 1
+
+
+def test_registry():
+    """Tests books of several symbols."""
+
+    books = Registry()
+    books['WOOD'].add(Order('buy', 145, 1, 100, 7))
+    books['ACME'].add(Order('sell', 10, 1, 50, 7))
+    books['IDLE']
+
+    assert books['WOOD'].symbol == 'WOOD'
+    assert books['ACME'].best_bid() is None
+    assert len(books.orders_of(7)) == 2
+    assert list(books.holders[7]) == [books['WOOD'], books['ACME']]
+    assert books.find('ACME', 7, 1).price == 10
+    assert books.find('NONE', 7, 1) is None
+    assert 'NONE' not in books
+    assert sorted(books.pop_changes()) == [('ACME', 'ask', 10, 50),
+                                           ('WOOD', 'bid', 145, 100)]
+    assert books.pop_changes() == []
+
+    books['ACME'].remove(books.find('ACME', 7, 1))
+    assert list(books.holders[7]) == [books['WOOD']]
+
+    books.clear()
+    assert books.orders_of(7) == []
+    assert books.holders == {}
@@ -0,0 +1,83 @@
+from decimal import Decimal
+
+import simplejson as json
+
+from market import codecs, wire
+
+
+MESSAGES = [{
+    'message': 'executionReport',
+    'symbol': 'WOOD',
+    'orderId': 5,
+    'report': 'NEW',
+    'seqId': 1,
+}, {
+    'message': 'executionReport',
+    'symbol': 'WOOD',
+    'orderId': 5,
+    'report': 'CANCELED',
+    'seqId': 2,
+}, {
+    'message': 'executionReport',
+    'symbol': 'ACME "A"',
+    'orderId': 12345678901,
+    'report': 'FILL',
+    'price': Decimal('100.05'),
+    'quantity': 3,
+    'seqId': 3,
+}, {
+    'type': 'orderbook',
+    'symbol': 'WOOD',
+    'side': 'bid',
+    'price': 149,
+    'quantity': 0,
+    'seqId': 4,
+}, {
+    'type': 'trade',
+    'symbol': 'WOOD',
+    'time': 1461700000.123456,
+    'price': 149.5,
+    'quantity': 10,
+    'seqId': 5,
+}, {
+    'error': 'Bad seq id, expected 1',
+    'seqId': 6,
+}, {
+    'type': 'snapshot',
+    'seqId': 7,
+    'levels': [],
+}, {
+    'message': 'executionReport',
+    'report': ['unusual'],
+    'seqId': 8,
+}]
+
+
+def test_json():
+    """Tests that the specialized encoders make the same JSON
+    as the generic one."""
+
+    for msg in MESSAGES:
+        assert codecs.JSON.encode(msg) == \
+            json.dumps(msg).encode('utf-8') + b'\n'
+    # they are used indeed
+    assert codecs.JSON.encoders[tuple(MESSAGES[0]), 'NEW'] \
+        is codecs._new_report
+
+    data = b''.join(codecs.JSON.encode(msg) for msg in MESSAGES)
+    messages, rest = codecs.JSON.read(data + b'{"type"')
+    assert messages == json.loads(json.dumps(MESSAGES))
+    assert rest == b'{"type"'
+
+
+def test_binary():
+    """Tests the binary codec (of participants)."""
+
+    codec = codecs.CODECS['binary']
+    messages, rest = codec.split(wire.cancel_order(5) + b'C')
+    assert rest == b'C'
+    assert codec.decode(messages[0]) == {'message': 'cancelOrder',
+                                        'orderId': 5}
+    assert codec.read(b''.join(codec.encode(msg)
+                               for msg in MESSAGES[:3])) == \
+        (MESSAGES[:3], b'')
@@ -1,40 +1,70 @@
 from datetime import datetime, timedelta
 from functools import partial
+from itertools import count
 
+from market.book import RestingOrder
 from market.database import db_session
 from market import engine
 from market import factories
+from market import models
+from market import persistence
 
 import test_models
 
 
+codes = count(1)
+
+
+def order(side, price, quantity, symbol='WOOD'):
+    """A new (unsaved) order."""
+
+    return RestingOrder(None, symbol, next(codes), None, side, price,
+                        quantity)
+
+
+def incoming(**kwargs):
+    """Saves and matches a new order."""
+
+    new = order(**kwargs)
+    persistence.save_order(new)
+    return engine.match(new)
+
+
 def test_empty():
     """Test engine when there are no orders."""
-    assert engine.trade() is False
+
+    assert incoming(side='buy', price=145, quantity=100) == []
+    assert engine.book.best_bid().price == 145
 
 
 def test_match():
     """Test basic matching."""
 
     test_models.test_table()
-    factories.Order(side='sell', quantity=350, price=144)
-    db_session.commit()
 
-    trade1 = engine.trade()
+    trade1, trade2, trade3 = incoming(side='sell', quantity=350, price=144)
     assert trade1['price'] == 145
     assert trade1['quantity'] == 100
-    assert trade1['buy'].traded_to == trade1['sell']
+    assert trade1['buy'].filled == 100
+    assert trade1['buy'].quantity == 0
+    assert trade3['sell'].filled == 350
+
+    persistence.writer.flush()
+    executions = models.Execution.query.order_by(models.Execution.id).all()
+    assert [(e.buy_order_id, e.sell_order_id, e.price, e.quantity)
+            for e in executions] == \
+           [(t['buy'].id, t['sell'].id, t['price'], t['quantity'])
+            for t in [trade1, trade2, trade3]]
+    saved = models.Order.query.filter_by(id=trade3['buy'].id).one()
+    assert (saved.active, saved.quantity, saved.remaining_quantity,
+            saved.filled_quantity) == (True, 300, 250, 50)
 
-    trade2 = engine.trade()
     assert trade2['price'] == 145
     assert trade2['quantity'] == 200
 
-    trade3 = engine.trade()
     assert trade3['price'] == 144
     assert trade3['quantity'] == 50
 
-    assert engine.trade() is False
-
 
 def test_no_buys():
     """Test a case when there are no buying orders."""
@@ -45,7 +75,8 @@ def test_no_buys():
     s(price=151, quantity=300)
     db_session.commit()
 
-    assert engine.trade() is False
+    assert incoming(side='sell', price=140, quantity=100) == []
+    assert incoming(side='market_sell', price=None, quantity=100) == []
 
 
 def test_no_sells():
@@ -57,69 +88,40 @@ def test_no_sells():
     b(price=144, quantity=300)
     db_session.commit()
 
-    assert engine.trade() is False
+    assert incoming(side='buy', price=150, quantity=100) == []
+    assert incoming(side='market_buy', price=None, quantity=100) == []
 
 
 def test_correct_order():
-    """Tests correct matching by both a creation time and a price."""
+    """Tests correct matching by both a price and a creation time."""
 
     now = datetime.now()
 
     s = partial(factories.Order, side='sell')
     sell1 = s(price=100, quantity=10, registered_at=now - timedelta(minutes=2))
-    sell2 = s(price=90, quantity=5, registered_at=now - timedelta(minutes=1))
+    sell2 = s(price=90, quantity=5, registered_at=now - timedelta(minutes=2))
     sell3 = s(price=80, quantity=5, registered_at=now - timedelta(minutes=1))
-
-    b = partial(factories.Order, side='buy')
-    buy1 = b(price=110, quantity=5, registered_at=now - timedelta(minutes=2))
-    buy2 = b(price=100, quantity=10, registered_at=now - timedelta(minutes=1))
-    buy3 = b(price=120, quantity=10, registered_at=now - timedelta(minutes=1))
+    sell4 = s(price=90, quantity=5, registered_at=now - timedelta(minutes=1))
 
     db_session.commit()
 
-    trade1 = engine.trade()
+    trade1, trade2 = incoming(side='buy', price=120, quantity=10)
     assert trade1['sell'].code == sell3.code
-    assert trade1['buy'].code == buy3.code
     assert trade1['price'] == 120
     assert trade1['quantity'] == 5
-
-    trade2 = engine.trade()
     assert trade2['sell'].code == sell2.code
-    assert trade2['buy'].code == buy3.code
     assert trade2['price'] == 120
     assert trade2['quantity'] == 5
 
-    trade3 = engine.trade()
-    assert trade3['sell'].code == sell1.code
-    assert trade3['buy'].code == buy1.code
-    assert trade3['price'] == 110
+    trade3, trade4 = incoming(side='buy', price=100, quantity=10)
+    assert trade3['sell'].code == sell4.code
+    assert trade3['price'] == 100
     assert trade3['quantity'] == 5
-
-    trade4 = engine.trade()
     assert trade4['sell'].code == sell1.code
-    assert trade4['buy'].code == buy2.code
     assert trade4['price'] == 100
     assert trade4['quantity'] == 5
 
-    assert engine.trade() is False
-
-
-def test_decimal():
-    """Tests working with Decimals."""
-
-    s = partial(factories.Order, side='sell')
-    s(price=100.5, quantity=500)
-
-    b = partial(factories.Order, side='buy')
-    b(price=100.5, quantity=100)
-
-    db_session.commit()
-
-    trade = engine.trade()
-    assert trade['price'] == 100.5
-    assert trade['quantity'] == 100
-
-    assert engine.trade() is False
+    assert incoming(side='buy', price=90, quantity=10) == []
 
 
 def test_deactivated_participant():
@@ -130,47 +132,121 @@ def test_deactivated_participant():
     s = partial(factories.Order, side='sell')
     s(price=100, quantity=500, participant=participant)
 
-    b = partial(factories.Order, side='buy')
-    b(price=100, quantity=100)
-
     db_session.commit()
 
     participant.deactivate()
 
-    assert engine.trade() is False
+    assert incoming(side='buy', price=100, quantity=100) == []
 
 
 def test_market_order_sell():
     """Tests matching MARKER sell orders."""
 
     test_models.test_table()
-    factories.Order(side='market_sell', quantity=170, price=None)
-    db_session.commit()
 
-    trade1 = engine.trade()
+    trade1, trade2 = incoming(side='market_sell', quantity=170, price=None)
     assert trade1['quantity'] == 100
     assert trade1['price'] == 145
 
-    trade2 = engine.trade()
     assert trade2['quantity'] == 70
     assert trade2['price'] == 145
 
-    assert engine.trade() is False
-
 
 def test_market_order_buy():
     """Tests matching MARKER buy orders."""
 
     test_models.test_table()
-    factories.Order(side='market_buy', quantity=602, price=None)
-    db_session.commit()
 
-    trade1 = engine.trade()
+    trade1, trade2 = incoming(side='market_buy', quantity=602, price=None)
     assert trade1['quantity'] == 500
     assert trade1['price'] == 149
 
-    trade2 = engine.trade()
     assert trade2['quantity'] == 102
     assert trade2['price'] == 151
 
-    assert engine.trade() is False
+
+def test_match_sweep():
+    """Tests sweeping an incoming order through several price levels."""
+
+    test_models.test_table()
+    persistence.writer.flush()
+    rows = models.Order.query.count()
+
+    sell = order('sell', 144, 350)
+    persistence.save_order(sell)
+
+    trades = engine.match(sell)
+    assert [(t['price'], t['quantity']) for t in trades] == \
+           [(145, 100), (145, 200), (144, 50)]
+    assert all(t['sell'] is sell for t in trades)
+
+    # resting orders are filled in place, no new rows
+    persistence.writer.flush()
+    assert models.Order.query.count() == rows + 1
+    assert models.Execution.query.count() == 3
+    assert engine.book.best_bid().price == 144
+    assert engine.book.best_bid().quantity == 250
+    assert engine.book.best_ask().price == 149
+
+
+def test_match_residual():
+    """Tests that a residual of an incoming order rests in the book."""
+
+    test_models.test_table()
+
+    buy = order('buy', 151, 3500)
+    persistence.save_order(buy)
+
+    trades = engine.match(buy)
+    assert [t['quantity'] for t in trades] == [500, 1000, 300, 1200]
+    assert buy.active
+    assert buy.filled == 3000
+
+    residual = engine.book.best_bid()
+    assert residual is buy
+    assert residual.price == 151
+    assert residual.quantity == 500
+    assert engine.book.best_ask().price == 156
+
+
+def test_match_market_resting():
+    """Tests that a resting MARKET order is matched first."""
+
+    factories.Order(side='market_buy', quantity=50, price=None)
+    factories.Order(side='buy', quantity=50, price=150)
+    db_session.commit()
+
+    sell = order('sell', 140, 80)
+    persistence.save_order(sell)
+
+    trades = engine.match(sell)
+    assert [(t['buy'].side, t['price'], t['quantity']) for t in trades] == \
+           [('market_buy', 140, 50), ('buy', 150, 30)]
+    assert engine.book.best_ask() is None
+
+
+def test_symbols():
+    """Tests that orders of different symbols are not matched."""
+
+    factories.Order(side='sell', symbol='ACME', price=100, quantity=10)
+
+    assert incoming(side='buy', price=110, quantity=10) == []
+
+    trades = incoming(side='buy', symbol='ACME', price=100, quantity=10)
+    assert [(t['symbol'], t['quantity']) for t in trades] == [('ACME', 10)]
+    assert engine.books['ACME'].best_ask() is None
+    assert engine.book.best_bid().price == 110
+
+
+def test_load():
+    """Tests loading compact copies of the active orders from the DB."""
+
+    factories.Order(side='sell', price=149, quantity=500)
+    factories.Order(side='sell', price=150, quantity=500, active=False)
+    persistence.writer.flush()
+
+    engine.load()
+    order = engine.book.best_ask()
+    assert isinstance(order, RestingOrder)
+    assert (order.price, order.quantity) == (149, 500)
+    assert len(engine.book.asks) == 1
@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+
+from market import gateways, persistence, server
+from market.server import Command, ParticipantProtocol, DatastreamProtocol
+
+from test_server import read, send, watch
+
+
+def test_commands():
+    """Tests packing commands into fixed-size records and back."""
+
+    for command in [Command('createOrder', 'WOOD', 5, 'sell', 14900, 10),
+                    Command('createOrder', 'ACME', -1, 'market_buy', None,
+                            3),
+                    Command('cancelOrder', 'WOOD', 5, None, None, None)]:
+        kind = gateways.CREATE if command.action == 'createOrder' \
+            else gateways.CANCEL
+        record = gateways._pack_command(kind, 7, command)
+        assert len(record) == gateways.COMMAND.size
+        assert gateways._unpack_command(record) == (kind, 7, command)
+
+    assert gateways._unpack_command(
+        gateways._pack_command(gateways.DISCONNECT, 7)) == \
+        (gateways.DISCONNECT, 7, None)
+    with pytest.raises(server.MarketException):
+        gateways._pack_command(gateways.CANCEL, 7, Command(
+            'cancelOrder', 'Ω' * 9, 5, None, None, None))
+
+
+def test_results():
+    """Tests packing replies and datastream messages and back."""
+
+    replies = [(7, {
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 5,
+        'report': 'FILL',
+        'price': 149.5,
+        'quantity': 3,
+    }), (8, {'error': 'Order does not exist.'})]
+    for participant_id, msg in replies:
+        kind, pid, unpacked = gateways._unpack_result(
+            gateways._pack_reply(participant_id, msg))
+        assert (pid, unpacked) == (participant_id, msg)
+
+    for msg in [{
+        'type': 'orderbook',
+        'symbol': 'WOOD',
+        'side': 'ask',
+        'price': 150,
+        'quantity': 0,
+    }, {
+        'type': 'trade',
+        'symbol': 'WOOD',
+        'time': 1461700000.5,
+        'price': 150,
+        'quantity': 3,
+    }]:
+        kind, pid, unpacked = gateways._unpack_result(
+            gateways._pack_datastream(msg))
+        assert unpacked == msg
+
+
+@pytest.mark.asyncio
+async def test_gateways(event_loop, unused_tcp_port_factory, monkeypatch):
+    """Tests matching in the matching process (fed by this gateway)."""
+
+    router = gateways.Gateways(1)
+    router.start(event_loop)
+    monkeypatch.setattr(server, 'router', router)
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port,
+                                   reuse_port=True)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    try:
+        reader1, writer1 = await asyncio.open_connection(port=port)
+        reader2, writer2 = await asyncio.open_connection(port=port)
+        datastream, _ = await watch(port_datastream)
+
+        order = {
+            'message': 'createOrder',
+            'orderId': 1,
+            'side': 'SELL',
+            'price': 100.5,
+            'quantity': 10,
+        }
+        await send(writer1, order)
+        assert (await read(reader1))['report'] == 'NEW'
+        await send(writer1, dict(order, orderId='abc'))
+        assert (await read(reader1))['error'] == 'Bad order id.'
+        await send(writer1, dict(order, orderId=2, quantity=2 ** 63))
+        assert (await read(reader1))['error'] == 'Bad number.'
+        await send(writer1, dict(order, orderId=2, price=10 ** 17))
+        assert (await read(reader1))['error'] == 'Bad number.'
+        answer = await read(datastream)
+        assert (answer['price'], answer['quantity']) == (100.5, 10)
+
+        await send(writer2, dict(order, side='BUY', quantity=4))
+        assert (await read(reader2))['report'] == 'NEW'
+        answer = await read(reader2)
+        assert (answer['report'], answer['price'], answer['quantity']) == \
+            ('FILL', 100.5, 4)
+        assert (await read(reader1))['report'] == 'FILL'
+        assert (await read(datastream))['type'] == 'trade'
+        assert (await read(datastream))['quantity'] == 6
+
+        writer1.close()
+        answer = await read(datastream)
+        assert (answer['seqId'], answer['quantity']) == (4, 0)
+    finally:
+        router.stop()
+        persistence.partition_ids(1, 0)
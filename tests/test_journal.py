@@ -0,0 +1,156 @@
+from datetime import datetime
+import struct
+
+import pytest
+
+from market import engine, factories, models, persistence
+from market import journal as journal_module
+from market.book import RestingOrder
+from market.journal import ACCEPTED, CANCELED, EXECUTED, Journal
+
+
+def test_records(tmpdir):
+    """Tests writing and reading all kinds of records."""
+
+    path = str(tmpdir.join('journal.bin'))
+    journal = Journal(path)
+    journal.open()
+
+    order = RestingOrder(1, 'WOOD', 123, 2, 'sell', 10050, 20,
+                         datetime(2016, 4, 27, 12, 0))
+    market = RestingOrder(2, 'ACME', 124, None, 'market_buy', None, 5,
+                          datetime(2016, 4, 27, 12, 1), filled=3)
+    journal.accepted(order)
+    journal.accepted(market)
+    journal.executed({'id': 7, 'price': 10050, 'quantity': 5,
+                      'time': datetime(2016, 4, 27, 12, 2),
+                      'buy': market, 'sell': order})
+    journal.canceled(market)
+    journal.close()
+
+    records = list(Journal(path).read())
+    assert [(seq, event) for seq, event, values in records] == \
+           [(1, ACCEPTED), (2, ACCEPTED), (3, EXECUTED), (4, CANCELED)]
+
+    values = journal_module.order_values(records[0][2])
+    assert values['price'] == 10050
+    assert values['participant_id'] == 2
+    assert values['registered_at'] == order.registered_at
+
+    values = journal_module.order_values(records[1][2])
+    assert values['price'] is None
+    assert values['participant_id'] is None
+    assert values['symbol'] == 'ACME'
+    assert values['side'] == 'market_buy'
+    assert (values['quantity'], values['filled']) == (5, 3)
+
+    assert records[2][2][:5] == (7, 2, 1, 10050, 5)
+
+
+def test_torn_record(tmpdir):
+    """Tests ignoring and cutting off a torn record at the end."""
+
+    path = str(tmpdir.join('journal.bin'))
+    journal = Journal(path)
+    journal.open()
+    journal.canceled(models.Order(id=1))
+    journal.canceled(models.Order(id=2))
+    journal.close()
+
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 1)
+
+    journal = Journal(path)
+    journal.open()
+    assert journal.seq == 1
+    journal.canceled(models.Order(id=3))
+    journal.close()
+
+    assert [values for seq, event, values in Journal(path).read()] == \
+           [(1,), (3,)]
+
+
+def test_bad_record(tmpdir):
+    """Tests that a record failing to pack leaves no gap in seqs."""
+
+    path = str(tmpdir.join('journal.bin'))
+    journal = Journal(path)
+    journal.open()
+    with pytest.raises(struct.error):
+        journal.canceled(models.Order(id=2 ** 70))
+    journal.canceled(models.Order(id=1))
+    journal.close()
+
+    assert [(seq, values) for seq, event, values in Journal(path).read()] \
+           == [(1, (1,))]
+
+
+def test_other_version(tmpdir):
+    """Tests refusing (and keeping) a journal of another format version."""
+
+    path = tmpdir.join('journal.bin')
+    path.write_binary(b'WOODJNL1' + bytes(100))
+
+    with pytest.raises(ValueError):
+        Journal(str(path)).open()
+    assert path.size() == 108
+
+
+def test_recover(journal):
+    """Tests rebuilding the book from the journal."""
+
+    s = lambda **kwargs: factories.Order(side='sell', **kwargs)
+    s(price=149, quantity=500)
+    s(price=151, quantity=1000)
+    canceled = s(price=151, quantity=300)
+    s(price=151, quantity=1200)
+    engine.cancel(canceled)
+
+    buy = RestingOrder(None, 'WOOD', 1, None, 'buy', 151, 700)
+    persistence.save_order(buy)
+    trades = engine.match(buy)
+
+    expected = [(level.price, [(o.id, o.quantity) for o in level])
+                for level in engine.book.asks]
+    journal.flush()
+
+    engine.book.clear()
+    engine.recover()
+
+    assert [(level.price, [(o.id, o.quantity) for o in level])
+            for level in engine.book.asks] == expected
+    assert engine.book.best_ask().quantity == 800
+    assert engine.book.best_bid() is None
+    assert persistence.last_id(models.Execution) == trades[-1]['id']
+
+
+def test_start_recovering(journal):
+    """Tests that new participants follow the recovered ones, even if
+    the DB lags behind."""
+
+    participant_id = persistence.last_id(models.Participant) + 100
+    persistence.save_order(RestingOrder(None, 'WOOD', 7, participant_id,
+                                        'sell', 149, 10))
+    journal.close()
+
+    engine.books.clear()
+    assert engine.start(recovering=True) == participant_id
+    assert persistence.next_id(models.Participant) == participant_id + 1
+    assert engine.books.find('WOOD', participant_id, 7).quantity == 10
+
+
+def test_load_discards(journal):
+    """Tests starting a new journal when loading the book from the DB."""
+
+    factories.Order(side='sell', price=149, quantity=500)
+    persistence.writer.flush()
+    journal.close()
+
+    engine.load()
+    journal.open()
+    assert journal.seq == 0
+    assert engine.book.best_ask().quantity == 500
+    assert [seq for seq, event, values in Journal(journal.path).read()] \
+           == []
+    assert [seq for seq, event, values
+            in Journal(journal.path + journal_module.OLD).read()] == [1]
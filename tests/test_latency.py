@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+
+from market import latency, settings
+from market.latency import Histogram
+from market.server import ParticipantProtocol
+
+from test_server import read, send
+
+
+@pytest.fixture(autouse=True)
+def latency_clean():
+    latency.reset()
+    yield
+    latency.reset()
+
+
+def test_buckets():
+    """Tests that each duration falls into a bucket not exceeding it."""
+
+    for ns in list(range(100)) + [999, 10 ** 6, 123456789, 2 ** 40 + 1]:
+        index = Histogram.bucket(ns)
+        assert Histogram.upper_bound(index - 1) < ns \
+            <= Histogram.upper_bound(index)
+        assert Histogram.upper_bound(index) <= ns * 1.125
+
+
+def test_percentiles():
+    """Tests (approximate) percentiles and exact mean and max."""
+
+    histogram = Histogram()
+    for us in range(1, 1001):
+        histogram.add(us * 1000)
+
+    summary = histogram.summary()
+    assert (summary['count'], summary['mean_us'], summary['max_us']) == \
+           (1000, 500.5, 1000)
+    assert 500 <= summary['p50_us'] <= 500 * 1.125
+    assert 990 <= summary['p99_us'] <= 1000
+    assert Histogram().summary()['p99_us'] == 0
+
+
+def test_record(monkeypatch):
+    """Tests chaining stages and disabling the stats."""
+
+    start = latency.now()
+    end = latency.record('a', start)
+    assert latency.record('b', end) >= end
+    assert latency.histograms['a'].count == 1
+    assert latency.histograms['a'].total == end - start
+
+    monkeypatch.setattr(settings, 'LATENCY_STATS', False)
+    latency.record('c', latency.now())
+    assert 'c' not in latency.histograms
+
+
+@pytest.mark.asyncio
+async def test_stages(event_loop, unused_tcp_port_factory):
+    """Tests measuring the stages of processing a message."""
+
+    port = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    reader, writer = await asyncio.open_connection(port=port)
+
+    for code, side in enumerate(['SELL', 'BUY'], 1):
+        await send(writer, {
+            'message': 'createOrder',
+            'orderId': code,
+            'side': side,
+            'price': 100,
+            'quantity': 10,
+        })
+        assert (await read(reader))['report'] == 'NEW'
+
+    stages = {stage: histogram.count
+              for stage, histogram in latency.histograms.items()}
+    assert stages == {'parse': 2, 'process': 2, 'match': 2, 'dispatch': 2,
+                      'flush': 2, 'commit': 2, 'total': 2}
+    assert latency.histograms['total'].max >= \
+        latency.histograms['commit'].max
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+
+from market import latency, metrics
+from market.server import ParticipantProtocol, DatastreamProtocol
+
+from test_server import read, send, watch
+
+
+def value(text, name):
+    """The value of a metric (a line of the text format)."""
+
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[-1])
+
+
+@pytest.mark.asyncio
+async def test_metrics(event_loop, unused_tcp_port_factory, monkeypatch):
+    """Tests counting the messages and serving the metrics."""
+
+    monkeypatch.setattr(metrics, 'counters', dict.fromkeys(metrics.counters,
+                                                           0))
+    latency.reset()
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    port_metrics = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    await metrics.serve('localhost', port_metrics)
+
+    reader, writer = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    # NEW, NEW and FILL of both sides, an error
+    for code, (side, replies) in enumerate([('SELL', 1), ('BUY', 3),
+                                            ('BAD', 1)], 1):
+        await send(writer, {
+            'message': 'createOrder',
+            'orderId': code,
+            'side': side,
+            'price': 100,
+            'quantity': 10 + code,
+        })
+        for i in range(replies):
+            await read(reader)
+    await send(writer, {'message': 'cancelOrder', 'orderId': 2})
+    assert (await read(reader))['report'] == 'CANCELED'
+
+    metrics_reader, metrics_writer = \
+        await asyncio.open_connection(port=port_metrics)
+    metrics_writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+    response = (await metrics_reader.read()).decode('utf-8')
+    head, text = response.split('\r\n\r\n', 1)
+    assert head.startswith('HTTP/1.0 200 OK')
+
+    assert value(text, 'market_messages_received_total') == 4
+    assert value(text, 'market_orders_created_total') == 2
+    assert value(text, 'market_orders_canceled_total') == 1
+    assert value(text, 'market_trades_total') == 1
+    assert value(text, 'market_rejected_messages_total') == 1
+    assert value(text, 'market_bytes_sent_total') > 0
+    assert value(text, 'market_participants') == 1
+    assert value(text, 'market_watchers') == 1
+    assert value(text, 'market_book_orders{side="bid",symbol="WOOD"}') == 0
+    assert value(text, 'market_book_levels{side="ask",symbol="WOOD"}') == 0
+    assert '# TYPE market_latency_seconds histogram' in text
+    assert value(text, 'market_latency_seconds_count{stage="match"}') == 2
+    assert value(
+        text, 'market_latency_seconds_bucket{stage="match",le="+Inf"}') == 2
+    assert value(
+        text, 'market_latency_seconds_bucket{stage="match",le="1.0"}') == 2
+
+    metrics_reader, metrics_writer = \
+        await asyncio.open_connection(port=port_metrics)
+    metrics_writer.write(b'GET / HTTP/1.0\r\n\r\n')
+    response = (await metrics_reader.read()).decode('utf-8')
+    assert response.startswith('HTTP/1.0 404 Not Found')
@@ -0,0 +1,135 @@
+from datetime import datetime
+
+import pytest
+
+from market.book import RestingOrder
+from market import engine, factories, models, persistence
+from market.persistence import Writer
+
+
+def test_save_order():
+    """Tests that a saved order gets its id and is written."""
+
+    participant = factories.Participant()
+    order = RestingOrder(None, 'WOOD', 1, participant.id, 'buy', 145, 100)
+    persistence.save_order(order)
+    assert order.id is not None
+    assert order.active
+    assert order.registered_at is not None
+
+    persistence.writer.flush()
+    saved = models.Order.query.filter_by(id=order.id).one()
+    assert saved.participant_id == participant.id
+    assert (saved.quantity, saved.remaining_quantity,
+            saved.filled_quantity) == (100, 100, 0)
+
+
+def test_fill_order():
+    """Tests writing fills of orders and their executions."""
+
+    buy = factories.Order(side='buy', price=145, quantity=100)
+    sell = factories.Order(side='sell', price=140, quantity=60)
+    for order in [buy, sell]:
+        order.quantity -= 60
+        order.filled += 60
+        order.active = order.quantity > 0
+        persistence.fill_order(order)
+    trade = {'symbol': 'WOOD', 'price': 145, 'quantity': 60,
+             'time': datetime.now(), 'buy': buy, 'sell': sell}
+    persistence.save_execution(trade)
+    assert trade['id'] is not None
+
+    persistence.writer.flush()
+    saved = models.Order.query.filter_by(id=buy.id).one()
+    assert (saved.active, saved.remaining_quantity,
+            saved.filled_quantity) == (True, 40, 60)
+    saved = models.Order.query.filter_by(id=sell.id).one()
+    assert (saved.active, saved.remaining_quantity) == (False, 0)
+    execution = models.Execution.query.one()
+    assert (execution.buy_order_id, execution.sell_order) == \
+           (buy.id, saved)
+    assert (execution.price, execution.quantity) == (145, 60)
+
+
+def test_archive():
+    """Tests moving inactive orders and their executions to history."""
+
+    buy = factories.Order(side='buy', price=145, quantity=100)
+    sell = factories.Order(side='buy', price=145, quantity=60)
+    live = factories.Order(side='sell', price=150, quantity=10)
+    incoming = RestingOrder(None, 'WOOD', 1, None, 'sell', 145, 130)
+    persistence.save_order(incoming)
+    trades = engine.match(incoming)
+    assert not buy.active and sell.active and not incoming.active
+
+    persistence.archive(batch_size=10)
+    persistence.writer.flush()
+    assert {order.id for order in models.Order.query} == {sell.id, live.id}
+    assert {order.id for order in models.OrderHistory.query} == \
+           {buy.id, incoming.id}
+    assert sorted(execution.id for execution
+                  in models.ExecutionHistory.query) == \
+           [trade['id'] for trade in trades]
+    assert models.Execution.query.count() == 0
+
+    persistence.seed_ids(models.Order)
+    assert persistence.last_id(models.Order) == incoming.id
+
+
+def test_archive_batch():
+    """Tests archiving a batch of the oldest inactive orders only."""
+
+    orders = [factories.Order(active=False) for i in range(3)]
+    persistence.archive(batch_size=2)
+    persistence.writer.flush()
+    assert [order.id for order in models.Order.query] == [orders[2].id]
+
+
+class CountingWriter(Writer):
+    """Writer only counting the statements of each batch."""
+
+    def _commit(self, batch):
+        self.batches.append(len([item for item in batch
+                                 if isinstance(item, tuple)]))
+        super()._commit([item for item in batch
+                         if not isinstance(item, tuple)])
+
+
+def test_group_commit():
+    """Tests that queued statements are committed in batches,
+    cut only at message boundaries."""
+
+    writer = CountingWriter(batch_size=4, max_delay=0.05)
+    writer.batches = []
+
+    for message in range(5):
+        for i in range(3):
+            writer.put(None, {})
+        writer.barrier()
+    writer.flush()
+    writer.stop()
+
+    assert writer.batches == [6, 6, 3]
+
+
+def test_failed_commit():
+    """Tests that a failed commit stops committing and keeps
+    the statements."""
+
+    writer = Writer(batch_size=10, max_delay=0.05)
+    order = {'id': 1, 'symbol': 'WOOD', 'code': 1, 'active': True,
+             'side': 'buy', 'price': 10, 'participant_id': None,
+             'quantity': 1, 'remaining_quantity': 1, 'filled_quantity': 0,
+             'registered_at': None}
+
+    writer.put(persistence._insert_order, order)
+    with pytest.raises(Exception):
+        writer.flush()
+    writer.put(persistence._insert_order, dict(order, id=2))
+    with pytest.raises(Exception):
+        writer.flush()
+    writer.stop()
+
+    assert writer.error is not None
+    assert [params['id'] for statement, params in writer.failed] == [1, 2]
+    assert models.Order.query.count() == 0
@@ -0,0 +1,41 @@
+import pickle
+
+from market.ring import Ring
+
+
+def test_ring():
+    """Tests passing records in order, around the end of the ring."""
+
+    ring = Ring(4, 3)
+    other = pickle.loads(pickle.dumps(ring))
+    try:
+        assert other.get() == []
+        for i in range(10):
+            ring.put(b'%04d' % i)
+            ring.put(b'%04d' % (i + 100))
+            assert len(other) == 2
+            assert other.get() == [b'%04d' % i, b'%04d' % (i + 100)]
+    finally:
+        other.close()
+        ring.close(unlink=True)
+
+
+def test_backlog():
+    """Tests keeping records while the ring is full."""
+
+    ring = Ring(1, 2)
+    try:
+        for record in [b'a', b'b', b'c', b'd']:
+            ring.put(record)
+        assert list(ring.backlog) == [b'c', b'd']
+        assert not ring.retry()
+
+        assert ring.get() == [b'a', b'b']
+        # the order is kept
+        ring.put(b'e')
+        assert ring.retry() is False
+        assert ring.get() == [b'c', b'd']
+        assert ring.retry()
+        assert ring.get() == [b'e']
+    finally:
+        ring.close(unlink=True)
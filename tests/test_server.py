@@ -2,8 +2,10 @@ import asyncio
 import json
 import pytest
 
-from market import models
-from market.server import ParticipantProtocol, DatastreamProtocol
+from market import engine, factories, models, persistence, server, \
+    settings, wire
+from market.server import ParticipantProtocol, DatastreamProtocol, \
+    ConflatedDatastreamProtocol
 
 
 async def send(writer, msg):
@@ -15,10 +17,21 @@ async def read(reader):
     return json.loads((await reader.readline()).decode('utf-8'))
 
 
+async def watch(port):
+    """Connects a watcher, skips its initial snapshot.
+
+    :returns: The reader and the writer.
+    """
+
+    reader, writer = await asyncio.open_connection(port=port)
+    assert (await read(reader))['type'] == 'snapshot'
+    return reader, writer
+
+
 def trades_count():
-    return models.Order.query.filter(
-              models.Order.traded_to != None
-           ).count() / 2
+    """Counts the saved executions."""
+
+    return models.Execution.query.count()
 
 
 @pytest.mark.asyncio
@@ -35,7 +48,7 @@ async def test_process(event_loop, unused_tcp_port_factory):
 
     reader1, writer1 = await asyncio.open_connection(port=port)
     reader2, writer2 = await asyncio.open_connection(port=port)
-    datastream, _ = await asyncio.open_connection(port=port_datastream)
+    datastream, _ = await watch(port_datastream)
 
     await send(writer1, {
         'message': 'createOrder',
@@ -49,6 +62,7 @@ async def test_process(event_loop, unused_tcp_port_factory):
     answer = await read(datastream)
     assert answer == {
         'type': 'orderbook',
+        'symbol': 'WOOD',
         'side': 'ask',
         'price': 149,
         'quantity': 20,
@@ -76,8 +90,6 @@ async def test_process(event_loop, unused_tcp_port_factory):
     })
     answer = await read(reader2)
     assert answer['report'] == 'NEW'
-    answer = await read(datastream)
-    assert answer['side'] == 'bid'
 
     answer = await read(reader2)
     assert answer['report'] == 'FILL'
@@ -105,6 +117,19 @@ async def test_process(event_loop, unused_tcp_port_factory):
     assert answer['price'] == 149
     assert answer['quantity'] == 20
 
+    answer = await read(datastream)
+    assert answer == {
+        'type': 'orderbook',
+        'symbol': 'WOOD',
+        'side': 'ask',
+        'price': 140,
+        'quantity': 0,
+        'seqId': 5,
+    }
+    answer = await read(datastream)
+    assert answer['price'] == 149
+    assert answer['quantity'] == 0
+
     assert trades_count() == 2
 
 
@@ -327,3 +352,593 @@ async def test_market_buy(event_loop, unused_tcp_port):
     assert answer['quantity'] == 20
 
     assert trades_count() == 1
+
+
+@pytest.mark.asyncio
+async def test_async_persistence(event_loop, unused_tcp_port, monkeypatch):
+    """Tests replying before the changes are committed."""
+
+    monkeypatch.setattr(settings, 'PERSISTENCE_MODE', 'async')
+
+    port = unused_tcp_port
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    reader1, writer1 = await asyncio.open_connection(port=port)
+
+    await send(writer1, {
+        'message': 'createOrder',
+        'orderId': 123,
+        'side': 'SELL',
+        'price': 149,
+        'quantity': 20,
+    })
+    answer = await read(reader1)
+    assert answer['report'] == 'NEW'
+
+    persistence.writer.flush()
+    assert models.Order.query.filter_by(code=123).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_datastream_cancel(event_loop, unused_tcp_port_factory):
+    """Tests informing watchers about a canceled order."""
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    server_datastream = await event_loop.create_server(DatastreamProtocol,
+                                                       port=port_datastream)
+
+    reader1, writer1 = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    for order_id, quantity in [(123, 20), (124, 30)]:
+        await send(writer1, {
+            'message': 'createOrder',
+            'orderId': order_id,
+            'side': 'BUY',
+            'price': 145,
+            'quantity': quantity,
+        })
+        answer = await read(reader1)
+        assert answer['report'] == 'NEW'
+
+    answer = await read(datastream)
+    assert answer['quantity'] == 20
+    answer = await read(datastream)
+    assert answer['quantity'] == 50
+
+    await send(writer1, {
+        'message': 'cancelOrder',
+        'orderId': 123,
+    })
+    answer = await read(reader1)
+    assert answer['report'] == 'CANCELED'
+
+    answer = await read(datastream)
+    assert answer['side'] == 'bid'
+    assert answer['price'] == 145
+    assert answer['quantity'] == 30
+
+
+@pytest.mark.asyncio
+async def test_duplicate_id(event_loop, unused_tcp_port):
+    """Tests creating an order with an id of a live order (error)."""
+
+    port = unused_tcp_port
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    reader1, writer1 = await asyncio.open_connection(port=port)
+
+    order = {
+        'message': 'createOrder',
+        'orderId': 123,
+        'side': 'SELL',
+        'price': 149,
+        'quantity': 20,
+    }
+    await send(writer1, order)
+    answer = await read(reader1)
+    assert answer['report'] == 'NEW'
+
+    await send(writer1, order)
+    answer = await read(reader1)
+    assert answer['error'] == 'Order already exists.'
+
+
+@pytest.mark.asyncio
+async def test_symbols(event_loop, unused_tcp_port_factory):
+    """Tests trading several symbols."""
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    server_datastream = await event_loop.create_server(DatastreamProtocol,
+                                                       port=port_datastream)
+
+    reader1, writer1 = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    for order_id, symbol, side in [(1, 'ACME', 'SELL'), (2, 'WOOD', 'BUY'),
+                                   (3, 'ACME', 'BUY')]:
+        await send(writer1, {
+            'message': 'createOrder',
+            'symbol': symbol,
+            'orderId': order_id,
+            'side': side,
+            'price': 100,
+            'quantity': 10,
+        })
+        answer = await read(reader1)
+        assert answer['report'] == 'NEW'
+
+    answer = await read(reader1)
+    assert answer['report'] == 'FILL'
+    assert (answer['symbol'], answer['orderId']) == ('ACME', 3)
+    answer = await read(reader1)
+    assert answer['report'] == 'FILL'
+    assert (answer['symbol'], answer['orderId']) == ('ACME', 1)
+
+    messages = [await read(datastream) for i in range(4)]
+    assert [(m['type'], m['symbol']) for m in messages] == [
+        ('orderbook', 'ACME'),
+        ('orderbook', 'WOOD'),
+        ('trade', 'ACME'),
+        ('orderbook', 'ACME'),
+    ]
+
+    await send(writer1, {
+        'message': 'cancelOrder',
+        'symbol': 'ACME',
+        'orderId': 2,
+    })
+    answer = await read(reader1)
+    assert answer['error'] == 'Order does not exist.'
+    assert 'XYZ' not in engine.books
+
+    await send(writer1, {
+        'message': 'cancelOrder',
+        'symbol': 'XYZ',
+        'orderId': 2,
+    })
+    answer = await read(reader1)
+    assert answer['error'] == 'Order does not exist.'
+    assert 'XYZ' not in engine.books
+
+    await send(writer1, {
+        'message': 'cancelOrder',
+        'symbol': 'NOT A SYMBOL',
+        'orderId': 2,
+    })
+    answer = await read(reader1)
+    assert answer['error'] == 'Unknown symbol.'
+
+
+@pytest.mark.asyncio
+async def test_bad_values(event_loop, unused_tcp_port):
+    """Tests refusing orders with bad values before saving them."""
+
+    port = unused_tcp_port
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    reader1, writer1 = await asyncio.open_connection(port=port)
+
+    order = {
+        'message': 'createOrder',
+        'orderId': 123,
+        'side': 'SELL',
+        'price': 149,
+        'quantity': 20,
+    }
+    for bad, error in [({'side': 'foo'}, 'Unknown side.'),
+                       ({'price': '101'}, 'Bad number.'),
+                       ({'price': None}, 'Bad number.'),
+                       ({'quantity': '10'}, 'Bad number.'),
+                       ({'quantity': 1.5}, 'Bad number.'),
+                       ({'quantity': 0}, 'Bad number.'),
+                       ({'quantity': 10 ** 30}, 'Bad number.'),
+                       ({'quantity': 2 ** 63}, 'Bad number.'),
+                       ({'price': 10 ** 17}, 'Bad number.'),
+                       ({'price': 10 ** 30}, 'Bad number.'),
+                       ({'price': 1e300}, 'Bad number.'),
+                       ({'orderId': 2 ** 70}, 'Bad order id.'),
+                       ({'orderId': '123'}, 'Bad order id.'),
+                       ({'orderId': True}, 'Bad order id.')]:
+        await send(writer1, dict(order, **bad))
+        answer = await read(reader1)
+        assert answer['error'] == error
+
+    persistence.writer.flush()
+    assert models.Order.query.count() == 0
+    assert engine.book.best_ask() is None
+
+    # a bad message doesn't cost the connection (nor the orders before)
+    writer1.write(json.dumps(order).encode('utf-8') + b'\n'
+                  + json.dumps(dict(order, orderId=124, price=10 ** 30))
+                  .encode('utf-8') + b'\n')
+    assert (await read(reader1))['report'] == 'NEW'
+    assert (await read(reader1))['error'] == 'Bad number.'
+    await send(writer1, dict(order, orderId=125))
+    assert (await read(reader1))['report'] == 'NEW'
+
+
+class FailingWriter(persistence.Writer):
+    """Writer failing to commit anything."""
+
+    def _commit(self, batch):
+        self.error = self.error or Exception('DB is down')
+        super()._commit(batch)
+
+
+@pytest.mark.asyncio
+async def test_not_committed(event_loop, unused_tcp_port, monkeypatch):
+    """Tests replying with an error (not an ack) if committing fails."""
+
+    writer = FailingWriter(batch_size=10, max_delay=0.001)
+    monkeypatch.setattr(persistence, 'writer', writer)
+
+    port = unused_tcp_port
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    reader1, writer1 = await asyncio.open_connection(port=port)
+
+    order = {
+        'message': 'createOrder',
+        'orderId': 123,
+        'side': 'SELL',
+        'price': 149,
+        'quantity': 20,
+    }
+    await send(writer1, order)
+    answer = await read(reader1)
+    assert answer['error'] == 'Not committed.'
+
+    await send(writer1, dict(order, orderId=124))
+    answer = await read(reader1)
+    assert answer['error'] == 'Market halted.'
+
+    writer.stop()
+    assert len(writer.failed) == 2
+
+
+@pytest.mark.asyncio
+async def test_decimal_price(event_loop, unused_tcp_port_factory):
+    """Tests converting prices to ticks and back."""
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+
+    server = await event_loop.create_server(ParticipantProtocol,
+                                            port=port)
+    server_datastream = await event_loop.create_server(DatastreamProtocol,
+                                                       port=port_datastream)
+
+    reader1, writer1 = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    order = {
+        'message': 'createOrder',
+        'orderId': 123,
+        'side': 'SELL',
+        'price': 100.5,
+        'quantity': 20,
+    }
+    await send(writer1, order)
+    answer = await read(reader1)
+    assert answer['report'] == 'NEW'
+    answer = await read(datastream)
+    assert answer['price'] == 100.5
+    assert engine.book.best_ask().price == 10050
+
+    await send(writer1, dict(order, orderId=124, price=100.505))
+    answer = await read(reader1)
+    assert answer['error'] == 'Price not on a tick.'
+
+
+@pytest.mark.asyncio
+async def test_framing(event_loop, unused_tcp_port_factory, monkeypatch):
+    """Tests pipelined, split, bad and too long messages."""
+
+    monkeypatch.setattr(settings, 'MAX_MESSAGE_SIZE', 200)
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    reader, writer = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    encode = lambda msg: json.dumps(msg).encode('utf-8') + b'\n'
+    orders = [encode({
+        'message': 'createOrder',
+        'orderId': code,
+        'side': 'SELL',
+        'price': 150,
+        'quantity': 10,
+    }) for code in range(1, 4)]
+
+    # two messages in one chunk, the third one split
+    writer.write(orders[0] + orders[1] + orders[2][:10])
+    await writer.drain()
+    answers = [await read(reader) for i in range(2)]
+    assert [(a['orderId'], a['seqId']) for a in answers] == [(1, 1), (2, 2)]
+    # the changes of the batch at once
+    answer = await read(datastream)
+    assert (answer['price'], answer['quantity']) == (150, 20)
+
+    writer.write(orders[2][10:])
+    await writer.drain()
+    assert (await read(reader))['orderId'] == 3
+
+    writer.write(b'{"message": \n[1]\n\n')
+    await writer.drain()
+    assert [(await read(reader))['error'] for i in range(2)] == \
+           ['Bad message.'] * 2
+
+    # the rest of a too long message is skipped
+    writer.write(b'"' * 300)
+    await writer.drain()
+    assert (await read(reader))['error'] == 'Message too long.'
+    writer.write(b'"' * 300 + b'\n' + orders[0])
+    await writer.drain()
+    answer = await read(reader)
+    assert (answer['error'], answer['seqId']) == \
+           ('Order already exists.', 7)
+
+
+@pytest.mark.asyncio
+async def test_binary(event_loop, unused_tcp_port):
+    """Tests the binary protocol, along with a JSON participant."""
+
+    port = unused_tcp_port
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    reader1, writer1 = await asyncio.open_connection(port=port)
+    reader2, writer2 = await asyncio.open_connection(port=port)
+
+    async def read_binary(count):
+        data = b''
+        messages = []
+        while len(messages) < count:
+            data += await reader1.read(1024)
+            received, data = wire.read(data)
+            messages.extend(received)
+        return messages
+
+    # the magic split
+    writer1.write(wire.MAGIC[:3])
+    await asyncio.sleep(0.01)
+    writer1.write(wire.MAGIC[3:] + wire.create_order(1, 'SELL', 15000, 10))
+    assert await reader1.readexactly(len(wire.MAGIC)) == wire.MAGIC
+    assert await read_binary(1) == [{
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 1,
+        'report': 'NEW',
+        'seqId': 1,
+    }]
+
+    await send(writer2, {
+        'message': 'createOrder',
+        'orderId': 1,
+        'side': 'BUY',
+        'price': 150,
+        'quantity': 4,
+    })
+    answers = [await read(reader2) for i in range(2)]
+    assert answers[1]['report'] == 'FILL'
+    fill, = await read_binary(1)
+    assert (fill['report'], fill['price'], fill['quantity']) == \
+        ('FILL', 150, 4)
+
+    writer1.write(wire.cancel_order(1, seq_id=2) + wire.cancel_order(1)
+                  + wire.create_order(2, 'BUY', 0, 1, seq_id=4))
+    answers = await read_binary(3)
+    assert [answer.get('report', answer.get('error'))
+            for answer in answers] == \
+        ['CANCELED', 'Order does not exist.', 'Bad number.']
+
+    writer1.write(b'{"message": "cancelOrder"}\n')
+    answer, = await read_binary(1)
+    assert answer['error'] == 'Bad message.'
+
+
+@pytest.mark.asyncio
+async def test_datastream_seq_id(event_loop, unused_tcp_port_factory):
+    """Tests that watchers share the seq ids of the datastream
+    (and get the same bytes)."""
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    reader, writer = await asyncio.open_connection(port=port)
+    datastream1, writer1 = await watch(port_datastream)
+
+    order = {
+        'message': 'createOrder',
+        'side': 'SELL',
+        'price': 150,
+        'quantity': 10,
+    }
+    await send(writer, dict(order, orderId=1))
+    await read(reader)
+    assert (await read(datastream1))['seqId'] == 1
+
+    datastream2, writer2 = await watch(port_datastream)
+    await asyncio.sleep(0.01)
+    await send(writer, dict(order, orderId=2, price=151))
+    await read(reader)
+    lines = [await datastream.readline()
+             for datastream in [datastream1, datastream2]]
+    assert lines[0] == lines[1]
+    assert json.loads(lines[0].decode('utf-8'))['seqId'] == 2
+
+
+@pytest.mark.asyncio
+async def test_datastream_snapshot(event_loop, unused_tcp_port_factory):
+    """Tests the snapshot of the loaded book and of the changes a new
+    watcher gets first."""
+
+    # as loaded on start (prices in ticks)
+    for side, price, quantity in [('buy', 10000, 5), ('buy', 10000, 7),
+                                  ('sell', 11000, 10)]:
+        factories.Order(side=side, price=price, quantity=quantity)
+    engine.books.pop_changes()
+    server._dispatch([], server._book_messages())
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    reader, writer = await asyncio.open_connection(port=port)
+    await send(writer, {
+        'message': 'createOrder',
+        'orderId': 1,
+        'side': 'SELL',
+        'price': 111,
+        'quantity': 3,
+    })
+    await read(reader)
+
+    datastream, datastream_writer = await asyncio.open_connection(
+        port=port_datastream)
+    assert await read(datastream) == {
+        'type': 'snapshot',
+        'seqId': 3,
+        'levels': [
+            {'symbol': 'WOOD', 'side': 'ask', 'price': 110, 'quantity': 10},
+            {'symbol': 'WOOD', 'side': 'ask', 'price': 111, 'quantity': 3},
+            {'symbol': 'WOOD', 'side': 'bid', 'price': 100, 'quantity': 12},
+        ],
+    }
+
+    await send(writer, {'message': 'cancelOrder', 'orderId': 1})
+    await read(reader)
+    assert await read(datastream) == {
+        'type': 'orderbook',
+        'symbol': 'WOOD',
+        'side': 'ask',
+        'price': 111,
+        'quantity': 0,
+        'seqId': 4,
+    }
+
+
+async def slow_watcher(event_loop, ports, policy, monkeypatch):
+    """Makes a sell order, then one more and a trade
+    while a watcher is slow (with the given policy).
+
+    :returns: The datastream reader and writer of the watcher.
+    """
+
+    monkeypatch.setattr(settings, 'WATCHER_POLICY', policy)
+    port, port_datastream = ports
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+    reader, writer = await asyncio.open_connection(port=port)
+    datastream, datastream_writer = await watch(port_datastream)
+
+    order = {
+        'message': 'createOrder',
+        'side': 'SELL',
+        'price': 150,
+        'quantity': 10,
+    }
+    await send(writer, dict(order, orderId=1))
+    await read(reader)
+    assert (await read(datastream))['seqId'] == 1
+
+    watcher, = server.watchers
+    watcher.pause_writing()
+    await send(writer, dict(order, orderId=2, price=151))
+    await read(reader)
+    await send(writer, dict(order, orderId=3, side='BUY', quantity=4))
+    for i in range(3):
+        await read(reader)
+    watcher.resume_writing()
+    return datastream, datastream_writer
+
+
+@pytest.mark.asyncio
+async def test_slow_watcher_resync(event_loop, unused_tcp_port_factory,
+                                   monkeypatch):
+    """Tests sending a snapshot to a watcher which was too slow."""
+
+    datastream, writer = await slow_watcher(
+        event_loop, [unused_tcp_port_factory() for i in range(2)],
+        'resync', monkeypatch)
+    assert await read(datastream) == {
+        'type': 'snapshot',
+        'seqId': 4,
+        'levels': [
+            {'symbol': 'WOOD', 'side': 'ask', 'price': 150, 'quantity': 6},
+            {'symbol': 'WOOD', 'side': 'ask', 'price': 151, 'quantity': 10},
+        ],
+    }
+
+
+@pytest.mark.asyncio
+async def test_slow_watcher_conflate(event_loop, unused_tcp_port_factory,
+                                     monkeypatch):
+    """Tests sending the latest quantities of the changed levels
+    to a watcher which was too slow."""
+
+    datastream, writer = await slow_watcher(
+        event_loop, [unused_tcp_port_factory() for i in range(2)],
+        'conflate', monkeypatch)
+    answers = [await read(datastream) for i in range(2)]
+    assert [(a['seqId'], a['price'], a['quantity']) for a in answers] == \
+           [(2, 151, 10), (4, 150, 6)]
+
+
+@pytest.mark.asyncio
+async def test_slow_watcher_disconnect(event_loop, unused_tcp_port_factory,
+                                       monkeypatch):
+    """Tests disconnecting a watcher which was too slow."""
+
+    datastream, writer = await slow_watcher(
+        event_loop, [unused_tcp_port_factory() for i in range(2)],
+        'disconnect', monkeypatch)
+    assert await datastream.read() == b''
+    assert server.watchers == []
+
+
+@pytest.mark.asyncio
+async def test_conflated_datastream(event_loop, unused_tcp_port_factory):
+    """Tests sending the latest quantity of each changed level and all
+    the trades on the conflated datastream."""
+
+    port, port_conflated = [unused_tcp_port_factory() for i in range(2)]
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(ConflatedDatastreamProtocol,
+                                   port=port_conflated)
+    reader, writer = await asyncio.open_connection(port=port)
+    conflated, conflated_writer = await watch(port_conflated)
+    await asyncio.sleep(0.01)
+
+    for code, (side, quantity, replies) in enumerate(
+            [('SELL', 10, 1), ('SELL', 5, 1), ('BUY', 4, 3)], 1):
+        await send(writer, {
+            'message': 'createOrder',
+            'orderId': code,
+            'side': side,
+            'price': 150,
+            'quantity': quantity,
+        })
+        for i in range(replies):
+            await read(reader)
+    assert server.datastream_seq_id == 4
+
+    server._send_conflated()
+    answers = [await read(conflated) for i in range(2)]
+    assert sorted(a['type'] for a in answers) == ['orderbook', 'trade']
+    level, = [a for a in answers if a['type'] == 'orderbook']
+    assert (level['price'], level['quantity']) == (150, 11)
+    trade, = [a for a in answers if a['type'] == 'trade']
+    assert trade['quantity'] == 4
+    assert [a['seqId'] for a in answers] == \
+        sorted(a['seqId'] for a in answers)
+    assert server.conflated == {}
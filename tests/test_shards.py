@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+
+from market import models, persistence, server, shards
+from market.server import ParticipantProtocol, DatastreamProtocol
+
+from test_server import read, send, watch
+
+
+def test_shard_of():
+    """Tests that symbols are partitioned stably."""
+
+    assert shards.shard_of('WOOD', 4) == shards.shard_of('WOOD', 4)
+    assert {shards.shard_of('S%d' % i, 4) for i in range(100)} == \
+           {0, 1, 2, 3}
+
+
+def test_partition_ids(monkeypatch):
+    """Tests assigning primary keys of one partition only."""
+
+    monkeypatch.setattr(persistence, '_ids', {models.Order: 10})
+    persistence.partition_ids(3, 1)
+    try:
+        assert [persistence.next_id(models.Order) for i in range(3)] == \
+               [13, 16, 19]
+    finally:
+        persistence.partition_ids(1, 0)
+
+
+@pytest.mark.asyncio
+async def test_router(event_loop, unused_tcp_port_factory, monkeypatch):
+    """Tests matching in worker processes."""
+
+    router = shards.Router(2)
+    router.start(event_loop)
+    monkeypatch.setattr(server, 'router', router)
+
+    port = unused_tcp_port_factory()
+    port_datastream = unused_tcp_port_factory()
+    await event_loop.create_server(ParticipantProtocol, port=port)
+    await event_loop.create_server(DatastreamProtocol, port=port_datastream)
+
+    reader1, writer1 = await asyncio.open_connection(port=port)
+    reader2, writer2 = await asyncio.open_connection(port=port)
+    datastream, _ = await watch(port_datastream)
+
+    # both symbols in different shards
+    assert shards.shard_of('ACME', 2) != shards.shard_of('WOOD', 2)
+    for symbol in ['ACME', 'WOOD']:
+        await send(writer1, {
+            'message': 'createOrder',
+            'symbol': symbol,
+            'orderId': 1,
+            'side': 'SELL',
+            'price': 100,
+            'quantity': 10,
+        })
+        answer = await read(reader1)
+        assert (answer['symbol'], answer['report']) == (symbol, 'NEW')
+        answer = await read(datastream)
+        assert (answer['symbol'], answer['quantity']) == (symbol, 10)
+
+    await send(writer2, {
+        'message': 'createOrder',
+        'symbol': 'WOOD',
+        'orderId': 1,
+        'side': 'BUY',
+        'price': 100,
+        'quantity': 4,
+    })
+    answer = await read(reader2)
+    assert answer['report'] == 'NEW'
+    answer = await read(reader2)
+    assert (answer['report'], answer['quantity']) == ('FILL', 4)
+    answer = await read(reader1)
+    assert (answer['symbol'], answer['report']) == ('WOOD', 'FILL')
+
+    answer = await read(datastream)
+    assert answer['type'] == 'trade'
+    answer = await read(datastream)
+    assert (answer['symbol'], answer['quantity']) == ('WOOD', 6)
+
+    writer1.close()
+    answers = [await read(datastream) for i in range(2)]
+    assert sorted((a['symbol'], a['quantity']) for a in answers) == \
+           [('ACME', 0), ('WOOD', 0)]
+
+    router.stop()
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from market import engine, factories, models, persistence, settings, snapshot
+from market.book import Registry, RestingOrder
+
+
+def book_state():
+    return [[(level.price, [(o.id, o.quantity) for o in level])
+             for level in side]
+            for side in [engine.book.bids, engine.book.asks]]
+
+
+def test_write_load(tmpdir):
+    """Tests writing and loading a snapshot."""
+
+    path = str(tmpdir.join('snapshot.bin'))
+    books = Registry()
+    now = datetime.now()
+    for order in [RestingOrder(1, 'WOOD', 11, 5, 'buy', 145, 100, now),
+                  RestingOrder(2, 'WOOD', 12, 5, 'buy', 14550, 200, now),
+                  RestingOrder(3, 'WOOD', 13, None, 'sell', 149, 300, now),
+                  RestingOrder(4, 'WOOD', 14, 6, 'market_sell', None, 400,
+                               now),
+                  RestingOrder(5, 'ACME', 11, 5, 'sell', 10, 50, now)]:
+        books[order.symbol].add(order)
+
+    snapshot.write(path, 42, snapshot.capture(books), (10, 6, 3))
+    seq, orders, last_ids = snapshot.load(path)
+
+    assert (seq, last_ids) == (42, (10, 6, 3))
+    assert [(o.id, o.symbol, o.code, o.participant_id, o.side, o.price,
+             o.quantity) for o in orders] == [
+        (2, 'WOOD', 12, 5, 'buy', 14550, 200),
+        (1, 'WOOD', 11, 5, 'buy', 145, 100),
+        (3, 'WOOD', 13, None, 'sell', 149, 300),
+        (4, 'WOOD', 14, 6, 'market_sell', None, 400),
+        (5, 'ACME', 11, 5, 'sell', 10, 50),
+    ]
+    assert orders[0].registered_at == now
+
+
+def test_no_snapshot(tmpdir):
+    """Tests loading a missing snapshot."""
+
+    assert snapshot.load(str(tmpdir.join('snapshot.bin'))) is None
+    assert snapshot.load(None) is None
+
+
+def test_checkpoint_recover(journal, tmpdir, monkeypatch):
+    """Tests recovering from a snapshot and the journal tail."""
+
+    monkeypatch.setattr(settings, 'SNAPSHOT_PATH',
+                        str(tmpdir.join('snapshot.bin')))
+
+    s = lambda **kwargs: factories.Order(side='sell', **kwargs)
+    s(price=149, quantity=500)
+    canceled = s(price=151, quantity=1000)
+    s(price=151, quantity=300)
+
+    finish = engine.checkpoint()
+    assert engine.checkpoint() is None
+    finish()
+    assert engine.checkpoint() is not None
+
+    engine.cancel(canceled)
+    buy = RestingOrder(None, 'WOOD', 1, None, 'buy', 151, 700)
+    persistence.save_order(buy)
+    engine.match(buy)
+
+    expected = book_state()
+    journal.flush()
+
+    engine.book.clear()
+    engine.recover()
+
+    assert book_state() == expected
+    assert engine.book.best_ask().quantity == 100
+    assert persistence.last_id(models.Order) >= buy.id
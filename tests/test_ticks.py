@@ -0,0 +1,26 @@
+from decimal import Decimal, InvalidOperation
+
+import pytest
+
+from market import settings, ticks
+
+
+def test_ticks(monkeypatch):
+    """Tests converting prices to ticks and back."""
+
+    monkeypatch.setattr(settings, 'TICK_SIZES', {'ACME': '0.5'})
+    monkeypatch.setattr(ticks, '_sizes', {})
+
+    assert ticks.to_ticks('WOOD', 145) == 14500
+    assert ticks.to_ticks('WOOD', 100.05) == 10005
+    assert ticks.to_ticks('ACME', Decimal('10.5')) == 21
+    with pytest.raises(ValueError):
+        ticks.to_ticks('ACME', 10.25)
+    with pytest.raises(InvalidOperation):
+        ticks.to_ticks('WOOD', 10 ** 30)
+
+    assert ticks.to_price('WOOD', 14500) == 145
+    assert isinstance(ticks.to_price('WOOD', 14500), int)
+    assert ticks.to_price('WOOD', 10005) == Decimal('100.05')
+    assert ticks.to_price('ACME', 21) == Decimal('10.5')
+    assert ticks.to_price('ACME', None) is None
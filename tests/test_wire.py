@@ -0,0 +1,72 @@
+import pytest
+
+from market import wire
+
+
+def test_messages():
+    """Tests decoding messages of participants, even split anyhow."""
+
+    data = wire.create_order(5, 'SELL', 10050, 3, seq_id=1) \
+        + wire.cancel_order(5, symbol='ACME') \
+        + wire.create_order(6, 'MARKET_BUY', 0, 7)
+    messages, rest = wire.split(data[:-10])
+    assert len(messages) == 2
+    assert rest == data[-wire.CREATE.size:-10]
+    messages.extend(wire.split(rest + data[-10:])[0])
+
+    assert [wire.decode(message) for message in messages] == [{
+        'message': 'createOrder',
+        'orderId': 5,
+        'seqId': 1,
+        'side': 'SELL',
+        'price': 100.5,
+        'quantity': 3,
+    }, {
+        'message': 'cancelOrder',
+        'symbol': 'ACME',
+        'orderId': 5,
+    }, {
+        'message': 'createOrder',
+        'orderId': 6,
+        'side': 'MARKET_BUY',
+        'quantity': 7,
+    }]
+
+
+def test_bad_messages():
+    """Tests that unknown messages can't be decoded."""
+
+    messages, rest = wire.split(wire.cancel_order(1) + b'{"message"}')
+    assert (len(messages), rest) == (2, b'')
+    with pytest.raises(ValueError):
+        wire.decode(messages[1])
+    # an unknown side is left to be refused
+    message = wire.decode(wire.CREATE.pack(b'C', b'', 0, 1, 9, 100, 1))
+    assert message['side'] is None
+
+
+def test_replies():
+    """Tests encoding replies (and reading them by a client)."""
+
+    replies = [{
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 5,
+        'report': 'NEW',
+        'seqId': 1,
+    }, {
+        'message': 'executionReport',
+        'symbol': 'WOOD',
+        'orderId': 5,
+        'report': 'FILL',
+        'price': 100.5,
+        'quantity': 3,
+        'seqId': 2,
+    }, {
+        'error': 'Bad message.',
+        'seqId': 3,
+    }]
+    data = b''.join(wire.encode(reply) for reply in replies)
+    error = wire.ERROR.size + len('Bad message.')
+    assert wire.read(data[:-1]) == (replies[:2], data[-error:-1])
+    assert wire.read(data) == (replies, b'')
@@ -42,10 +42,21 @@ class MarketModel:
 		self._trades = [] # type: List[Dict[str, Any]]
 		self._bid = {} # type: Dict[int, int]
 		self._ask = {} # type: Dict[int, int]
+		self._seq_id = 0
 
 
 	def apply(self, message: Dict[str, Any]) -> None:
-		if message['type'] == 'trade':
+		if message.get('seqId', 0) and message['seqId'] <= self._seq_id:
+			return # older than the snapshot
+		if message['type'] == 'snapshot':
+			self._seq_id = message['seqId']
+			self._bid = {}
+			self._ask = {}
+			for level in message['levels']:
+				assert level['side'] in {'bid', 'ask'}, 'Invalid order book side'
+				side = self._bid if level['side'] == 'bid' else self._ask
+				side[level['price']] = level['quantity']
+		elif message['type'] == 'trade':
 			self._trades.append({
 				'time': datetime.datetime.fromtimestamp(message['time']),
 				'price': message['price'],